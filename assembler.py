@@ -0,0 +1,964 @@
+'''
+ # Assembler
+
+ アセンブルの途中の状態(今のアドレス、タグの表、fixup)はすべて Assembler のインスタンスが持つ。
+ インスタンスどうしは何も共有しないので、別々のスレッドで同時に使ってよい
+ (一つのインスタンスを複数のスレッドから同時に使うのはだめ)。
+
+ ```
+ a = Assembler()
+ image = a.assemble(open('fib.s').read())
+ image = a.assemble(src, lib='', prologue=False)
+ ```
+
+ プロセスの中で使い回すもの(prologue やライブラリのパース結果、
+ リンク済みのライブラリ)はモジュールに置いてあるが、どれも一度作ったら書き換えない。
+'''
+
+import unittest
+
+import extension
+import heap
+import ir
+import library
+import optable
+import peephole
+import reach
+import symbols
+import utils
+from ir import match_displacement
+from stats import phase
+
+
+__builtin_stack_init = (0xf4240 - 4) // 4
+__builtin_heap_init =   0x25000 //4
+
+program_start = 456 * 4
+
+# B形式の即値(12bit, 語単位)で飛べる範囲。外に飛ぶ分岐は緩和する
+branch_range = range(-2**11, 2**11)
+# jal (20bit) で飛べる範囲。中に飛ぶ call, tail は jal 一つにする
+jal_range = range(-2**19, 2**19)
+
+builtin_tags = {
+    '__builtin_stack_init': __builtin_stack_init,
+    '__builtin_heap_init': __builtin_heap_init,
+}
+
+
+class Assembler:
+    prologue = '''\
+li sp, __builtin_stack_init
+li hp, __builtin_heap_init
+j _min_caml_start
+'''
+
+    epilogue = '''
+li a0, __builtin_heap_init
+jalr x0, a0, -1
+'''
+
+    def __init__(self, lib=None, lib_base=None, use_lib_cache=True, verbose=False,
+                 listing=False, stats=None, optimize=False, prune_lib=True):
+        # lib は libmincaml.S の中身。None のときは必要になった時点で library.find で読む。
+        # '' ならライブラリ無し
+        self.lib = lib
+        # None でなければ、リンク済みのライブラリをこのアドレスに置く
+        self.lib_base = lib_base
+        self.use_lib_cache = use_lib_cache
+        # 診断メッセージ(無視した行、ヒープのタグ、タグの表など)を出すか
+        self.verbose = verbose
+        # リスティング用に、置いた命令を (バッファ上の位置, アドレス, Inst) で覚えておくか
+        self.trace = [] if listing else None
+        # stats.Stats。None なら何も測らない
+        self.stats = stats
+        if stats is not None:
+            self.instrument(stats)
+        # 配置の前に peephole (のぞき穴最適化) をかけるか
+        self.optimize = optimize
+        # ライブラリのうち、プログラムから使われない関数を除くか
+        self.prune_lib = prune_lib
+        # 直前に置いたもの (symbols で使う)
+        self.placed = None
+        self.reset()
+
+    def instrument(self, stats):
+        ''' 命令ごとに呼ばれるメソッドを、時間や回数を測るものに差し替える '''
+        self.resolve_args = stats.timed('resolve tags', self.resolve_args)
+        self.asm_op = stats.timed('encode', self.asm_op)
+        self.asm = stats.timed('expand pseudo-ops', self.asm)
+        self._solve_tag = stats.counted('tag lookups', self._solve_tag)
+
+    def reset(self, relaxed=None):
+        self.read_bytes = 0
+        self.tags = dict(builtin_tags)  # map[tag]int
+        self.use_place_holder = True
+
+        # タグを参照した行: (バッファ上の位置, アドレス, Inst, 未解決のタグがあったか)
+        self.fixups = []
+        self.unresolved = False
+        self.redefined = set()
+        if self.trace is not None:
+            self.trace = []
+        # 命令以外のものを置いた場所: (アドレス, 大きさ, 名前)
+        self.regions = []
+        # optable.relaxable の命令のうち、長い形にしたもの (Inst)。
+        # 遠くに飛ぶ分岐と、近くに飛ばない (値が12bitに収まらない) call, tail, _li。
+        # 配置をやり直すときは引き継ぐ
+        self.relaxed = set() if relaxed is None else relaxed
+
+    def get_lib_data(self):
+        if self.lib is None:
+            with phase(self.stats, 'read library'):
+                self.lib = library.find(verbose=self.verbose)
+        return self.lib
+
+    def define_tag(self, name):
+        if name in self.tags:
+            #raise Exception('Collision occurred: {}'.format(name))
+            # 後に定義された方が有効。それより前に解決した参照はfixupで直す
+            self.redefined.add(name)
+        self.tags[name] = self.read_bytes // 4
+
+    def _solve_tag(self, name):
+        if name in self.tags:
+            return self.tags[name]
+
+        if self.use_place_holder:
+            self.unresolved = True
+            return 0
+
+        if self.verbose:
+            print(name, hex(heap.get(name)))
+        return heap.get(name) // 4
+        #print('{} は見つかりませんでした。'.format(name))
+        #raise Exception('Tag is not found')
+
+    def solve_tag_relative(self, name):
+        return str(self._solve_tag(name) - self.read_bytes//4)
+
+    def solve_tag_absolute(self, name):
+        return str(self._solve_tag(name))
+
+    def check_args(self, name, args, length):
+        if (len(args) == length):
+            return
+
+        print('{} should have {} args. But got {}'.format(name, length, len(args)))
+        print('  -> {} {}', name, ','.join(args))
+        raise(Exception('Syntax Error'))
+
+    def handle_args(self, args, relative=True):
+        ret = []
+        for arg in args:
+            r = match_displacement(arg)
+            if r is not None:
+                # 再帰的にパターンが存在するかを（一応）確認する
+                l = self.handle_args(r)
+                ret += l
+            elif not utils.is_special(arg):
+                if relative:
+                    ret.append(self.solve_tag_relative(arg))
+                else:
+                    ret.append(self.solve_tag_absolute(arg))
+            else:
+                ret.append(arg)
+        return ret
+
+    def asm(self, name, arguments):
+        op = optable.lookup(name, arguments)
+        return self.asm_op(op, self.handle_args(arguments, op.relative))
+
+    def asm_op(self, op, args):
+        if op.directive is not None:
+            # データは一行分をまとめて作る (.align は今のアドレスを見る)
+            return op.directive.emit(args, self.read_bytes)
+        self.check_args(op.name, args, op.arity)
+        if op.expand is None:
+            return op.encoder(op, *args)
+
+        # 拡張命令は複数命令に渡っている可能性がある。
+        ret = bytes()
+        for (name, args) in op.expand(*args):
+            ret += self.asm(name, args)
+        return ret
+
+    def resolve_args(self, inst):
+        args = inst.args
+        if inst.refs is not None:
+            args = list(args)
+            if inst.op.relative:
+                for i in inst.refs:
+                    args[i] = self.solve_tag_relative(args[i])
+            else:
+                for i in inst.refs:
+                    args[i] = self.solve_tag_absolute(args[i])
+        return args
+
+    def encode_relaxable(self, op, args, long):
+        if op.name not in optable.branches:
+            if long:
+                return self.asm_op(op, args)
+            return self.asm_op(optable.short[op.name], args)
+        if not long:
+            return self.asm_op(op, args)
+
+        jal = optable.table['jal']
+        if op.name == 'bnei':
+            # 等しくなければ2語先の jal で far へ、等しければ次の jal で飛び越す
+            (rs, rt, imm) = args
+            return (self.asm_op(op, [rs, rt, '2']) + self.asm_op(jal, ['x0', '2'])
+                    + self.asm_op(jal, ['x0', str(int(imm) - 2)]))
+
+        # b<cond> rs, rt, far を b<!cond> rs, rt, 2; jal x0, far にする
+        if op.expand is not None:
+            ((name, args),) = op.expand(*args)
+            op = optable.table[name]
+        (rs, rt, imm) = args
+        inv = optable.table[optable.inverse[op.name]]
+        # jal は分岐の次の語にあるので、そこからの距離
+        return (self.asm_op(inv, [rs, rt, '2'])
+                + self.asm_op(jal, ['x0', str(int(imm) - 1)]))
+
+    def encode(self, inst, args=None):
+        if args is None:
+            args = self.resolve_args(inst)
+        try:
+            if inst.op.name in optable.relaxable:
+                return self.encode_relaxable(inst.op, args, inst in self.relaxed)
+            return self.asm_op(inst.op, args)
+        except Exception as e:
+            ir.error_line(inst.source, inst.lineno, inst)
+            raise e
+
+    def place(self, image, insts):
+        for inst in insts:
+            if inst.tag is not None:
+                self.define_tag(inst.tag)
+            if inst.op is None:
+                if self.trace is not None:
+                    self.trace.append((len(image), self.read_bytes, inst))
+                continue
+            self.unresolved = False
+            a = self.encode(inst)
+            if inst.refs is not None:
+                self.fixups.append((len(image), self.read_bytes, inst, self.unresolved))
+            if self.trace is not None:
+                self.trace.append((len(image), self.read_bytes, inst))
+            self.read_bytes += len(a)
+            image += a
+
+    def resolve_fixups(self, image):
+        self.use_place_holder = False
+        for (offset, addr, inst, pending) in self.fixups:
+            if not pending and self.redefined.isdisjoint(inst.args[i] for i in inst.refs):
+                continue
+            self.read_bytes = addr
+            a = self.encode(inst)
+            image[offset:offset + len(a)] = a
+
+    def size(self, inst, addr=0):
+        ''' addr に置いたときの inst の大きさ '''
+        op = inst.op
+        if op.name in optable.relaxable:
+            return optable.long_size[op.name] if inst in self.relaxed else 4
+        if op.size is None:
+            return op.directive.size(inst.args, addr)
+        return op.size
+
+    def out_of_range(self, inst, addr):
+        ''' addr に置いた inst (optable.relaxable のもの) が、短い形では足りないか '''
+        if inst in self.relaxed:
+            return False
+        name = inst.op.name
+        arg = inst.args[optable.relaxable[name]]
+        t = self.tags.get(arg)
+        if name == '_li':
+            if t is None:
+                if not heap.has(arg):
+                    return True
+                t = heap.get(arg) // 4
+            return not extension.fits_li_short(str(t))
+        if t is None:
+            # 数で直接書いた飛び先などは今まで通り
+            return name not in optable.branches
+        if name in optable.branches:
+            return t - addr // 4 not in branch_range
+        return t - addr // 4 not in jal_range
+
+    def relax(self, placed):
+        '''
+        置いた命令 (アドレス, Inst) のうち、短い形では足りないものを self.relaxed に加える。
+        加えた数を返す。0 でなければ配置をやり直す。
+        どれも短い形から始めて長くするだけで、命令どうしの距離もアドレスも縮まないので、
+        いずれ加えるものが無くなる
+        '''
+        relaxable = optable.relaxable
+        far = [inst for (addr, inst) in placed
+               if inst.op.name in relaxable and self.out_of_range(inst, addr)]
+        self.relaxed.update(far)
+        return len(far)
+
+    def savings(self, insts):
+        '''
+        call, tail, li を常に二命令にしていたときと比べて減った命令の数と、
+        緩和した分岐の数と、それで増えた命令の数
+        '''
+        saved = 0
+        grown = 0
+        added = 0
+        for inst in insts:
+            if inst.op is None:
+                continue
+            name = inst.op.name
+            if name in optable.short:
+                if inst not in self.relaxed:
+                    saved += 1
+            elif name == '_li_short':
+                saved += 1
+            elif name in optable.branches and inst in self.relaxed:
+                grown += 1
+                added += optable.long_size[name] // 4 - 1
+        return (saved, grown, added)
+
+    def report_savings(self, insts):
+        (saved, grown, added) = self.savings(insts)
+        if self.verbose:
+            print('{} instructions ({} bytes) saved by short call/tail/li, '
+                  '{} branches relaxed (+{} bytes)'.format(saved, saved * 4, grown, added * 4))
+        if self.stats is not None:
+            self.stats.counters['instructions saved'] += saved
+            self.stats.counters['bytes saved'] += saved * 4
+            self.stats.counters['relaxed branches'] += grown
+
+    def peephole(self, head, body, tail, lib_insts, lib_tags):
+        ''' head, body, tail, lib_insts を最適化したものを返す '''
+        with phase(self.stats, 'peephole'):
+            (sections, counts) = peephole.optimize([head, body, tail, lib_insts], lib_tags)
+        if self.verbose:
+            print('peephole: ' + ', '.join('{} {}'.format(k, counts[k]) for k in sorted(counts)))
+        if self.stats is not None:
+            for k in counts:
+                self.stats.counters['peephole: ' + k] += counts[k]
+        return sections
+
+    def drop_unused(self, head, body, tail, lib_insts):
+        ''' lib_insts から、たどり着けない関数を除いたものを返す '''
+        with phase(self.stats, 'reachability'):
+            (kept, removed) = reach.prune(head, body, tail, lib_insts)
+        # どれもまだ短い形なので、その大きさで数える (.align はアドレス0に置いたとして)
+        n = sum(self.size(inst) for inst in removed if inst.op is not None)
+        names = [inst.tag for inst in removed if inst.tag is not None]
+        if self.verbose:
+            print('libmincaml.S: {} bytes removed ({})'.format(n, ', '.join(names)))
+        if self.stats is not None:
+            self.stats.counters['library bytes removed'] += n
+            self.stats.counters['library tags removed'] += len(names)
+        return kept
+
+    def plan(self, head, body, tail, lib_insts, lib_image, lib_tags):
+        '''
+        エンコードせずに配置を繰り返して、どの命令を長い形にするかを決める。
+        (prologue の (アドレス, Inst) の列, それ以外の列) を返す。read_bytes は最後の位置
+        '''
+        while True:
+            self.reset(self.relaxed)
+            self.tags.update(lib_tags)
+            placed_head = self.layout(head)
+            self.read_bytes = program_start
+            placed = self.layout(body)
+            placed += self.layout(tail)
+            if lib_image is None:
+                placed += self.layout(lib_insts)
+            else:
+                check_overlap(self.read_bytes, self.lib_base)
+                # 同名のタグはライブラリのものが有効
+                self.tags.update(lib_tags)
+            if not self.relax(placed_head) + self.relax(placed):
+                return (placed_head, placed)
+
+    def warn_redefined(self):
+        ''' 同じ名前のタグを二度以上定義していたら知らせる (後の定義が有効) '''
+        if self.redefined:
+            print('警告: 同じ名前のタグが複数あります。後の定義が有効です: {}'.format(
+                ', '.join(sorted(self.redefined))))
+
+    def layout(self, insts):
+        '''
+        エンコードせずに、Op.size (と self.relaxed) だけでアドレスを割り当ててタグを決める。
+        (アドレス, Inst) の列を返す
+        '''
+        l = []
+        relaxable = optable.relaxable
+        long_size = optable.long_size
+        relaxed = self.relaxed
+        addr = self.read_bytes
+        for inst in insts:
+            if inst.tag is not None:
+                self.read_bytes = addr
+                self.define_tag(inst.tag)
+            if self.trace is not None:
+                # _build_parallel ではバッファ上の位置とアドレスが一致する
+                self.trace.append((addr, addr, inst))
+            op = inst.op
+            if op is None:
+                continue
+            l.append((addr, inst))
+            if op.name in relaxable:
+                addr += long_size[op.name] if inst in relaxed else 4
+            elif op.size is None:
+                addr += op.directive.size(inst.args, addr)
+            else:
+                addr += op.size
+        self.read_bytes = addr
+        return l
+
+    def encode_chunk(self, chunk):
+        ''' タグが全部決まった後で、アドレスの連続した命令列をまとめてエンコードする '''
+        code = bytearray()
+        for (addr, inst) in chunk:
+            self.read_bytes = addr
+            code += self.encode(inst)
+        return bytes(code)
+
+    def load_lib(self, lib=None):
+        if lib is None:
+            lib = self.get_lib_data()
+        return load_lib(lib, self.lib_base, self.use_lib_cache)
+
+    def preload(self):
+        ''' どのプログラムでも同じ部分を、先にパース・エンコードしておく '''
+        heap_image()
+        parse_text(self.prologue, '<prologue>')
+        parse_text(self.epilogue, '<epilogue>')
+        if self.lib_base is None:
+            parse_text(self.get_lib_data(), 'libmincaml.S', self.verbose)
+        else:
+            self.load_lib()
+
+    def assemble(self, source, *, lib=None, prologue=True, filename='<source>', jobs=1):
+        '''
+        ソース(文字列)をアセンブルして、イメージを返す。
+        lib はこの呼び出しだけで使う libmincaml.S の中身('' ならライブラリ無し)。
+        jobs が2以上なら、エンコードを jobs 個のプロセスに分ける
+        '''
+        if lib is None:
+            lib = self.get_lib_data()
+        with phase(self.stats, 'parse'):
+            lines = source.splitlines()
+            body = ir.parse(lines, filename, verbose=self.verbose)
+        if self.stats is not None:
+            self.stats.counters['source lines'] += len(lines)
+        if jobs > 1:
+            return self._build_parallel(body, lib, prologue, jobs)
+        return self._build(body, lib, prologue)
+
+    def assemble_file(self, filename, **kwargs):
+        with phase(self.stats, 'read'):
+            with open(filename) as f:
+                source = f.read()
+        return self.assemble(source, filename=filename, **kwargs)
+
+    def prepare(self, body, lib, prologue):
+        '''
+        _build と _build_parallel に共通の前半。ライブラリ・prologue・epilogue を用意し、
+        peephole と使わないライブラリの除去をかけてから plan で配置を決める。
+        ((head, body, tail, lib_insts, lib_image, lib_tags), plan の結果) を返す
+        '''
+        self.reset()
+        lib_image = None
+        lib_tags = {}
+        lib_insts = []
+        if self.lib_base is not None:
+            check_lib_base(self.lib_base)
+            with phase(self.stats, 'prelinked library'):
+                (lib_image, lib_tags) = self.load_lib(lib)
+        else:
+            with phase(self.stats, 'parse'):
+                lib_insts = parse_text(lib, 'libmincaml.S', self.verbose)
+        head = parse_text(self.prologue, '<prologue>') if prologue else []
+        tail = parse_text(self.epilogue, '<epilogue>')
+        if self.optimize:
+            (head, body, tail, lib_insts) = self.peephole(head, body, tail, lib_insts, lib_tags)
+        if self.prune_lib and lib_insts:
+            lib_insts = self.drop_unused(head, body, tail, lib_insts)
+        self.placed = (head, body, tail, lib_insts, lib_image, lib_tags)
+
+        with phase(self.stats, 'layout'):
+            placed = self.plan(head, body, tail, lib_insts, lib_image, lib_tags)
+        self.warn_redefined()
+        return (self.placed, placed)
+
+    def _build(self, body, lib, prologue):
+        (parts, _) = self.prepare(body, lib, prologue)
+        (head, body, tail, lib_insts, lib_image, lib_tags) = parts
+        with phase(self.stats, 'first pass'):
+            image = self.first_pass(head, body, tail, lib_insts, lib_image, lib_tags)
+
+        if self.verbose:
+            (a, n, _) = self.regions[0]
+            print('heap: {} - {}'.format(hex(a), hex(a + n)))
+            print(self.tags)
+        with phase(self.stats, 'fixups'):
+            self.resolve_fixups(image)
+        if self.stats is not None:
+            for insts in (head, body, tail, lib_insts):
+                self.stats.count_insts(insts)
+        if self.verbose or self.stats is not None:
+            self.report_savings(head + body + tail + lib_insts)
+        return bytes(image)
+
+    def first_pass(self, head, body, tail, lib_insts, lib_image, lib_tags):
+        ''' 全体を一度置く。前方参照は仮の値で、fixup を覚えておく '''
+        self.reset(self.relaxed)
+        self.tags.update(lib_tags)
+        image = bytearray()
+
+        # prologue
+        self.place(image, head)
+
+        pad = max(0, (heap.base - self.read_bytes) // 4) * 4
+        self.read_bytes += pad
+        image += bytes(pad)
+
+        h = heap_image()
+        self.regions.append((self.read_bytes, len(h), 'heap'))
+        self.read_bytes += len(h)
+        image += h
+
+        self.read_bytes = program_start
+
+        self.place(image, body)
+        self.place(image, tail)
+        if lib_image is None:
+            self.place(image, lib_insts)
+        else:
+            check_overlap(self.read_bytes, self.lib_base)
+            # 同名のタグはライブラリのものが有効
+            self.tags.update(lib_tags)
+            image += bytes(self.lib_base - self.read_bytes)
+            image += lib_image
+            self.read_bytes = self.lib_base + len(lib_image)
+            self.regions.append((self.lib_base, len(lib_image), 'libmincaml.S (prelinked)'))
+        return image
+
+    def _build_parallel(self, body, lib, prologue, jobs):
+        '''
+        _build と同じものを、先にアドレスを全部割り当ててから
+        命令列をいくつかに切って jobs 個のプロセスでエンコードして作る
+        '''
+        import multiprocessing
+
+        ((_, _, _, _, lib_image, _), (head, insts)) = self.prepare(body, lib, prologue)
+        end = self.read_bytes
+        head_end = 0
+        if head:
+            (addr, inst) = head[-1]
+            head_end = addr + self.size(inst, addr)
+        pad = max(0, (heap.base - head_end) // 4) * 4
+        if lib_image is not None:
+            self.regions.append((self.lib_base, len(lib_image), 'libmincaml.S (prelinked)'))
+
+        self.use_place_holder = False
+        image = bytearray(self.encode_chunk(head))
+        image += bytes(pad)
+        h = heap_image()
+        self.regions.append((len(image), len(h), 'heap'))
+        image += h
+
+        # プロセス間のやりとりが割に合うように、一つの塊はある程度大きくする
+        n = max(1024, -(-len(insts) // (jobs * 4)))
+        # 緩和した分岐も一緒に送る (一回の pickle の中なら同じ Inst は同じものになる)
+        chunks = [(c, [inst for (addr, inst) in c if inst in self.relaxed])
+                  for c in (insts[i:i + n] for i in range(0, len(insts), n))]
+        with phase(self.stats, 'encode'):
+            with multiprocessing.Pool(jobs, _init_encoder, (self.tags,)) as pool:
+                for code in pool.imap(_encode_chunk, chunks):
+                    image += code
+
+        if lib_image is not None:
+            image += bytes(self.lib_base - end)
+            image += lib_image
+        if self.stats is not None:
+            self.stats.count_insts(inst for (addr, inst) in head + insts)
+        if self.verbose or self.stats is not None:
+            self.report_savings(inst for (addr, inst) in head + insts)
+        return bytes(image)
+
+    def symbols(self):
+        '''
+        直前にアセンブルしたもののタグの symbols.SymbolTable。
+        組み込みのタグ、ヒープの変数、prologue・プログラム・epilogue・ライブラリのタグが入る
+        '''
+        (head, body, tail, lib_insts, lib_image, lib_tags) = self.placed
+        t = symbols.SymbolTable()
+        for (name, value) in builtin_tags.items():
+            t.add(name, value * 4, 'builtin', 0)
+        for (name, addr, size) in heap.symbols():
+            t.add(name, addr, 'heap', size)
+
+        # plan と同じ順に、最後に決まった self.relaxed で置き直す
+        source = body[0].source if body else '<source>'
+        addr = 0
+        for (section, start, insts) in [('<prologue>', 0, head), (source, program_start, body),
+                                        ('<epilogue>', None, tail),
+                                        ('libmincaml.S', None, lib_insts)]:
+            if start is not None:
+                addr = start
+            for inst in insts:
+                if inst.tag is not None:
+                    t.add(inst.tag, addr, section)
+                if inst.op is not None:
+                    addr += self.size(inst, addr)
+            t.end(section, addr)
+        if lib_image is not None:
+            for (name, value) in lib_tags.items():
+                t.add(name, value * 4, 'libmincaml.S')
+            t.end('libmincaml.S', self.lib_base + len(lib_image))
+        return t
+
+    def write_map(self, path):
+        self.symbols().write_map(path)
+
+    def symbol(self, name):
+        if name in self.tags:
+            return hex(self.tags[name] * 4)
+        if heap.has(name):
+            return hex(heap.get(name))
+        return '?'
+
+    def listing(self, image):
+        '''
+        直前にアセンブルしたものの一覧。一行に一命令で、
+        アドレス、機械語(語の値)、ソースの位置、行、参照したタグの値(バイトアドレス)
+        '''
+        out = []
+        regions = sorted(self.regions)
+        for (offset, addr, inst) in self.trace or []:
+            while regions and regions[0][0] <= addr:
+                (a, n, name) = regions.pop(0)
+                out.append('{:08x}  <{}, {} bytes>'.format(a, name, n))
+            where = '{}:{}'.format(inst.source, inst.lineno)
+            if inst.op is None:
+                out.append('{:08x}  {:17}  {:20}  {}:'.format(addr, '', where, inst.tag))
+                continue
+            code = image[offset:offset + self.size(inst, addr)]
+            # 大きなデータは先頭の二語だけ
+            words = ' '.join('{:08x}'.format(int.from_bytes(code[i:i + 4], 'little'))
+                             for i in range(0, min(len(code), 8), 4))
+            if len(code) > 8:
+                words += ' ... ({} bytes)'.format(len(code))
+            line = '{:08x}  {:17}  {:20}  {}'.format(addr, words, where, inst)
+            if inst.refs is not None:
+                line += '  ; ' + ', '.join('{}={}'.format(inst.args[i], self.symbol(inst.args[i]))
+                                          for i in inst.refs)
+            out.append(line)
+        for (a, n, name) in regions:
+            out.append('{:08x}  <{}, {} bytes>'.format(a, name, n))
+        return '\n'.join(out) + '\n'
+
+    def write_listing(self, path, image):
+        # まとめて一回で書く
+        with open(path, 'w') as f:
+            f.write(self.listing(image))
+
+
+# _build_parallel のワーカープロセスが使うアセンブラ
+_encoder = None
+
+
+def _init_encoder(tags):
+    global _encoder
+    _encoder = Assembler(lib='')
+    _encoder.tags = tags
+    _encoder.use_place_holder = False
+
+
+def _encode_chunk(arg):
+    import contextlib
+    import io
+    (chunk, relaxed) = arg
+    log = io.StringIO()
+    try:
+        with contextlib.redirect_stdout(log):
+            _encoder.relaxed = set(relaxed)
+            return _encoder.encode_chunk(chunk)
+    except Exception as e:
+        l = log.getvalue().splitlines()[-5:]
+        l.append('{}: {}'.format(type(e).__name__, e))
+        raise Exception('\n'.join(l))
+
+
+# 複数のプログラムを続けてアセンブルするときに使い回すもの
+_parsed = {}
+_prelinked = {}
+
+
+def heap_image():
+    # heap.py の表から作ったもの (表が同じなら同じ bytes)
+    return heap.image()
+
+
+def parse_text(text, source, verbose=False):
+    # 置く場所によらないので、prologueやライブラリのパース結果は使い回せる
+    key = (source, text)
+    insts = _parsed.get(key)
+    if insts is None:
+        insts = ir.parse(text.split('\n'), source, verbose=verbose)
+        _parsed[key] = insts
+    return insts
+
+
+def prelink(lib, base):
+    ''' ライブラリだけを base に置いてアセンブルし、(image, tags) を返す '''
+    a = Assembler(lib=lib)
+    insts = ir.parse(lib.split('\n'), 'libmincaml.S')
+    while True:
+        a.reset(a.relaxed)
+        a.read_bytes = base
+        image = bytearray()
+        a.place(image, insts)
+        if not a.relax((addr, inst) for (_, addr, inst, _) in a.fixups):
+            break
+
+    # ヒープ以外で、ライブラリの外にあるタグは解決できない
+    for (offset, addr, inst, pending) in a.fixups:
+        if not pending:
+            continue
+        for i in inst.refs:
+            name = inst.args[i]
+            if name not in a.tags and not heap.has(name):
+                ir.error_line(inst.source, inst.lineno, inst)
+                print('ライブラリの外のタグ {} を参照しているので、固定アドレスに置けません'.format(name))
+                raise Exception('Prelink Error')
+
+    a.resolve_fixups(image)
+    lib_tags = {}
+    for (name, addr) in a.tags.items():
+        if name not in builtin_tags:
+            lib_tags[name] = addr
+    return (bytes(image), lib_tags)
+
+
+def load_lib(lib, base, use_cache=True):
+    r = _prelinked.get((lib, base))
+    if r is not None:
+        return r
+
+    key = library.cache_key(lib, base)
+    r = None
+    if use_cache:
+        r = library.load(key)
+    if r is None:
+        r = prelink(lib, base)
+        if use_cache:
+            library.store(key, *r)
+    _prelinked[(lib, base)] = r
+    return r
+
+
+def check_lib_base(base):
+    if base % 4 != 0 or base < program_start:
+        print('--lib-base は {} 以上の4の倍数でなければなりません'.format(hex(program_start)))
+        raise Exception('Invalid Base')
+
+
+def check_overlap(end, base):
+    if end > base:
+        print('プログラムが {} バイトあり、ライブラリの位置 {} と重なっています'.format(
+            end, hex(base)))
+        raise Exception('Overlap Error')
+
+
+class TestAsm(unittest.TestCase):
+    def setUp(self):
+        self.a = Assembler(lib='')
+
+    def test_arity(self):
+        with self.assertRaises(Exception):
+            self.a.asm('add', ['a0', 'a1'])
+        with self.assertRaises(Exception):
+            self.a.asm('hoge', [])
+
+    def test_pseudo(self):
+        asm = self.a.asm
+        self.assertEqual(asm('nop', []), asm('addi', ['x0', 'x0', '0']))
+        self.assertEqual(len(asm('li', ['a0', '100000'])), 8)
+
+    def test_hook(self):
+        asm = self.a.asm
+        self.assertEqual(asm('jal', ['5']), asm('jal', ['x1', '5']))
+        self.assertEqual(asm('jalr', ['a0']), asm('jalr', ['x0', 'a0', '0']))
+        self.assertEqual(asm('add', ['a0', 'a1', '3']),
+                         asm('addi', ['a0', 'a1', '3']))
+
+
+class TestFixup(unittest.TestCase):
+    def setUp(self):
+        self.a = Assembler(lib='')
+
+    def test_forward_reference(self):
+        a = self.a
+        image = bytearray()
+        a.place(image, ir.parse(['back:', 'j fwd', 'j back', 'fwd: nop']))
+        self.assertEqual(len(a.fixups), 2)
+        self.assertEqual(image[0:4], bytes(a.asm('jal', ['x0', '0'])))
+        a.resolve_fixups(image)
+        self.assertEqual(image[0:4], bytes(a.asm('jal', ['x0', '2'])))
+        self.assertEqual(image[4:8], bytes(a.asm('jal', ['x0', '-1'])))
+
+    def test_redefinition(self):
+        a = self.a
+        image = bytearray()
+        a.place(image, ir.parse(['x: nop', 'j x', 'x: nop']))
+        a.resolve_fixups(image)
+        self.assertEqual(image[4:8], bytes(a.asm('jal', ['x0', '1'])))
+
+
+class TestRelax(unittest.TestCase):
+    def setUp(self):
+        self.a = Assembler(lib='')
+
+    def build(self, lines):
+        a = self.a
+        a.reset()
+        insts = ir.parse(lines)
+        while True:
+            a.reset(a.relaxed)
+            image = bytearray()
+            a.place(image, insts)
+            if not a.relax((addr, inst) for (_, addr, inst, _) in a.fixups):
+                break
+        a.resolve_fixups(image)
+        return image
+
+    def test_near(self):
+        image = self.build(['beq a0, a1, x'] + ['nop'] * 2046 + ['x: nop'])
+        self.assertEqual(len(image), 2048 * 4)
+        self.assertEqual(image[:4], self.a.asm('beq', ['a0', 'a1', '2047']))
+        image = self.build(['x: nop'] + ['nop'] * 2047 + ['bgt a0, a1, x'])
+        self.assertEqual(image[-4:], self.a.asm('blt', ['a1', 'a0', '-2048']))
+
+    def test_far(self):
+        asm = self.a.asm
+        image = self.build(['beq a0, a1, x'] + ['nop'] * 3000 + ['x: nop'])
+        self.assertEqual(len(image), 3003 * 4)
+        self.assertEqual(image[:8], asm('bne', ['a0', 'a1', '2']) + asm('jal', ['x0', '3001']))
+
+        image = self.build(['x: nop'] + ['nop'] * 3000 + ['ble a0, a1, x', 'bnei a0, x20, x'])
+        # bnei の rs2 は即値なので反対にせず、jal を二つ使う
+        self.assertEqual(image[-20:], asm('blt', ['a1', 'a0', '2']) + asm('jal', ['x0', '-3002'])
+                         + asm('bnei', ['a0', 'x20', '2']) + asm('jal', ['x0', '2'])
+                         + asm('jal', ['x0', '-3005']))
+        self.assertEqual(self.a.savings([i for i in self.a.relaxed]), (0, 2, 3))
+
+        # 後ろのタグは3命令分ずれる
+        image = self.build(['bnei a0, x20, x'] + ['nop'] * 3000 + ['x: beq a0, a1, x'])
+        self.assertEqual(len(image), 3004 * 4)
+        self.assertEqual(image[:12], asm('bnei', ['a0', 'x20', '2']) + asm('jal', ['x0', '2'])
+                         + asm('jal', ['x0', '3001']))
+        self.assertEqual(image[-4:], asm('beq', ['a0', 'a1', '0']))
+
+    def test_fixed_point(self):
+        # 内側の分岐を緩和すると、外側の分岐も届かなくなる
+        image = self.build(['beq a0, a1, x', 'beq a0, a1, y'] + ['nop'] * 2045
+                           + ['x: nop'] + ['nop'] * 2000 + ['y: nop'])
+        self.assertEqual(len(self.a.relaxed), 2)
+        self.assertEqual(image[:8], self.a.asm('bne', ['a0', 'a1', '2'])
+                         + self.a.asm('jal', ['x0', '2048']))
+
+    def test_short(self):
+        asm = self.a.asm
+        image = self.build(['call f', 'tail f', 'li a0, 5', 'li a0, 8192', 'li a0, 5000',
+                            'li a0, f', 'f: nop'])
+        self.assertEqual(image, asm('jal', ['ra', '7']) + asm('jal', ['x0', '6'])
+                         + asm('addi', ['a0', 'x0', '5']) + asm('lui', ['a0', '2'])
+                         + asm('li', ['a0', '5000']) + asm('addi', ['a0', 'x0', '7'])
+                         + asm('nop', []))
+        self.assertEqual(self.a.savings(ir.parse(['call f', 'tail f', 'li a0, 5', 'li a0, f'])),
+                         (4, 0, 0))
+
+        # 値が12bitに収まらないタグは二命令
+        image = self.build(['li a0, f'] + ['nop'] * 2047 + ['f: nop'])
+        self.assertEqual(image[:8], asm('li', ['a0', '2049']))
+
+    def test_assemble(self):
+        src = ('_min_caml_start:\n\tbeq a0, a1, end\n' + '\tnop\n' * 3000
+               + 'end:\n\tbne a0, a1, _min_caml_start\n\tret\n')
+        image = self.a.assemble(src)
+        self.assertEqual(len([i for i in self.a.relaxed if i.op.name in optable.branches]), 2)
+        self.assertEqual(self.a.assemble(src, jobs=2), image)
+
+
+class TestAssembler(unittest.TestCase):
+    lib = 'min_caml_hoge:\n\tli a0, min_caml_hoge\n\tret\n'
+
+    def source(self, n):
+        return ('_min_caml_start:\n\tcall f\n\tj end\nf:\n\tli a0, end\n\tret\n'
+                'end:\n\tcall min_caml_hoge\n' + '\tnop\n' * n)
+
+    def test_assemble(self):
+        a = Assembler(lib=self.lib)
+        image = a.assemble(self.source(0))
+        self.assertEqual(image[:4], a.asm('li', ['sp', '__builtin_stack_init'])[:4])
+        self.assertEqual(a.assemble('_min_caml_start:\n\tnop\n', lib='', prologue=False)[:4],
+                         bytes(4))
+        # 呼び出しごとに状態は作り直される
+        self.assertEqual(a.assemble(self.source(0)), image)
+
+    def test_parallel(self):
+        a = Assembler(lib=self.lib)
+        src = self.source(3000)
+        self.assertEqual(a.assemble(src, jobs=2), a.assemble(src))
+
+    def test_symbols(self):
+        import contextlib
+        import io
+        a = Assembler(lib=self.lib)
+        src = self.source(3000) + 'f:\n\tret\n'
+        log = io.StringIO()
+        with contextlib.redirect_stdout(log):
+            a.assemble(src, filename='a.s')
+        self.assertIn('f', log.getvalue())
+        t = a.symbols()
+        for (name, value) in a.tags.items():
+            self.assertEqual(t[name].addr, value * 4)
+        self.assertEqual([n for (n, _, _) in t.collisions], ['f'])
+        self.assertEqual((t['end'].section, t['min_caml_hoge'].section), ('a.s', 'libmincaml.S'))
+        self.assertEqual(t.lookup(t['end'].addr + 4 * 10).name, 'end')
+        self.assertEqual(t.lookup(heap.get('min_caml_objects') + 8).name, 'min_caml_objects')
+        self.assertEqual(t['min_caml_hoge'].size, 4 * 2 + 4)
+
+    def test_data(self):
+        a = Assembler(lib='')
+        src = ('_min_caml_start:\n\tli a0, table\n\tj end\n\t.byte 1\n\t.align 4\n'
+               'table:\t.word 0x3f800000, -1\n\t.space 0x100000\nend:\t.float 1.0\n')
+        image = a.assemble(src, prologue=False)
+        # li (短い形) と j の後ろ
+        start = program_start + 4 * 2
+        table = a.tags['table'] * 4
+        self.assertEqual((table % 16, table), (0, start + 4 + 4))
+        self.assertEqual(image[start:start + 4], b'\x01\0\0\0')
+        self.assertEqual(image[table:table + 8], bytes.fromhex('0000803fffffffff'))
+        end = a.tags['end'] * 4
+        self.assertEqual(end, table + 8 + 0x100000)
+        self.assertEqual(image[end:end + 4], bytes.fromhex('0000803f'))
+        self.assertEqual(a.assemble(src, prologue=False, jobs=2), image)
+
+    def test_threads(self):
+        import threading
+        srcs = [self.source(i * 100) for i in range(4)]
+        expected = [Assembler(lib=self.lib).assemble(s) for s in srcs]
+        results = {}
+
+        def run(i):
+            a = Assembler(lib=self.lib)
+            results[i] = [a.assemble(s) for s in srcs[i:] + srcs[:i]]
+
+        threads = [threading.Thread(target=run, args=(i,)) for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        for i in range(4):
+            self.assertEqual(results[i], expected[i:] + expected[:i])
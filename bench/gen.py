@@ -0,0 +1,178 @@
+'''
+ベンチマーク用の大きなプログラムを作る
+
+  python -m bench.gen -n 100000 -o big.s [--seed S]
+
+min-caml の出力に似せた関数を並べる。関数の中身は、スタックへの lw/sw、整数演算、
+即値のロード (li)、ローカルなラベルへの分岐 (疑似命令を含む)、他の関数の呼び出し、
+浮動小数点命令、疑似命令 (mv, subi, nop, fmv.s など) を適当な割合で混ぜたもの。
+分岐とジャンプは関数の中だけで、関数をまたぐのは call だけなので、大きくしても
+即値の範囲を超えない。ライブラリの関数は呼ばないので --no-lib でアセンブルできる。
+'''
+
+import argparse
+import random
+import unittest
+
+
+iregs = ['a0', 'a1', 'a2', 'a3', 'a4', 'a5', 's1', 's2', 's3', 't0', 't1', 't2']
+fregs = ['fa0', 'fa1', 'fa2', 'fa3', 'fs0', 'fs1', 'ft0', 'ft1']
+alu = ['add', 'sub', 'xor', 'or', 'and', 'sll', 'srl', 'sra', 'slt', 'sltu']
+branches = ['beq', 'bne', 'blt', 'bge', 'bltu', 'bgeu', 'bgt', 'ble', 'bgtu', 'bleu']
+fpu = ['fadd.s', 'fsub.s', 'fmul.s', 'fdiv.s']
+
+# 文の種類と重み
+weights = [
+    ('load', 18),
+    ('store', 14),
+    ('alu', 16),
+    ('imm', 14),
+    ('li', 6),
+    ('branch', 8),
+    ('call', 5),
+    ('fp', 12),
+    ('pseudo', 7),
+]
+
+
+class Generator:
+    def __init__(self, seed=0):
+        self.rng = random.Random(seed)
+        self.kinds = [k for (k, _) in weights]
+        self.cum = []
+        c = 0
+        for (_, w) in weights:
+            c += w
+            self.cum.append(c)
+        self.labels = 0
+        # 今作っている関数の番号と、呼んだ関数の番号の最大値
+        self.cur = 0
+        self.maxcall = 0
+
+    def label(self, prefix):
+        self.labels += 1
+        return '{}.{}'.format(prefix, self.labels)
+
+    def stmt(self, out, depth):
+        r = self.rng
+        kind = r.choices(self.kinds, cum_weights=self.cum)[0]
+        a = r.choice(iregs)
+        b = r.choice(iregs)
+        c = r.choice(iregs)
+        if kind == 'load':
+            out.append('\tlw\t{}, {}(sp)'.format(a, r.randrange(0, 64) * 4))
+        elif kind == 'store':
+            out.append('\tsw\t{}, {}(sp)'.format(a, r.randrange(0, 64) * 4))
+        elif kind == 'alu':
+            out.append('\t{}\t{}, {}, {}'.format(r.choice(alu), a, b, c))
+        elif kind == 'imm':
+            op = r.choice(['add', 'add', 'sub', 'slti', 'andi', 'xori', 'slli'])
+            if op == 'slli':
+                imm = r.randrange(0, 32)
+            else:
+                imm = r.randrange(-2048, 2048) if op != 'sub' else r.randrange(0, 2048)
+            out.append('\t{}\t{}, {}, {}'.format(op, a, b, imm))
+        elif kind == 'li':
+            out.append('\tli\t{}, {}'.format(a, r.randrange(-2**31, 2**31)))
+        elif kind == 'branch' and depth < 2:
+            # if-then-else の形
+            els = self.label('ble_else')
+            end = self.label('ble_cont')
+            out.append('\t{}\t{}, {}, {}'.format(r.choice(branches), a, b, els))
+            for _ in range(r.randrange(1, 6)):
+                self.stmt(out, depth + 1)
+            out.append('\tj\t{}'.format(end))
+            out.append('{}:'.format(els))
+            for _ in range(r.randrange(1, 6)):
+                self.stmt(out, depth + 1)
+            out.append('{}:'.format(end))
+        elif kind == 'call':
+            out.append('\tsw\tra, 4(sp)')
+            # 前にある関数か、少し後ろの関数を呼ぶ
+            t = r.randrange(self.cur + 8)
+            self.maxcall = max(self.maxcall, t)
+            out.append('\tcall\tfun.{}'.format(t))
+            out.append('\tlw\tra, 4(sp)')
+        elif kind == 'fp':
+            x = r.randrange(4)
+            f = r.choice(fregs)
+            if x == 0:
+                out.append('\tflw\t{}, {}(sp)'.format(f, r.randrange(0, 64) * 4))
+            elif x == 1:
+                out.append('\tfsw\t{}, {}(sp)'.format(f, r.randrange(0, 64) * 4))
+            elif x == 2:
+                out.append('\t{}\t{}, {}, {}'.format(r.choice(fpu), f, r.choice(fregs),
+                                                     r.choice(fregs)))
+            else:
+                out.append('\tfcvt.s.w\t{}, {}'.format(f, a))
+        else:
+            x = r.randrange(5)
+            if x == 0:
+                out.append('\tmv\t{}, {}'.format(a, b))
+            elif x == 1:
+                out.append('\tsubi\t{}, {}, {}'.format(a, b, r.randrange(0, 2048)))
+            elif x == 2:
+                out.append('\tfmv.s\t{}, {}'.format(r.choice(fregs), r.choice(fregs)))
+            elif x == 3:
+                out.append('\tfneg.s\t{}, {}'.format(r.choice(fregs), r.choice(fregs)))
+            else:
+                out.append('\tnop')
+
+    def function(self, out, name):
+        out.append('{}:'.format(name))
+        out.append('\tadd\tsp, sp, -256')
+        out.append('\tsw\tra, 252(sp)')
+        n = self.rng.randrange(10, 60)
+        for _ in range(n):
+            self.stmt(out, 0)
+        out.append('\tlw\tra, 252(sp)')
+        out.append('\tadd\tsp, sp, 256')
+        out.append('\tret')
+
+    def generate(self, lines):
+        out = ['\t.text', '\t.globl _min_caml_start', '\t.align 2']
+        while len(out) < lines - 4 or self.cur == 0:
+            self.function(out, 'fun.{}'.format(self.cur))
+            self.cur += 1
+        # 呼んだのにまだ無い関数
+        while self.cur <= self.maxcall:
+            out.append('fun.{}:'.format(self.cur))
+            out.append('\tret')
+            self.cur += 1
+        out.append('_min_caml_start:')
+        out.append('\tli\ta0, 10')
+        out.append('\tcall\tfun.0')
+        out.append('\tret')
+        return '\n'.join(out) + '\n'
+
+
+def generate(lines, seed=0):
+    return Generator(seed).generate(lines)
+
+
+class TestGen(unittest.TestCase):
+    def test_generate(self):
+        from assembler import Assembler
+        src = generate(3000, seed=1)
+        self.assertEqual(src, generate(3000, seed=1))
+        n = src.count('\n')
+        self.assertTrue(2500 < n < 3500, n)
+        # そのままアセンブルできる
+        image = Assembler(lib='').assemble(src)
+        self.assertGreater(len(image), 3000)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', type=int, default=100000, help='approximate number of lines')
+    parser.add_argument('-o', '--output', default='big.s')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    src = generate(args.n, args.seed)
+    with open(args.output, 'w') as f:
+        f.write(src)
+    print('{}: {} lines'.format(args.output, src.count('\n')))
+
+
+if __name__ == '__main__':
+    main()
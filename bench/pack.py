@@ -0,0 +1,105 @@
+'''
+命令エンコードのマイクロベンチマーク
+
+  python -m bench.pack [-n N]
+
+以前の utils.pack (フィールドごとと命令語全体をbit反転する実装) と、
+optable の base に各フィールドをORする今の実装とで、一秒あたりのエンコード命令数を比べる。
+'''
+
+import argparse
+import struct
+import time
+
+import optable
+import utils
+
+
+def legacy_pack(tuples):
+    # 以前の utils.pack そのまま
+    reordered = []
+    for (x, l) in tuples:
+        val = 0
+        for _ in range(l):
+            tmp = x & 1
+            x >>= 1
+            val <<= 1
+            val |= tmp
+        reordered.append((val, l))
+    tuples = reordered
+    cnt = 0
+    val = 0
+    for (code, length) in tuples:
+        val <<= length
+        val += code
+        cnt += length
+
+    ret = 0
+    for _ in range(32):
+        tmp = val & 1
+        val >>= 1
+        ret <<= 1
+        ret |= tmp
+    return struct.pack('<L', ret)
+
+
+# add a0, a1, a2 / addi a0, a1, -5 / sw a0, -8(sp) のフィールド列
+fields = [
+    [(0b0110011, 7), (10, 5), (0, 3), (11, 5), (12, 5), (0, 7)],
+    [(0b0010011, 7), (10, 5), (0, 3), (11, 5), (4091, 12)],
+    [(0b0100011, 7), (24, 5), (0b010, 3), (2, 5), (10, 5), (127, 7)],
+]
+
+ops = [
+    ('add', ('a0', 'a1', 'a2')),
+    ('addi', ('a0', 'a1', '-5')),
+    ('sw', ('a0', 'sp', '-8')),
+    ('beq', ('a0', 'a1', '-3')),
+    ('jal', ('ra', '-20')),
+    ('fadd.s', ('fa0', 'fa1', 'fa2')),
+]
+
+
+def rate(f, n):
+    t = time.perf_counter()
+    cnt = f(n)
+    return cnt / (time.perf_counter() - t)
+
+
+def run_legacy_pack(n):
+    for _ in range(n):
+        for t in fields:
+            legacy_pack(t)
+    return n * len(fields)
+
+
+def run_pack(n):
+    for _ in range(n):
+        for t in fields:
+            utils.pack(t)
+    return n * len(fields)
+
+
+def run_encoder(n):
+    l = [(optable.table[name], args) for (name, args) in ops]
+    for _ in range(n):
+        for (op, args) in l:
+            op.encoder(op, *args)
+    return n * len(l)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', type=int, default=20000, help='iterations')
+    args = parser.parse_args()
+
+    for t in fields:
+        assert legacy_pack(t) == utils.pack(t)
+
+    print('legacy utils.pack: {:>12,.0f} inst/s'.format(rate(run_legacy_pack, args.n)))
+    print('utils.pack:        {:>12,.0f} inst/s'.format(rate(run_pack, args.n)))
+    print('optable encoder:   {:>12,.0f} inst/s'.format(rate(run_encoder, args.n)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,147 @@
+'''
+段階ごとのベンチマーク
+
+  python -m bench.run [-n LINES] [-r REPEAT] [-o results.json] [--compare OLD.json]
+
+bench.gen で作ったプログラムについて、次のそれぞれの速さを測る(REPEAT 回のうち最速)。
+
+- parse: ir.parse (字句解析とIRの構築)
+- encode: パース済みのIRをアセンブルする (一周目 + fixup)
+- pack: utils.pack と optable のエンコーダ単体 (bench.pack と同じもの)
+- emit: 出来上がったイメージを各 --format の形式にする
+- cli: python main.py をプロセスごと起動して、ファイルを書き出すまで
+
+結果は JSON で書き出す。--compare で前の結果と比べ、10%以上遅くなったものに印を付ける。
+リビジョン (git) とPythonのバージョンも一緒に記録する。
+'''
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+import formats
+import ir
+from assembler import Assembler
+from bench import gen
+from bench import pack
+
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def best(f, repeat):
+    t = None
+    for _ in range(repeat):
+        s = time.perf_counter()
+        f()
+        d = time.perf_counter() - s
+        if t is None or d < t:
+            t = d
+    return t
+
+
+def revision():
+    try:
+        p = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=repo_dir,
+                           capture_output=True, text=True)
+        return p.stdout.strip() or None
+    except OSError:
+        return None
+
+
+def run(lines, repeat):
+    src = gen.generate(lines)
+    l = src.splitlines()
+    results = {}
+
+    def add(name, seconds, count, unit):
+        results[name] = {'seconds': seconds, 'rate': count / seconds, 'unit': unit}
+
+    add('parse', best(lambda: ir.parse(l, 'bench.s'), repeat), len(l), 'lines/s')
+
+    body = ir.parse(l, 'bench.s')
+    a = Assembler(lib='')
+    n = sum(1 for inst in body if inst.op is not None)
+    add('encode', best(lambda: a._build(body, '', True), repeat), n, 'inst/s')
+
+    k = 20000
+    add('pack (utils.pack)', best(lambda: pack.run_pack(k), repeat),
+        k * len(pack.fields), 'inst/s')
+    add('pack (optable encoder)', best(lambda: pack.run_encoder(k), repeat),
+        k * len(pack.ops), 'inst/s')
+
+    image = a.assemble(src, lib='')
+    for name in sorted(formats.table):
+        f = formats.table[name]
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'a.' + f.ext)
+            add('emit ' + name, best(lambda: f.write(path, image), repeat),
+                len(image) / 2**20, 'MB/s')
+
+    with tempfile.TemporaryDirectory() as d:
+        path = os.path.join(d, 'bench.s')
+        with open(path, 'w') as f:
+            f.write(src)
+        cmd = [sys.executable, os.path.join(repo_dir, 'main.py'), path, '--no-lib',
+               '--output', os.path.join(d, 'a.out')]
+        add('cli', best(lambda: subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL),
+                        repeat), len(l), 'lines/s')
+
+    return {
+        'revision': revision(),
+        'python': platform.python_version(),
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'lines': len(l),
+        'image': len(image),
+        'results': results,
+    }
+
+
+def show(r, old=None, threshold=0.1):
+    print('revision {} / python {} / {} lines / {} bytes'.format(
+        r['revision'], r['python'], r['lines'], r['image']))
+    if old is not None:
+        print('compared with revision {} ({} lines)'.format(old['revision'], old['lines']))
+    regressions = 0
+    for (name, v) in r['results'].items():
+        line = '{:24} {:>14,.1f} {:8} {:>10.2f} ms'.format(
+            name, v['rate'], v['unit'], v['seconds'] * 1000)
+        if old is not None and name in old['results']:
+            ratio = v['rate'] / old['results'][name]['rate']
+            line += '  {:>6.2f}x'.format(ratio)
+            if ratio < 1 - threshold:
+                line += '  遅くなった'
+                regressions += 1
+        print(line)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', type=int, default=100000, help='lines of the generated program')
+    parser.add_argument('-r', '--repeat', type=int, default=3)
+    parser.add_argument('-o', '--output', help='write results as JSON')
+    parser.add_argument('--compare', metavar='OLD', help='results of an earlier run')
+    args = parser.parse_args()
+
+    r = run(args.n, args.repeat)
+    old = None
+    if args.compare:
+        with open(args.compare) as f:
+            old = json.load(f)
+    regressions = show(r, old)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(r, f, indent=2)
+            f.write('\n')
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+'''
+ # --serve のクライアント
+
+ `python main.py --serve` で立ち上げたサーバーにソースを送り、返ってきたイメージを書き出す。
+ 引数は main.py と同じように使える。
+
+ ```
+ python client.py assets/fib.s --output fib.out
+ ```
+
+ 起動を速くするため、アセンブラのモジュールは出力形式の表 (formats) の他は import しない。
+
+ ## プロトコル
+
+ 要求も応答も、JSON 一行のヘッダの後に length バイトの本体が続く。一つの接続で何回でも送れる。
+
+ - 要求: {"filename", "prologue", "format", "length"} + ソース (UTF-8)
+ - 応答: {"error", "tags", "length"} + 出力ファイルの中身。失敗したときは error にログが入る
+ - ヘッダが JSON のオブジェクトでないか length が0以上の整数でなければ、本体は読まずに
+   error だけの応答 (length は0) を返し、次の行を要求として待つ
+'''
+
+import argparse
+import json
+import os
+import socket
+import sys
+
+import formats
+
+
+def socket_path():
+    return os.environ.get(
+        'ASM_SOCKET', os.path.join('/tmp', 'cpu3-asm-{}.sock'.format(os.getuid())))
+
+
+def send(f, header, body):
+    header = dict(header, length=len(body))
+    f.write(json.dumps(header).encode('utf-8') + b'\n')
+    f.write(body)
+    f.flush()
+
+
+def receive(f):
+    ''' (ヘッダ, 本体) を返す。相手が閉じていれば None '''
+    line = f.readline()
+    if not line:
+        return None
+    header = json.loads(line)
+    body = f.read(header['length'])
+    if len(body) != header['length']:
+        raise Exception('Connection Closed')
+    return (header, body)
+
+
+def request(path, source, filename='<source>', prologue=True, fmt='raw'):
+    ''' (応答のヘッダ, 出力) を返す '''
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.connect(path)
+        f = s.makefile('rwb')
+        send(f, {'filename': filename, 'prologue': prologue, 'format': fmt},
+             source.encode('utf-8'))
+        r = receive(f)
+    if r is None:
+        raise Exception('Connection Closed')
+    return r
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('filename', help='source file')
+    parser.add_argument('-c', '--coe', help='dump coe (same as --format coe)',
+            action='store_true')
+    parser.add_argument('--format', help='output format', default='raw',
+            choices=sorted(formats.table))
+    parser.add_argument('--output', help='output file')
+    parser.add_argument('--no-prologue',
+            help='assemble without prologue',
+            action='store_true')
+    parser.add_argument('--socket', help='server socket', default=socket_path())
+    args = parser.parse_args()
+
+    fmt = 'coe' if args.coe else args.format
+    output = args.output
+    if output is None:
+        output = 'a.' + formats.lookup(fmt).ext
+
+    with open(args.filename) as f:
+        source = f.read()
+    (header, body) = request(args.socket, source, args.filename,
+                             not args.no_prologue, fmt)
+    if header['error'] is not None:
+        print(header['error'])
+        sys.exit(1)
+    with open(output, 'wb') as f:
+        f.write(body)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,271 @@
+'''
+ # データの指示
+
+ `.word` などのデータを置く指示。optable に形式 D の Op として登録する。
+
+ | 指示 | 引数 | 置くもの |
+ |---|---|---|
+ | .word | 値, ... | 32bit の値 |
+ | .half | 値, ... | 16bit の値 |
+ | .byte | 値, ... | 8bit の値 |
+ | .float | 数, ... | 単精度浮動小数点数 (IEEE 754) |
+ | .space, .zero | バイト数[, 値] | 値 (既定は0) のバイトを並べる |
+ | .fill | 回数[, 大きさ[, 値]] | 大きさ (1, 2, 4 バイト。既定は1) の値 (既定は0) を並べる |
+ | .align | n | アドレスが 2^n バイトの倍数になるまで0を置く (n は 0 から 21) |
+
+ 値は10進数か 0x で始まる16進数で、負でもよい。収まらない上位のビットは捨てる。
+ 命令は語単位でしか置けないので、どの指示も一行で置くものを4バイトの倍数になるまで0で埋める
+ (`.byte 1, 2` は4バイト、`.half 1` も4バイト)。
+
+ 大きさは引数 (.align はアドレスも) だけで決まるので、エンコードせずに配置できる。
+ 置くものは一行分を bytes 一つとしてまとめて作る (`.space 1000000` も一回の確保で済む)。
+'''
+
+import abc
+import string
+import struct
+import unittest
+
+
+def number(s):
+    ''' 10進数か 0x で始まる16進数 '''
+    t = s[1:] if s[:1] == '-' else s
+    if t[:2] in ('0x', '0X') and len(t) > 2 and all(c in string.hexdigits for c in t[2:]):
+        v = int(t[2:], 16)
+    elif t.isascii() and t.isdigit():
+        v = int(t)
+    else:
+        print('{} は数ではありません'.format(s))
+        raise Exception('Data Error')
+    return -v if s[:1] == '-' else v
+
+
+def words(n):
+    ''' n バイトを語の単位に切り上げたもの '''
+    return -(-n // 4) * 4
+
+
+def pad(b):
+    return b + bytes(words(len(b)) - len(b))
+
+
+class Directive(abc.ABC):
+    # 引数の数の範囲
+    arity = (0, None)
+
+    def check(self, name, args):
+        ''' パースしたときに一度だけ呼ぶ。書式がおかしければ例外 '''
+        (lo, hi) = self.arity
+        if len(args) < lo or (hi is not None and len(args) > hi):
+            print('{} の引数の数が正しくありません: {}'.format(name, ', '.join(args)))
+            raise Exception('Syntax Error')
+        self.validate(args)
+
+    @abc.abstractmethod
+    def validate(self, args):
+        ''' 引数を読むだけで、置くものは作らない。おかしければ例外 '''
+
+    @abc.abstractmethod
+    def size(self, args, addr):
+        ''' addr に置いたときのバイト数 '''
+
+    @abc.abstractmethod
+    def emit(self, args, addr):
+        ''' addr に置く一行分の bytes '''
+
+
+class Values(Directive):
+    ''' .word, .half, .byte '''
+
+    def __init__(self, width):
+        self.width = width
+        self.mask = (1 << (width * 8)) - 1
+        self.format = {1: 'B', 2: 'H', 4: 'I'}[width]
+
+    def validate(self, args):
+        for v in args:
+            number(v)
+
+    def size(self, args, addr):
+        return words(len(args) * self.width)
+
+    def emit(self, args, addr):
+        mask = self.mask
+        b = struct.pack('<{}{}'.format(len(args), self.format),
+                        *[number(v) & mask for v in args])
+        return pad(b)
+
+
+class Float(Directive):
+    def values(self, args):
+        values = []
+        for v in args:
+            try:
+                values.append(float(v))
+            except ValueError:
+                print('{} は浮動小数点数ではありません'.format(v))
+                raise Exception('Data Error')
+        return values
+
+    def validate(self, args):
+        for (v, x) in zip(args, self.values(args)):
+            try:
+                struct.pack('<f', x)
+            except OverflowError:
+                print('{} は単精度で表せません'.format(v))
+                raise Exception('Data Error')
+
+    def size(self, args, addr):
+        return len(args) * 4
+
+    def emit(self, args, addr):
+        values = self.values(args)
+        try:
+            return struct.pack('<{}f'.format(len(values)), *values)
+        except OverflowError:
+            print('{} は単精度で表せません'.format(', '.join(args)))
+            raise Exception('Data Error')
+
+
+class Space(Directive):
+    ''' .space, .zero '''
+    arity = (1, 2)
+
+    def parse(self, args):
+        ''' (バイト数, 値) '''
+        n = number(args[0])
+        if n < 0:
+            print('{} バイトは置けません'.format(n))
+            raise Exception('Data Error')
+        fill = number(args[1]) & 0xff if len(args) > 1 else 0
+        return (n, fill)
+
+    def validate(self, args):
+        self.parse(args)
+
+    def size(self, args, addr):
+        return words(number(args[0]))
+
+    def emit(self, args, addr):
+        (n, fill) = self.parse(args)
+        if fill == 0:
+            return bytes(words(n))
+        return pad(bytes([fill]) * n)
+
+
+class Fill(Directive):
+    ''' .fill 回数, 大きさ, 値 '''
+    arity = (1, 3)
+
+    def parse(self, args):
+        ''' (回数, 大きさ, 値) '''
+        repeat = number(args[0])
+        width = number(args[1]) if len(args) > 1 else 1
+        value = number(args[2]) if len(args) > 2 else 0
+        if repeat < 0 or width not in (1, 2, 4):
+            print('.fill {} は置けません'.format(', '.join(args)))
+            raise Exception('Data Error')
+        return (repeat, width, value)
+
+    def validate(self, args):
+        self.parse(args)
+
+    def size(self, args, addr):
+        width = number(args[1]) if len(args) > 1 else 1
+        return words(number(args[0]) * width)
+
+    def emit(self, args, addr):
+        (repeat, width, value) = self.parse(args)
+        item = (value & ((1 << (width * 8)) - 1)).to_bytes(width, 'little')
+        return pad(item * repeat)
+
+
+class Align(Directive):
+    arity = (1, 1)
+    # メモリは 0xf4240 語 (4000000 バイト) なので、それに収まる 2^21 バイトまで
+    limit = 21
+
+    def alignment(self, args):
+        return 1 << number(args[0])
+
+    def validate(self, args):
+        n = number(args[0])
+        if not 0 <= n <= self.limit:
+            print('.align {} は使えません'.format(n))
+            raise Exception('Data Error')
+
+    def size(self, args, addr):
+        a = max(4, self.alignment(args))
+        return -addr % a
+
+    def emit(self, args, addr):
+        self.validate(args)
+        return bytes(self.size(args, addr))
+
+
+# 名前 -> Directive
+table = {
+    '.word': Values(4),
+    '.half': Values(2),
+    '.byte': Values(1),
+    '.float': Float(),
+    '.space': Space(),
+    '.zero': Space(),
+    '.fill': Fill(),
+    '.align': Align(),
+}
+
+
+class TestDirective(unittest.TestCase):
+    def emit(self, name, args, addr=0):
+        d = table[name]
+        d.check(name, args)
+        b = d.emit(args, addr)
+        self.assertEqual(len(b), d.size(args, addr))
+        return b.hex()
+
+    def test_values(self):
+        self.assertEqual(self.emit('.word', ['1', '-1', '0x10']), '01000000ffffffff10000000')
+        self.assertEqual(self.emit('.word', ['012']), '0c000000')
+        self.assertEqual(self.emit('.half', ['0x1234', '-2', '5']), '3412feff05000000')
+        self.assertEqual(self.emit('.byte', ['1', '0x1ff']), '01ff0000')
+        self.assertEqual(self.emit('.byte', []), '')
+        self.assertEqual(self.emit('.float', ['1.0', '-2', '255']), '0000803f000000c000007f43')
+
+    def test_space(self):
+        self.assertEqual(self.emit('.space', ['5']), '00' * 8)
+        self.assertEqual(self.emit('.zero', ['0x8']), '00' * 8)
+        self.assertEqual(self.emit('.space', ['2', '0xab']), 'abab0000')
+        self.assertEqual(self.emit('.fill', ['3', '2', '0x1234']), '341234123412' + '0000')
+        self.assertEqual(self.emit('.fill', ['3']), '00' * 4)
+        self.assertEqual(len(table['.space'].emit(['1000000'], 0)), 1000000)
+
+    def test_check(self):
+        # パースのときは引数を確かめるだけで、置くものは作らない
+        def fail(args, addr):
+            raise AssertionError('emit')
+        for (name, args) in [('.space', ['0x1000000']), ('.fill', ['0x1000000', '4', '1']),
+                             ('.word', ['1']), ('.float', ['1.0']), ('.align', ['3'])]:
+            d = table[name]
+            d.emit = fail
+            try:
+                d.check(name, args)
+            finally:
+                del d.emit
+        with self.assertRaises(TypeError):
+            Directive()
+
+    def test_align(self):
+        self.assertEqual(self.emit('.align', ['2'], 12), '')
+        self.assertEqual(self.emit('.align', ['4'], 12), '00' * 4)
+        self.assertEqual(self.emit('.align', ['0'], 8), '')
+        self.assertEqual(len(self.emit('.align', ['21'], 4)), (2 ** 21 - 4) * 2)
+
+    def test_error(self):
+        for (name, args) in [('.word', ['x']), ('.word', ['0x']), ('.float', ['a']),
+                             ('.float', ['1e40']), ('.space', []), ('.space', ['-4']),
+                             ('.fill', ['1', '3']), ('.align', ['1', '2']), ('.align', ['40']),
+                             ('.align', ['22']), ('.word', ['0xzz']), ('.fill', ['2', '4', '0x1g']),
+                             ('.word', ['0x_1'])]:
+            with self.assertRaises(Exception):
+                table[name].check(name, args)
@@ -0,0 +1,450 @@
+#!/usr/bin/env python
+'''
+ # 逆アセンブラ
+
+ 出来上がったイメージ (a.out や .coe など) を命令に戻す。エンコーダを変えたときに、
+ 出てくる機械語を確かめるためのもの。
+
+ ```
+ python main.py assets/fib.s --map fib.map --output fib.out
+ python disasm.py fib.out --map fib.map
+ ```
+
+ ## 表
+
+ デコードの表は optable の Op (opcode, funct3, funct7) から作るので、エンコーダと同じ定義を使う。
+ U, J 形式は opcode だけ、funct7 の無いものは (opcode, funct3)、あるものは (opcode, funct3, funct7) で引く。
+ フィールドの取り出し方は asmgen の各形式の逆。
+
+ - 同じ符号になる命令 (今は xori と ori) は先に登録した方の名前で出し、`= ori` と注釈を付ける
+ - bnei は bgeu の rs2 に即値 (レジスタ番号 - 16) を入れたものなので、bgeu には bnei としての読み方も付ける
+ - どれにも当たらない語は `.word` で出す。命令の部分はそのままアセンブルし直せる書き方にする
+
+ ## 出力
+
+ 一行に一語で、アドレス、語の値、命令、`;` の後に注釈。分岐・jal の飛び先と、auipc + jalr、
+ lui + addi の組で作ったアドレスを注釈に出す。
+ .map ファイル (main.py --map) を渡すと、シンボルの名前を行の前と飛び先に出し、ヒープは .word で出す。
+ 同じ語が3つ以上続く所 (.space や0の並び) は、既定では最初の一語と語の数だけにする。
+
+ ## 速さ
+
+ numpy は使わずに、イメージ全体を array で一度に語の列にして、異なる語ごとに一度だけデコードする。
+ 分岐の即値は相対のまま出すので、行のアドレスより後ろは語だけで決まり、map で表を引いて並べられる。
+ 作り直すのはアドレスで変わる行 (飛び先の注釈、組の命令、ヒープ) だけで、飛び先のシンボルもまとめて引く。
+ 同じ語の続く所は、隣と等しいかの bytes の中を find で探すので、大きな .space も一語ずつは見ない。
+'''
+
+import argparse
+import array
+import bisect
+import itertools
+import operator
+import sys
+import unittest
+
+import asmgen
+import formats
+import optable
+import symbols
+import utils
+
+
+def signed(v, bits):
+    return v - (1 << bits) if v >> (bits - 1) else v
+
+
+# 各形式の、語 -> (rd, rs1, rs2, imm)。asmgen の各形式の逆
+
+def u_fields(w):
+    return (w >> 7 & 31, 0, 0, w >> 12)
+
+def j_fields(w):
+    imm = ((w >> 12 & 0xff) << 11) | ((w >> 20 & 1) << 10) | (w >> 21 & 0x3ff) | ((w >> 31) << 19)
+    return (w >> 7 & 31, 0, 0, signed(imm, 20))
+
+def b_fields(w):
+    imm = ((w >> 7 & 1) << 10) | (w >> 8 & 0xf) | ((w >> 25 & 0x3f) << 4) | ((w >> 31) << 11)
+    return (0, w >> 15 & 31, w >> 20 & 31, signed(imm, 12))
+
+def i_fields(w):
+    return (w >> 7 & 31, w >> 15 & 31, 0, signed(w >> 20, 12))
+
+def s_fields(w):
+    return (0, w >> 15 & 31, w >> 20 & 31, signed(((w >> 25) << 5) | (w >> 7 & 31), 12))
+
+def r_fields(w):
+    return (w >> 7 & 31, w >> 15 & 31, w >> 20 & 31, 0)
+
+
+fields = {
+    'R': r_fields,
+    'I': i_fields,
+    'S': s_fields,
+    'B': b_fields,
+    'U': u_fields,
+    'J': j_fields,
+    'F': r_fields,
+}
+
+
+def key(op):
+    if op.fmt in ('U', 'J'):
+        return (op.opcode,)
+    if op.funct7 is None:
+        return (op.opcode, op.funct3)
+    return (op.opcode, op.funct3, op.funct7)
+
+
+# (opcode, funct3, funct7) などのキー -> Op
+table = {}
+# 先に登録した命令の名前 -> 同じ符号になる他の命令の名前
+shared = {}
+for op in optable.table.values():
+    if op.fmt not in asmgen.formats:
+        continue
+    k = key(op)
+    if k in table:
+        shared.setdefault(table[k].name, []).append(op.name)
+        continue
+    table[k] = op
+
+
+# レジスタの番号 -> 名前 (utils.reg_d で最初に出てくるもの)
+int_regs = {}
+for (name, i) in utils.reg_d.items():
+    int_regs.setdefault(i, name)
+float_regs = {i: 'f{}'.format(i) for i in range(32)}
+
+# F 形式以外で浮動小数点レジスタを使う引数と、F 形式で整数レジスタを使う引数の位置
+float_args = {'flw': (0,), 'fsw': (0,)}
+int_args = {'feq.s': (0,), 'flt.s': (0,), 'fle.s': (0,), 'fcvt.w.s': (0,), 'fcvt.s.w': (1,)}
+
+# imm(rs1) の形で書くもの
+memory = {optable.LOAD, optable.STORE, optable.table['flw'].opcode, optable.table['fsw'].opcode}
+
+
+class Decoded:
+    __slots__ = ('op', 'rd', 'rs1', 'rs2', 'imm', 'text', 'notes')
+
+    def __init__(self, op, w):
+        self.op = op
+        (self.rd, self.rs1, self.rs2, self.imm) = fields[op.fmt](w)
+        if op.fmt == 'I' and op.funct7 is not None:
+            # シフト量
+            self.imm &= 31
+        self.text = '{} {}'.format(op.name, ', '.join(self.args()))
+        self.notes = ['= ' + name for name in shared.get(op.name, ())]
+        reading = readings.get(op.name)
+        if reading is not None:
+            self.notes.append('= ' + reading(self))
+
+    def regs(self):
+        ''' 引数の位置 -> レジスタ名の表 '''
+        name = self.op.name
+        if self.op.fmt == 'F':
+            l = [float_regs] * 3
+            for i in int_args.get(name, ()):
+                l[i] = int_regs
+            return l
+        l = [int_regs] * 3
+        for i in float_args.get(name, ()):
+            l[i] = float_regs
+        return l
+
+    def args(self):
+        op = self.op
+        (r0, r1, r2) = self.regs()
+        fmt = op.fmt
+        if fmt in ('R', 'F'):
+            l = [r0[self.rd], r1[self.rs1], r2[self.rs2]]
+            return l[:op.arity]
+        if fmt == 'I':
+            if op.opcode in memory:
+                return [r0[self.rd], '{}({})'.format(self.imm, r1[self.rs1])]
+            return [r0[self.rd], r1[self.rs1], str(self.imm)]
+        if fmt == 'S':
+            return [r0[self.rs2], '{}({})'.format(self.imm, r1[self.rs1])]
+        if fmt == 'B':
+            return [r0[self.rs1], r1[self.rs2], str(self.imm)]
+        return [r0[self.rd], str(self.imm)]
+
+
+def bnei(d):
+    # extension.bnei の逆: rs2 には (レジスタ番号 - 16) の下位5bit
+    return 'bnei {}, x{}, {}'.format(int_regs[d.rs1], (d.rs2 + 16) % 32, d.imm)
+
+
+# 命令の名前 -> 同じ語を別の命令 (この CPU 独自のもの) として読んだ文字列を作る関数
+readings = {
+    'bgeu': bnei,
+}
+
+
+def decode(w):
+    ''' 語を Decoded にする。命令でなければ None '''
+    op = (table.get((w & 0x7f, w >> 12 & 7, w >> 25))
+          or table.get((w & 0x7f, w >> 12 & 7))
+          or table.get((w & 0x7f,)))
+    if op is None:
+        return None
+    return Decoded(op, w)
+
+
+def to_words(image):
+    if len(image) % 4 != 0:
+        image = bytes(image) + bytes(-len(image) % 4)
+    a = array.array('I')
+    a.frombytes(image)
+    if sys.byteorder != 'little':
+        a.byteswap()
+    return a
+
+
+class Disassembler:
+    def __init__(self, symbols=None):
+        # symbols.SymbolTable
+        self.symbols = symbols
+        # アドレス -> その位置から始まるシンボルの名前
+        self.labels = {}
+        # .word で出す範囲 (ヒープ)
+        self.data = (0, 0)
+        if symbols is not None:
+            symbols.index()
+            for s in symbols.sorted:
+                self.labels.setdefault(s.addr, []).append(s.name)
+            heap = [s for s in symbols.sorted if s.section == 'heap']
+            if heap:
+                self.data = (heap[0].addr, max(s.addr + s.size for s in heap))
+
+    def where(self, addr, s=False):
+        ''' 注釈に出すアドレス。s は addr を含むシンボル (分かっていれば) '''
+        if s is False:
+            s = None if self.symbols is None else self.symbols.lookup(addr)
+        if s is None:
+            return '{:#010x}'.format(addr)
+        if s.addr == addr:
+            return '{:#010x} <{}>'.format(addr, s.name)
+        return '{:#010x} <{}+{:#x}>'.format(addr, s.name, addr - s.addr)
+
+    def text(self, w, d, notes=()):
+        ''' 行のアドレスより後ろ (改行まで) '''
+        if d is None:
+            return '  {:08x}  .word {:#010x}\n'.format(w, w)
+        notes = d.notes + list(notes)
+        if notes:
+            return '  {:08x}  {:24}  ; {}\n'.format(w, d.text, ', '.join(notes))
+        return '  {:08x}  {}\n'.format(w, d.text)
+
+    def notes(self, addr, d, prev):
+        ''' アドレスで変わる注釈。prev は一つ前の語の Decoded (組の命令を見るため) '''
+        if d.op.fmt in ('B', 'J'):
+            # 即値は語単位
+            return [self.where(addr + d.imm * 4)]
+        if prev is None or prev.op.fmt != 'U' or prev.rd != d.rs1 or prev.rd == 0:
+            return []
+        v = ((prev.imm << 12) + d.imm) & 0xffffffff
+        if prev.op.name == 'auipc':
+            return [self.where((addr - 4 + signed(v, 32) * 4) & 0xffffffff)]
+        if v * 4 in self.labels:
+            return ['= ' + self.labels[v * 4][-1]]
+        return []
+
+    def rest(self, addr, w, d, prev):
+        ''' addr に置いた語の、行のアドレスより後ろ '''
+        if self.data[0] <= addr < self.data[1]:
+            d = None
+        return self.text(w, d, () if d is None else self.notes(addr, d, prev))
+
+    def run(self, image, base=0, collapse=True):
+        ''' image (base から置いたもの) を逆アセンブルした文字列 '''
+        words = to_words(image)
+        n = len(words)
+        # 異なる語ごとに一度だけデコードする
+        decoded = {w: decode(w) for w in set(words)}
+        self.decoded = decoded
+        self.texts = {w: self.text(w, d) for (w, d) in decoded.items()}
+        # 分岐・jal は、飛び先の注釈の前までと、飛び先までのバイト数
+        self.heads = {w: self.text(w, d, [''])[:-1] for (w, d) in decoded.items()
+                      if d is not None and d.op.fmt in ('B', 'J')}
+        self.deltas = {w: decoded[w].imm * 4 for w in self.heads}
+        # lui/auipc の次の jalr/addi は、組にして値を出す
+        self.upper = {w for (w, d) in decoded.items() if d is not None and d.op.fmt == 'U'}
+        self.lower = {w for (w, d) in decoded.items()
+                      if d is not None and d.op.name in ('jalr', 'addi')}
+        # シンボルのある語の位置
+        self.marks = sorted((a - base) // 4 for a in self.labels
+                            if base <= a < base + n * 4 and (a - base) % 4 == 0)
+        marks = self.marks
+
+        # 行はアドレスとそれより後ろに分けたまま並べて、最後に一度だけつなげる
+        out = []
+        pos = 0
+        for (s, e) in (runs(words) if collapse else []) + [(n, n)]:
+            self.render(out, words, base, pos, s)
+            if s < e:
+                # 同じ語の並びは、途中にあるシンボルで区切ってまとめる
+                i = bisect.bisect_right(marks, s)
+                j = bisect.bisect_left(marks, e)
+                starts = [s] + marks[i:j] + [e]
+                for (a, b) in zip(starts, starts[1:]):
+                    self.render(out, words, base, a, a + 1)
+                    if b - a > 1:
+                        out.append('{:8}  ... ({} words)\n'.format('', b - a))
+            pos = e
+        return ''.join(out)
+
+    def render(self, out, words, base, s, e):
+        ''' words[s:e] の行を out に足す '''
+        if s >= e:
+            return
+        ws = words[s:e]
+        # pieces[2k] がアドレス、pieces[2k + 1] がその後ろ
+        pieces = list(itertools.chain.from_iterable(
+            zip(hex_addrs(base + s * 4, base + e * 4), map(self.texts.__getitem__, ws))))
+
+        # アドレスで変わる行だけ作り直す。飛び先はまとめて引く
+        flags = bytes(map(self.heads.__contains__, ws))
+        l = list(itertools.compress(range(s, e), flags))
+        jw = list(itertools.compress(ws, flags))
+        targets = [base + i * 4 + d for (i, d) in zip(l, map(self.deltas.__getitem__, jw))]
+        # 同じ関数を何度も呼ぶので、飛び先ごとに一度だけ引く
+        unique = list(set(targets))
+        found = [None] * len(unique) if self.symbols is None else self.symbols.lookup_many(unique)
+        notes = {t: self.where(t, sym) + '\n' for (t, sym) in zip(unique, found)}
+        for (i, h, t) in zip(l, map(self.heads.__getitem__, jw), targets):
+            pieces[(i - s) * 2 + 1] = h + notes[t]
+        # lui/auipc と組になった jalr/addi
+        lower = self.lower
+        fix = [i + 1 for i in itertools.compress(range(max(0, s - 1), e - 1),
+                                                 map(self.upper.__contains__, words[max(0, s - 1):e - 1]))
+               if words[i + 1] in lower]
+        (lo, hi) = self.data
+        fix += range(max(s, -(-(lo - base) // 4)), min(e, -(-(hi - base) // 4)))
+        decoded = self.decoded
+        for i in fix:
+            prev = decoded[words[i - 1]] if i > 0 else None
+            pieces[(i - s) * 2 + 1] = self.rest(base + i * 4, words[i], decoded[words[i]], prev)
+
+        # シンボルの名前を前に入れる
+        marks = self.marks
+        p = s
+        for k in marks[bisect.bisect_left(marks, s):bisect.bisect_left(marks, e)]:
+            out += pieces[(p - s) * 2:(k - s) * 2]
+            out += [name + ':\n' for name in self.labels[base + k * 4]]
+            p = k
+        out += pieces[(p - s) * 2:]
+
+
+def hex_addrs(start, stop):
+    ''' range(start, stop, 4) のそれぞれを8桁の16進にしたもの (まとめて bytes.hex で作る) '''
+    a = array.array('I', range(start, stop, 4))
+    if not a:
+        return []
+    if sys.byteorder == 'little':
+        a.byteswap()
+    return a.tobytes().hex(' ', 4).split(' ')
+
+
+def runs(words):
+    ''' 同じ語が3つ以上続く所の (最初の位置, 終わりの位置) のリスト '''
+    # same[i] は words[i + 1] == words[i]
+    same = bytes(map(operator.eq, words[1:], words))
+    l = []
+    pos = 0
+    while True:
+        i = same.find(b'\x01\x01', pos)
+        if i < 0:
+            return l
+        j = same.find(b'\x00', i)
+        if j < 0:
+            j = len(same)
+        l.append((i, j + 1))
+        pos = j
+
+
+def disassemble(image, base=0, symbols=None, collapse=True):
+    return Disassembler(symbols).run(image, base, collapse)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('filename', help='image (a.out, .coe, .mem, .hex)')
+    parser.add_argument('--format',
+            help='format of the image (default: guessed from the extension)',
+            choices=sorted(formats.table))
+    parser.add_argument('--map', metavar='FILE',
+            help='symbol map written by main.py --map')
+    parser.add_argument('--base', help='byte address of the first word',
+            type=lambda x: int(x, 0), default=0)
+    parser.add_argument('--all', help='print every word, even in runs of the same word',
+            action='store_true')
+    parser.add_argument('--output', help='output file (default: stdout)')
+    args = parser.parse_args()
+
+    image = formats.read(args.filename, args.format)
+    t = symbols.read_map(args.map) if args.map else None
+    text = disassemble(image, args.base, t, collapse=not args.all)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text)
+    else:
+        sys.stdout.write(text)
+
+
+class TestDisasm(unittest.TestCase):
+    def reassemble(self, w):
+        ''' 逆アセンブルした文字列をアセンブルし直した語 '''
+        import assembler
+        import ir
+        d = decode(w)
+        text = '.word {}'.format(w) if d is None else d.text
+        (inst,) = ir.parse(['\t' + text], 't')
+        return int.from_bytes(assembler.Assembler(lib='').encode(inst), 'little')
+
+    def test_encoding(self):
+        # エンコーダのテストの例をすべて戻せる
+        for (name, args, code) in optable.TestEncoding.cases:
+            w = int.from_bytes(bytes.fromhex(code), 'little')
+            d = decode(w)
+            self.assertEqual(d.op.name, 'xori' if name == 'ori' else name)
+            self.assertEqual(self.reassemble(w), w, d.text)
+
+    def test_text(self):
+        def text(name, args):
+            import assembler
+            return decode(int.from_bytes(assembler.Assembler(lib='').asm(name, args), 'little'))
+        self.assertEqual(text('sw', ['a0', 'sp', '-8']).text, 'sw a0, -8(sp)')
+        self.assertEqual(text('flw', ['f1', 'a0', '4']).text, 'flw f1, 4(a0)')
+        self.assertEqual(text('feq.s', ['a0', 'f1', 'f2']).text, 'feq.s a0, f1, f2')
+        self.assertEqual(text('fsqrt.s', ['f3', 'f4']).text, 'fsqrt.s f3, f4')
+        self.assertEqual(text('fcvt.s.w', ['f3', 'a4']).text, 'fcvt.s.w f3, a4')
+        self.assertEqual(text('srai', ['a0', 'a1', '3']).text, 'srai a0, a1, 3')
+        self.assertEqual(text('ori', ['a0', 'a1', '1']).notes, ['= ori'])
+        self.assertEqual(text('bnei', ['a0', 'x20', '-3']).notes, ['= bnei a0, x20, -3'])
+        self.assertIsNone(decode(0))
+
+    def test_image(self):
+        import assembler
+        a = assembler.Assembler(lib='min_caml_g:\n\tret\n')
+        src = ('_min_caml_start:\n\tcall f\n\tli a0, min_caml_g\n\tli a1, 100000\n'
+               '\tj end\nf:\n\tbeq a0, a1, end\n\tret\n\t.space 64\nend:\n\tcall min_caml_g\n')
+        image = a.assemble(src, filename='a.s')
+        t = a.symbols()
+        lines = disassemble(image, symbols=t).splitlines()
+        start = t['_min_caml_start'].addr
+        self.assertIn('_min_caml_start:', lines)
+        self.assertIn(' ' * 8 + '  ... (16 words)', lines)
+        self.assertTrue(any('<f>' in l and l.startswith('{:08x}'.format(start)) for l in lines))
+        self.assertTrue(any('beq a0, a1' in l and '<end>' in l for l in lines))
+        self.assertTrue(any(l.startswith('{:08x}'.format(t['min_caml_objects'].addr))
+                            and '.word' in l for l in lines))
+        # 全部出せば一行に一語で、どの語もアセンブルし直せる
+        lines = disassemble(image, collapse=False).splitlines()
+        self.assertEqual(len(lines), len(image) // 4)
+        for w in set(to_words(image)):
+            self.assertEqual(self.reassemble(w), w)
+
+
+if __name__ == '__main__':
+    main()
@@ -12,6 +12,20 @@ def li(rd, imm):
     return l
 
 
+def fits_li_short(imm):
+    ''' li を一命令 (addi か lui) にできるか '''
+    imm = utils.check_and_trans_imm(imm, 32)
+    return imm < (1 << 11) or imm >= (1 << 32) - (1 << 11) or imm & ((1 << 12) - 1) == 0
+
+
+def li_short(rd, imm):
+    ''' 12bitに収まる値は addi、下位12bitが0の値は lui 一つ '''
+    imm = utils.check_and_trans_imm(imm, 32)
+    if imm < (1 << 11) or imm >= (1 << 32) - (1 << 11):
+        return [('addi', [rd, 'x0', str(imm & ((1 << 12) - 1))])]
+    return [('lui', [rd, str(imm >> 12)])]
+
+
 def mv(rd, rs):
     l = [('addi', [rd, rs, '0'])]
     return l
@@ -79,7 +93,7 @@ def ret():
 def tail(imm):
     imm = utils.check_and_trans_imm(imm, 32)
     ui = str((imm >> 12) + ((imm >> 11) & 1))
-    li = str(imm & (1 << 12 - 1))
+    li = str(imm & ((1 << 12) - 1))
     l = [
         ('auipc', ('x6', ui)),
         ('jalr', ('x0', 'x6', li)),
@@ -0,0 +1,281 @@
+'''
+ # 出力形式
+
+ `--format` で選ぶ。どの形式も、出来上がったイメージ全体から一度に作る。
+ 16進への変換は bytes.hex に語ごとの区切りを指定して一回で済ませる。
+
+ - raw: そのまま (a.out)
+ - coe: Xilinx の .coe。一語一行で、バイトはメモリ上の順
+ - readmemh: Verilog の $readmemh 用。一語一行で、語をリトルエンディアンで読んだ値
+ - ihex: Intel HEX。16バイトずつのレコードで、64KBを超えると拡張リニアアドレスを入れる
+ - mmap: raw と同じものを、mmap したファイルに直接コピーして書く
+
+ 形式を足すときは add で登録する。render はイメージから出力ファイルの中身を作る関数、
+ write を指定するとファイルへの書き出しをそれに任せる。
+ parse はファイルの中身からイメージに戻す関数で、逆アセンブラ (disasm) が使う。
+'''
+
+import array
+import mmap
+import os
+import sys
+import unittest
+
+
+class Format:
+    __slots__ = ('name', 'ext', 'render', 'writer', 'raw', 'parse')
+
+    def __init__(self, name, ext, render, writer=None, raw=False, parse=bytes):
+        self.name = name
+        self.ext = ext
+        self.render = render
+        self.writer = writer
+        # 出力ファイルのバイトがイメージのバイトと同じ位置にあるか(部分的に書き換えられるか)
+        self.raw = raw
+        # 出力ファイルの中身 (bytes) からイメージを作る
+        self.parse = parse
+
+    def write(self, path, image):
+        if self.writer is not None:
+            return self.writer(path, image)
+        # 出力はまとめて一回で書く
+        with open(path, 'wb') as f:
+            f.write(self.render(image))
+
+
+table = {}
+
+
+def add(name, ext, render, writer=None, raw=False, parse=bytes):
+    table[name] = Format(name, ext, render, writer, raw, parse)
+
+
+def lookup(name):
+    if name not in table:
+        print('{} という出力形式はありません ({})'.format(name, ', '.join(sorted(table))))
+        raise Exception('No Such Format')
+    return table[name]
+
+
+def write(path, image, name='raw'):
+    lookup(name).write(path, image)
+
+
+def render(image, name='raw'):
+    return lookup(name).render(image)
+
+
+def guess(path):
+    ''' 拡張子から形式の名前を決める。分からなければ raw '''
+    ext = os.path.splitext(path)[1][1:]
+    for f in table.values():
+        if f.ext == ext:
+            return f.name
+    return 'raw'
+
+
+def read(path, name=None):
+    ''' 書き出したファイルをイメージに戻す。name を省略すると拡張子から決める '''
+    with open(path, 'rb') as f:
+        data = f.read()
+    return lookup(name or guess(path)).parse(data)
+
+
+def parse_error(message):
+    print(message)
+    raise Exception('Format Error')
+
+
+def check_alignment(image):
+    if len(image) % 4 != 0:
+        print('命令列のうち4byte alignedでないものが存在します')
+        raise Exception('Alignment error')
+
+
+def words_hex(image, sep, swap=False):
+    ''' 一語ずつ sep で区切った16進。swap なら語をリトルエンディアンの値として読む '''
+    check_alignment(image)
+    if swap:
+        a = array.array('I')
+        a.frombytes(image)
+        if sys.byteorder == 'little':
+            a.byteswap()
+        image = a.tobytes()
+    return bytes(image).hex(sep, 4)
+
+
+coe_prologue = b'''\
+memory_initialization_radix=16;
+memory_initialization_vector=
+'''
+coe_epilogue = b'''\
+0;
+'''
+
+
+def coe_body(image):
+    h = words_hex(image, '\n').replace('\n', ',\n')
+    return (h + ',\n').encode('ascii')
+
+
+def render_coe(image):
+    return b''.join([coe_prologue, coe_body(image), coe_epilogue])
+
+
+def parse_coe(data):
+    (head, sep, body) = data.decode('ascii').partition('memory_initialization_vector=')
+    if not sep or 'memory_initialization_radix=16;' not in head.replace(' ', ''):
+        parse_error('16進の COE ではありません')
+    for c in ' \t\r\n':
+        body = body.replace(c, '')
+    # 最後は coe_epilogue の '0;'
+    if body == '0;' or body.endswith(',0;'):
+        body = body[:-2]
+    h = body.replace(';', ',')
+    digits = h.replace(',', '')
+    if len(digits) != h.count(',') * 8:
+        # 8桁でない値がある
+        digits = ''.join(x.zfill(8) for x in h.split(',') if x)
+    try:
+        return bytes.fromhex(digits)
+    except ValueError:
+        parse_error('COE の値が読めません')
+
+
+def render_readmemh(image):
+    if not image:
+        return b''
+    return (words_hex(image, '\n', swap=True) + '\n').encode('ascii')
+
+
+def parse_readmemh(data):
+    lines = data.decode('ascii').split()
+    digits = ''.join(lines)
+    if len(digits) != len(lines) * 8:
+        # 注釈や、0埋めしていない値のあるもの
+        lines = [x.zfill(8) for x in (line.split('//')[0].strip()
+                                      for line in data.decode('ascii').split('\n')) if x]
+        digits = ''.join(lines)
+    if '@' in digits:
+        parse_error('アドレス指定 (@) のある readmemh は読めません')
+    # 語の値 (ビッグエンディアン) を並べたものになるので、語ごとに反転する
+    a = array.array('I')
+    try:
+        a.frombytes(bytes.fromhex(digits))
+    except ValueError:
+        parse_error('readmemh の値が読めません')
+    if sys.byteorder == 'little':
+        a.byteswap()
+    return a.tobytes()
+
+
+def ihex_record(addr, kind, data):
+    s = (len(data) + (addr >> 8) + (addr & 0xff) + kind + sum(data)) & 0xff
+    return ':{:02X}{:04X}{:02X}{}{:02X}\n'.format(
+        len(data), addr, kind, data.hex().upper(), (-s) & 0xff)
+
+
+# 16バイトのデータレコードの、アドレスまでの部分とそのチェックサムへの寄与
+_ihex_prefix = [':10{:04X}00'.format(i) for i in range(0, 0x10000, 16)]
+_ihex_sum = [16 + (i >> 8) + (i & 0xff) for i in range(0, 0x10000, 16)]
+_hex2 = ['{:02X}'.format(i) for i in range(256)]
+
+
+def render_ihex(image):
+    image = bytes(image)
+    l = []
+    for base in range(0, len(image), 0x10000):
+        if base:
+            l.append(ihex_record(0, 4, (base >> 16).to_bytes(2, 'big')))
+        seg = image[base:base + 0x10000]
+        # 16バイトのレコードは、16進もバイトの和もまとめて作る
+        n = len(seg) // 16 * 16
+        if n:
+            data = seg[:n].hex('\n', 16).upper().split('\n')
+            sums = map(sum, zip(*[seg[k:n:16] for k in range(16)]))
+            l += [p + d + _hex2[-(a + s) & 0xff] + '\n'
+                  for (p, d, a, s) in zip(_ihex_prefix, data, _ihex_sum, sums)]
+        if n < len(seg):
+            l.append(ihex_record(n, 0, seg[n:]))
+    l.append(':00000001FF\n')
+    return ''.join(l).encode('ascii')
+
+
+def parse_ihex(data):
+    image = bytearray()
+    upper = 0
+    for line in data.decode('ascii').split():
+        r = bytes.fromhex(line[1:])
+        (n, addr, kind) = (r[0], int.from_bytes(r[1:3], 'big'), r[3])
+        if line[0] != ':' or len(r) != n + 5 or sum(r) & 0xff:
+            parse_error('Intel HEX のレコードが壊れています: {}'.format(line))
+        if kind == 0:
+            a = upper + addr
+            if len(image) < a + n:
+                image += bytes(a + n - len(image))
+            image[a:a + n] = r[4:4 + n]
+        elif kind == 4:
+            upper = int.from_bytes(r[4:6], 'big') << 16
+        elif kind == 1:
+            break
+    return bytes(image)
+
+
+def write_mmap(path, image):
+    if not image:
+        with open(path, 'wb'):
+            return
+    with open(path, 'w+b') as f:
+        f.truncate(len(image))
+        with mmap.mmap(f.fileno(), len(image)) as m:
+            m[:] = image
+
+
+add('raw', 'out', bytes, raw=True)
+add('coe', 'coe', render_coe, parse=parse_coe)
+add('readmemh', 'mem', render_readmemh, parse=parse_readmemh)
+add('ihex', 'hex', render_ihex, parse=parse_ihex)
+add('mmap', 'out', bytes, write_mmap, raw=True)
+
+
+class TestFormats(unittest.TestCase):
+    image = b'\x13\x00\x00\x00\x01\x02\x03\x04'
+
+    def test_coe(self):
+        self.assertEqual(coe_body(self.image), b'13000000,\n01020304,\n')
+        self.assertEqual(coe_body(b''), b',\n')
+        with self.assertRaises(Exception):
+            coe_body(b'\x00\x00')
+
+    def test_readmemh(self):
+        self.assertEqual(render_readmemh(self.image), b'00000013\n04030201\n')
+
+    def test_ihex(self):
+        self.assertEqual(render_ihex(self.image),
+                         b':080000001300000001020304DB\n:00000001FF\n')
+        l = render_ihex(bytes(0x10010)).split(b'\n')
+        self.assertEqual(l[0x1000], b':020000040001F9')
+        self.assertEqual(l[0x1001], b':10000000' + b'00' * 16 + b'F0')
+        # 端数のレコード
+        self.assertEqual(render_ihex(bytes(range(19))).split(b'\n')[1], b':03001000101112BA')
+
+    def test_write(self):
+        import tempfile
+        with tempfile.TemporaryDirectory() as d:
+            for name in table:
+                path = os.path.join(d, name)
+                write(path, self.image, name)
+                with open(path, 'rb') as f:
+                    self.assertEqual(f.read(), render(self.image, name))
+        with self.assertRaises(Exception):
+            lookup('hoge')
+
+    def test_parse(self):
+        image = bytes(range(256)) * 300 + self.image
+        for (name, f) in table.items():
+            self.assertEqual(f.parse(f.render(image)), image)
+            self.assertEqual(f.parse(f.render(b'')), b'')
+        self.assertEqual((guess('a.coe'), guess('x/a.out'), guess('a.bin')), ('coe', 'raw', 'raw'))
+        self.assertEqual(parse_readmemh(b'// x\n13\n04030201 // y\n'), b'\x13\0\0\0\x01\x02\x03\x04')
+        with self.assertRaises(Exception):
+            parse_ihex(b':0100000001FF\n')
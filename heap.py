@@ -1,25 +1,45 @@
+'''
+ # ヒープの初期値
+
+ min-caml (レイトレーサ) の大域変数の並びと初期値。prologue の後の base から置く。
+ ここに書いた表だけから、イメージ (image) と、タグの表に無い名前のアドレス (get) の両方を作る。
+
+ add(名前, 大きさ(バイト), 初期値) で前から順に並べる。初期値は、全部の語を同じ値にするなら
+ その値、そうでなければ (値, 語の数) の列。省略すると0。
+ 値はコンパイラの出力 (heap_file) のままで、ヒープの中を指すものは語単位のアドレスにしてある。
+'''
+
+import struct
+import unittest
+
 l = []
 
 
-def add(name, size):
+def add(name, size, init=0):
     global l
-    l.append((name, size))
+    if type(init) == int:
+        init = [(init, size // 4)]
+    l.append((name, size, tuple(init)))
 
 
+# 語単位のアドレスで、いくつかの値が指している場所
+dummy_p = 0x8401
+and_net_p = 0x8453
+
 add("n_objects", 4)
-add("dummy", 12 * 4)
-add("objects", 60 * 4)
+add("dummy", 12 * 4, [(0, 4), (dummy_p, 2), (0, 1), (dummy_p, 4), (0, 1)])
+add("objects", 60 * 4, dummy_p)
 add("screen", 3 * 4)
 add("viewpoint", 3 * 4)
 add("light", 3 * 4)
-add("beam", 1 * 4)
-add("dummy", 4)
-add("and_net", 50 * 4)
-add("dummy", 4)
-add("or_net", 1 * 4)
+add("beam", 1 * 4, 0x437f0000)  # 255.0
+add("dummy", 4, 0xffffffff)
+add("and_net", 50 * 4, and_net_p)
+add("dummy", 4, and_net_p)
+add("or_net", 1 * 4, 0x8486)
 add("solver_dist", 1 * 4)
 add("intsec_rectside", 1 * 4)
-add("tmin", 1 * 4)
+add("tmin", 1 * 4, 0x4e6e6b28)  # 1000000000.0
 add("intersection_point", 3 * 4)
 add("intersected_object_id", 1 * 4)
 add("nvector", 3 * 4)
@@ -35,29 +55,115 @@ add("screenx_dir", 3 * 4)
 add("screeny_dir", 3 * 4)
 add("screenz_dir", 3 * 4)
 add("ptrace_dirvec", 3 * 4)
-add("dummy", 4 * 2)
-add("dirvecs", 5 * 4)
-add("dummy", 3 * 4 + 60 * 4)
-add("light_dirvec", 4 * 2)
-add("dummy", 2 * 4 + 3 * 4 + 4)
-add("reflections", 180 * 4)
+add("dummy", 4 * 2, 0x84b2)
+add("dirvecs", 5 * 4, 0x84b4)
+add("dummy", 3 * 4 + 60 * 4, [(0, 3), (0x84b9, 60)])
+add("light_dirvec", 4 * 2, [(0x84b9, 1), (0x84bc, 1)])
+add("dummy", 2 * 4 + 3 * 4 + 4, [(0x84fa, 2), (0, 1), (0x84fa, 1), (0, 2)])
+add("reflections", 180 * 4, 0x84fc)
 add("n_reflections", 1 * 4)
+# ユーザーのプログラム (program_start) までの余り
+add("dummy", 3 * 4)
 
 
-dic = {}
+# 置くアドレス (バイト単位)。prologue の後ろ
 base = 0x10 * 4
+
+dic = {}
+addr = base
 for x in l:
-    dic[x[0]] = base
-    base += x[1]
+    dic[x[0]] = addr
+    addr += x[1]
+
+
+# ソースからはこれを付けた名前で参照する
+prefix = 'min_caml_'
+
 
 def get(name):
-    return dic[name[9:]]
+    ''' ヒープの変数のアドレス (バイト単位) '''
+    if not has(name):
+        print('{} は見つかりませんでした'.format(name))
+        raise Exception('Tag is not found')
+    return dic[name[len(prefix):]]
+
+
+def has(name):
+    return name.startswith(prefix) and name[len(prefix):] in dic
+
+
+def symbols():
+    ''' (名前, アドレス, 大きさ) の列。dummy は除く '''
+    addr = base
+    for (name, size, init) in l:
+        if name != 'dummy':
+            yield (prefix + name, addr, size)
+        addr += size
+
+
+def build(layout):
+    ''' 表からイメージを作る。同じ値の続く所はまとめて作る '''
+    word = struct.Struct('<I').pack
+    chunks = []
+    for (name, size, init) in layout:
+        n = 0
+        for (value, count) in init:
+            chunks.append(word(value) * count)
+            n += count
+        if n * 4 != size:
+            print('{}: 大きさ {} バイトに初期値が {} 語あります'.format(name, size, n))
+            raise Exception('Heap Error')
+    return b''.join(chunks)
+
+
+# 表 (と base) ごとに一度だけ作る
+_images = {}
+
+
+def image():
+    key = (base, tuple(l))
+    r = _images.get(key)
+    if r is None:
+        r = build(l)
+        _images[key] = r
+    return r
+
+
+class TestHeap(unittest.TestCase):
+    def test_image(self):
+        # コンパイラの出力 (バイト単位のアドレス) を語単位に直したものと同じ
+        import os
+        p = os.path.dirname(os.path.abspath(__file__))
+        expected = bytearray()
+        with open(os.path.join(p, 'heap_file')) as f:
+            for x in f.read().split():
+                v = int(x, 16)
+                if 0x00020000 <= v <= 0x000213f0:
+                    v //= 4
+                expected += struct.pack('<I', v)
+        self.assertEqual(image(), bytes(expected))
+        self.assertIs(image(), image())
+
+    def test_get(self):
+        self.assertEqual(get('min_caml_n_objects'), base)
+        self.assertEqual(get('min_caml_objects'), base + 13 * 4)
+        self.assertFalse(has('min_caml_hoge'))
+        self.assertFalse(has('xxxxxxxxxobjects'))
+        with self.assertRaises(Exception):
+            get('objects')
+        for (name, addr, size) in symbols():
+            self.assertEqual(get(name), addr)
+        self.assertNotIn('min_caml_dummy', [name for (name, _, _) in symbols()])
+
+    def test_size(self):
+        with self.assertRaises(Exception):
+            build([('x', 8, ((0, 1),))])
 
 
 if __name__ == '__main__':
-    base = 0x10 * 4
+    addr = base
     print("[",end="")
     for x in l:
-        print("(\"", x[0], "\",",  base // 4, ");", sep="")
-        base += x[1]
+        print("(\"", x[0], "\",",  addr // 4, ");", sep="")
+        addr += x[1]
     print("]",end="")
@@ -1,15 +1,19 @@
+import extension
+import utils
+
+
 def jal(imm):
-    l = [('jal', 'x1', imm)]
+    l = [('jal', ('x1', imm))]
     return l
 
 
 def jalr(rs):
-    l = [('jalr', 'x0', rs, '0')]
+    l = [('jalr', ('x0', rs, '0'))]
     return l
 
 def li(rs, imm):
-    l = [('li', (rs, imm))]
-    return l
+    # タグの値によらず二命令 (短くするときは optable.short の _li_short を使う)
+    return extension.li(rs, imm)
 
 
 def add(rd, rs, imm):
@@ -20,3 +24,37 @@ def add(rd, rs, imm):
 def sub(rd, rs, imm):
     l = [('subi', (rd, rs, imm))]
     return l
+
+
+# 引数を見て、書き換え後の命令名を返す
+
+def rename_jal(args):
+    if len(args) == 1:
+        return '_jal'
+    return 'jal'
+
+
+def rename_jalr(args):
+    if len(args) == 1:
+        return '_jalr'
+    return 'jalr'
+
+
+def rename_li(args):
+    if len(args) == 2 and utils.is_number(args[1]):
+        if extension.fits_li_short(args[1]):
+            return '_li_short'
+        return 'li'
+    return '_li'
+
+
+def rename_add(args):
+    if len(args) == 3 and utils.is_number(args[2]):
+        return '_add'
+    return 'add'
+
+
+def rename_sub(args):
+    if len(args) == 3 and utils.is_number(args[2]):
+        return '_sub'
+    return 'sub'
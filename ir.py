@@ -0,0 +1,331 @@
+'''
+ # 中間表現
+
+ ソースは一度だけ読んで、一行ごとに Inst にしておく。
+ タグの収集、アドレスの割り当て、エンコード、エラー表示はすべてこの Inst の列に対して行うので、
+ 字句解析 (lexer) はファイル全体で一回で済む。
+ 下の正規表現は受け付ける書式の定義で、lexer はこれと同じ結果を返す
+ (op_pat, directive_pat, const_pat の順に試す)。
+
+ - op: optable の Op (hookによる書き換えは済ませてある)。タグだけの行は None。
+   .globl のような知らない指示は無視する
+ - args: 引数。'4(sp)' のような変位指定は ['sp', '4'] に展開してある
+ - refs: args のうち、タグを参照している引数の位置。無ければ None
+ - tag: 行頭のタグ。無ければ None
+ - source, lineno: エラー表示用
+
+ パース結果は複数のアセンブラ(スレッド)で共有するので、Inst は作った後に書き換えない。
+ 割り当てたアドレスは Assembler の側で持つ。
+'''
+
+import re
+import unittest
+
+import lexer
+import optable
+import utils
+
+
+
+tag_re = r'((?P<tag_name>[_|\w|.]*):)'
+r = r'^\s*' + tag_re + r'.*$'
+tag_pat = re.compile(r)
+
+
+displacement_res = r'^(?P<offset>(-?\d+)?)\((?P<reg>.+)\)$'
+displacement_re = re.compile(displacement_res)
+
+
+def match_displacement(s):
+    return lexer.displacement(s)
+
+
+class TestDisplacementRegex(unittest.TestCase):
+    ''' Does displacement regex work correctly? '''
+
+    def test_displacement_match(self):
+        r = displacement_re
+        self.assertIsNotNone(r.match('10(sp)'))
+        self.assertIsNotNone(r.match('-10(sp)'))
+        self.assertIsNotNone(r.match('(sp)'))
+        self.assertIsNone(r.match('hoge'))
+        self.assertIsNone(r.match('100'))
+
+    def test_displacement_values(self):
+        m = displacement_re.match('-18(sp)')
+        self.assertIsNotNone(m)
+        offset = m.group('offset')
+        reg = m.group('reg')
+        self.assertEqual(offset, '-18')
+        self.assertEqual(reg, 'sp')
+
+        m = displacement_re.match('(t1)')
+        self.assertIsNotNone(m)
+        offset = m.group('offset')
+        reg = m.group('reg')
+        self.assertEqual(offset, '')
+        self.assertEqual(reg, 't1')
+
+    def test_match_dislacement_func(self):
+        self.assertEqual(match_displacement('-18(sp)'), ('sp', '-18'))
+        self.assertEqual(match_displacement('(t10)'), ('t10', '0'))
+        self.assertIsNone(match_displacement('t10'))
+
+
+op_name_re = r'(?P<op_name>[a-zA-Z_](\w|\.)*)'
+args_re = r'(?P<args>(((-|\w|\.|%|\(|\))+,)\s*)*(-|\w|\.|%|\(|\))+)?'  # 若干雑だが
+comment_q = r'(#.*)?'
+spaces = r'\s+'
+spaces_star = r'\s*'
+space_args = '(' + spaces+args_re + ')'
+no_args = spaces_star
+args = '(' + space_args + '|' + no_args + ')'
+r = ''.join([
+    spaces_star,
+    tag_re,
+    '?',
+    spaces_star,
+    op_name_re,
+    args,
+    spaces_star,
+    comment_q,
+    spaces_star,
+    '$'
+])
+op_pat = re.compile(r)
+
+
+class TestOperationRegex(unittest.TestCase):
+    ''' does regex work correctly? '''
+
+    def test_op_name_re(self):
+        r = re.compile(op_name_re + '$')  # $はとりあえず仕方なく
+        self.assertIsNotNone(r.match('mov'))
+        self.assertIsNotNone(r.match('MOV'))
+        self.assertEqual(r.match('mov').group('op_name'), 'mov')
+        self.assertIsNone(r.match('0'))
+        self.assertIsNone(r.match(' mov'))
+
+    def test_args_re(self):
+        r = re.compile(args_re + '$')
+        self.assertIsNotNone(r.match('a, b, c, d, e,f,\tg, h'))
+        self.assertIsNotNone(r.match('hoge'))
+        self.assertIsNotNone(r.match(''))
+        self.assertIsNotNone(r.match(r'%lo(msg)'))
+        self.assertIsNone(r.match('a b c d'))
+        self.assertIsNone(r.match('hoge,'))
+
+    def test_all(self):
+        self.assertIsNotNone(op_pat.match(
+            'addi a1, a1,  %lo(msg)       # load msg(lo)'))
+        self.assertIsNotNone(op_pat.match('jalr ra, puts'))
+        self.assertIsNone(op_pat.match('_start:'))
+        self.assertIsNotNone(op_pat.match(
+            '1:	    auipc a1,     %pcrel_hi(msg) # load msg(hi)'))
+        self.assertIsNotNone(op_pat.match(
+            'ret'
+        ))
+        self.assertIsNone(op_pat.match('.globl _start'))
+        self.assertIsNotNone(op_pat.match('	flw	fa5,%lo(.LC1)(a5)'))
+
+        m = op_pat.match('hoge: jalr ra, puts')
+        self.assertEqual(m.group('tag_name'), 'hoge')
+        self.assertEqual(m.group('op_name'), 'jalr')
+        self.assertEqual(m.group('args'), 'ra, puts')
+
+# データの指示 (.word, .space など)。引数の書き方は命令と同じ
+directive_name_re = r'(?P<op_name>\.[a-zA-Z_](\w|\.)*)'
+r = ''.join([
+    spaces_star,
+    tag_re,
+    '?',
+    spaces_star,
+    directive_name_re,
+    args,
+    spaces_star,
+    comment_q,
+    spaces_star,
+    '$'
+])
+directive_pat = re.compile(r)
+
+
+class TestDirectiveRegex(unittest.TestCase):
+    def test_directive(self):
+        m = directive_pat.match('table: .word 0x10, -1 # c')
+        self.assertEqual(m.group('tag_name'), 'table')
+        self.assertEqual(m.group('op_name'), '.word')
+        self.assertEqual(m.group('args'), '0x10, -1')
+        self.assertIsNotNone(directive_pat.match('\t.text'))
+        self.assertIsNone(directive_pat.match('\t.file "a.c"'))
+        self.assertIsNone(directive_pat.match('add a0, a1, 1'))
+
+
+# 古い書き方の .word (10進数一つ)。'.' が任意の一文字なのもそのまま
+dec_num = r'(-?[1-9][0-9]*|0)'
+number = r'(?P<value>' + dec_num + ')'
+r = ''.join([
+    '^',
+    spaces_star,
+    tag_re,
+    '?',
+    spaces_star,
+    '.word',
+    spaces,
+    number,
+    spaces_star,
+    comment_q,
+    spaces_star,
+    '$'
+])
+const_pat = re.compile(r)
+
+
+class TestConstantRegex(unittest.TestCase):
+    def test_constant(self):
+        self.assertIsNotNone(const_pat.match('hoge:\t.word	1075838976'))
+        self.assertIsNotNone(const_pat.match('\t.word       0 #zero'))
+        self.assertIsNone(const_pat.match('hoge: jalr ra, puts'))
+
+        m = const_pat.match('\t.word\t1075838976')
+        self.assertEqual(m.group('value'), '1075838976')
+
+
+class Inst:
+    __slots__ = ('op', 'args', 'refs', 'tag', 'source', 'lineno')
+
+    def __init__(self, op, args, tag, source, lineno):
+        self.op = op
+        self.args = args
+        self.refs = None
+        self.tag = tag
+        self.source = source
+        self.lineno = lineno
+
+        if args and op is not None and op.directive is None:
+            regs = utils.regs
+            refs = [i for (i, arg) in enumerate(args)
+                    if arg not in regs and not utils.is_special(arg)]
+            if refs:
+                self.refs = tuple(refs)
+
+    def __reduce__(self):
+        # 別プロセスに送るときは、Op をその名前で送る
+        name = None if self.op is None else self.op.name
+        return (_restore, (name, self.args, self.refs, self.tag,
+                           self.source, self.lineno))
+
+    def __str__(self):
+        s = ''
+        if self.tag is not None:
+            s = self.tag + ': '
+        if self.op is not None:
+            s += '{} {}'.format(self.op.name, ', '.join(self.args))
+        return s
+
+
+def _restore(name, args, refs, tag, source, lineno):
+    op = None if name is None else optable.table[name]
+    inst = Inst(op, None, tag, source, lineno)
+    inst.args = args
+    inst.refs = refs
+    return inst
+
+
+def error_line(source, lineno, line):
+    print('エラーの発生した行: {}:{}: {}'.format(source, lineno, line))
+
+
+def split_args(args):
+    ret = []
+    for arg in args:
+        r = None if arg[-1:] != ')' else match_displacement(arg)
+        if r is not None:
+            # 再帰的にパターンが存在するかを（一応）確認する
+            ret += split_args(r)
+        else:
+            ret.append(arg)
+    return ret
+
+
+def parse(lines, source='', start=1, verbose=False):
+    insts = []
+    table = optable.table
+    for (lineno, line) in enumerate(lines, start):
+        s = line.strip()
+        (tag, name, args) = lexer.lex(s)
+
+        if tag is not None and utils.is_reservations(tag):
+            error_line(source, lineno, s)
+            print('{} は予約語です'.format(tag))
+            raise Exception('Name error')
+
+        op = None
+        if name is not None and name[0] == '.':
+            # 知らない指示は None のまま (無視する)
+            op = table.get(name)
+            if op is None:
+                args = None
+            else:
+                try:
+                    op.directive.check(name, args)
+                except Exception as e:
+                    error_line(source, lineno, s)
+                    raise e
+        elif name is not None:
+            try:
+                op = optable.lookup(name, args)
+            except Exception as e:
+                error_line(source, lineno, s)
+                raise e
+            for arg in args:
+                if arg[-1:] == ')':
+                    args = split_args(args)
+                    break
+
+        if tag is None and op is None:
+            if verbose:
+                print('{} is ignored'.format(s))
+            continue
+        insts.append(Inst(op, args, tag, source, lineno))
+    return insts
+
+
+class TestParse(unittest.TestCase):
+    def test_parse(self):
+        l = parse([
+            '\t.text',
+            'fib.1:',
+            '\tsw\tra, 24(sp)',
+            'hoge: li a0, fib.1 # comment',
+            '\t.word\t-1',
+            '\tadd a0, a1, 0',
+        ], 'test.s')
+        self.assertEqual(len(l), 5)
+        self.assertEqual((l[0].tag, l[0].op, l[0].lineno), ('fib.1', None, 2))
+        self.assertEqual(l[1].op.name, 'sw')
+        self.assertEqual(l[1].args, ['ra', 'sp', '24'])
+        self.assertIsNone(l[1].refs)
+        self.assertEqual((l[2].tag, l[2].op.name, l[2].refs), ('hoge', '_li', (1,)))
+        self.assertEqual((l[3].op.name, l[3].args), ('.word', ['-1']))
+        self.assertEqual(l[4].op.name, '_add')
+        l = parse(['\t.globl f', 'x: .space 0x10, 1', '\t.float 1.5, 2'])
+        self.assertEqual([(i.tag, i.op.name, i.args, i.refs) for i in l],
+                         [('x', '.space', ['0x10', '1'], None),
+                          (None, '.float', ['1.5', '2'], None)])
+
+    def test_pickle(self):
+        import pickle
+        (inst,) = parse(['hoge: li a0, fib.1'], 'test.s')
+        r = pickle.loads(pickle.dumps(inst))
+        self.assertIs(r.op, inst.op)
+        for name in Inst.__slots__[1:]:
+            self.assertEqual(getattr(r, name), getattr(inst, name))
+
+    def test_parse_error(self):
+        with self.assertRaises(Exception):
+            parse(['hoge a0, a1'])
+        with self.assertRaises(Exception):
+            parse(['ra: nop'])
+        with self.assertRaises(Exception):
+            parse(['.space x'])
@@ -0,0 +1,214 @@
+'''
+ # 字句解析
+
+ 一行を左から一度だけ見て、タグ・命令名 (か指示の名前)・引数に分ける。
+ ir の tag_pat / op_pat / directive_pat / const_pat と同じ行を受け付け、同じ結果を返す
+ (正規表現は文法の定義とテストのために ir に残してある)。
+
+ - タグ: 行頭の [_|\\w.]* の後に ':'
+ - 命令: [a-zA-Z_] で始まり (\\w|.)* が続く名前。引数は空白を空けて、
+   (-|\\w|.|%|(|))+ を ',' (後ろに空白があってもよい) で区切ったもの
+ - 指示: '.' の後に命令と同じ名前。引数も命令と同じ
+ - .word: 上のどれにもならない行で、'.word' の後に空白と10進数一つ (古い書き方)
+ - どれの後にも '#' からのコメントを置ける
+
+ 一文字ずつ Python で見ると正規表現より遅いので、区切り (':', '#', 空白, ',') は
+ str の find / split で探し、切り出した語の文字種は記号を消してから isalnum で確かめる。
+ ASCII 以外の文字を含む語だけ一文字ずつ見る。
+
+ どれにもならない行 (書式の崩れた行) は命令名と引数が None になる。
+ .globl のような知らない指示を無視するのは ir.parse。
+'''
+
+import unittest
+
+
+# 語に使える記号。UTF-8 にしてから消し、残りを bytes.isalnum (ASCII だけ) で確かめる
+_tag_marks = b'_|.'
+_name_marks = b'_.'
+_arg_marks = b'_-.%()'
+_args_marks = b'_-.%(),'
+_name_start = frozenset('abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ_')
+
+
+def _is_word(s, marks, extra):
+    ''' s が \\w と extra の文字だけでできているか (空でもよい) '''
+    b = s.encode().translate(None, marks)
+    if not b or b.isalnum():
+        return True
+    if s.isascii():
+        return False
+    return all(c.isalnum() or c == '_' or c in extra for c in s)
+
+
+def _is_dec(s):
+    ''' -?[1-9][0-9]*|0 '''
+    t = s[1:] if s[:1] == '-' else s
+    if not (t.isascii() and t.isdigit()):
+        return False
+    return t[0] != '0' or s == '0'
+
+
+def tag(s):
+    ''' 行頭のタグ。無ければ None '''
+    s = s.lstrip()
+    j = s.find(':')
+    if j < 0:
+        return None
+    t = s[:j]
+    if _is_word(t, _tag_marks, '|.'):
+        return t
+    return None
+
+
+def split_args(rest):
+    ''' 命令名の後ろ (前後の空白とコメントは除いたもの) を引数に分ける。書式が合わなければ None '''
+    # ',' の後ろにだけ空白を置ける。それ以外の空白は語の中に残るので下で弾かれる
+    r = rest.replace(', ', ',')
+    # よくある書き方 ('a0, a1, 4(sp)') はまとめて確かめる
+    if r.encode().translate(None, _args_marks).isalnum():
+        args = r.split(',')
+        if '' in args:
+            return None
+        return args
+    args = [a.lstrip() for a in rest.split(',')]
+    if '' in args or not _is_word(''.join(args), _arg_marks, '-.%()'):
+        return None
+    return args
+
+
+def _constant(body):
+    ''' .word の値か None '''
+    # 正規表現では '.word' の '.' は改行以外の任意の一文字
+    if body[1:5] != 'word' or body[:1] == '\n':
+        return None
+    rest = body[5:]
+    value = rest.lstrip()
+    if value == rest or not _is_dec(value):
+        return None
+    return value
+
+
+def lex(s):
+    '''
+    (タグ, 命令名, 引数) を返す。指示の行は命令名が '.word' などの指示の名前。
+    命令でも指示でもなければ命令名と引数は None
+    '''
+    body = s.strip()
+    # 引数にもタグにも '#' は使えないので、最初の '#' からはコメント
+    if '#' in body:
+        body = body[:body.index('#')].rstrip()
+
+    t = None
+    if ':' in body:
+        j = body.index(':')
+        head = body[:j]
+        if _is_word(head, _tag_marks, '|.'):
+            t = head
+            body = body[j + 1:].lstrip()
+
+    l = body.split(None, 1)
+    if l:
+        name = l[0]
+        if (name.isidentifier() and name.isascii()) or (
+                name[0] in _name_start and _is_word(name, _name_marks, '.')) or (
+                name[0] == '.' and name[1:2] in _name_start
+                and _is_word(name, _name_marks, '.')):
+            if len(l) == 1:
+                return (t, name, [])
+            args = split_args(l[1])
+            if args is not None:
+                return (t, name, args)
+
+    v = _constant(body)
+    if v is not None:
+        return (t, '.word', [v])
+    return (t, None, None)
+
+
+def displacement(arg):
+    ''' '4(sp)' を ('sp', '4') に、'(sp)' を ('sp', '0') にする。変位指定でなければ None '''
+    if arg[-1:] != ')':
+        return None
+    i = arg.find('(')
+    if i < 0 or i == len(arg) - 2 or '\n' in arg:
+        return None
+    offset = arg[:i]
+    if offset == '':
+        offset = '0'
+    else:
+        t = offset[1:] if offset[0] == '-' else offset
+        if not t.isdecimal():
+            return None
+    return (arg[i + 1:-1], offset)
+
+
+class TestLexer(unittest.TestCase):
+    # ir の正規表現のテストと同じ行
+    def test_operation(self):
+        self.assertEqual(lex('addi a1, a1,  %lo(msg)       # load msg(lo)'),
+                         (None, 'addi', ['a1', 'a1', '%lo(msg)']))
+        self.assertEqual(lex('jalr ra, puts'), (None, 'jalr', ['ra', 'puts']))
+        self.assertEqual(lex('_start:'), ('_start', None, None))
+        self.assertEqual(lex('1:	    auipc a1,     %pcrel_hi(msg) # load msg(hi)'),
+                         ('1', 'auipc', ['a1', '%pcrel_hi(msg)']))
+        self.assertEqual(lex('ret'), (None, 'ret', []))
+        self.assertEqual(lex('.globl _start'), (None, '.globl', ['_start']))
+        self.assertEqual(lex('	flw	fa5,%lo(.LC1)(a5)'), (None, 'flw', ['fa5', '%lo(.LC1)(a5)']))
+        self.assertEqual(lex('hoge: jalr ra, puts'), ('hoge', 'jalr', ['ra', 'puts']))
+        self.assertEqual(lex('a b c d'), (None, None, None))
+        self.assertEqual(lex('hoge a,'), (None, None, None))
+
+    def test_constant(self):
+        self.assertEqual(lex('hoge:\t.word	1075838976'), ('hoge', '.word', ['1075838976']))
+        self.assertEqual(lex('\t.word       0 #zero'), (None, '.word', ['0']))
+        self.assertEqual(lex('\t.word\t-12'), (None, '.word', ['-12']))
+        self.assertEqual(lex('\t.word\t012'), (None, '.word', ['012']))
+        self.assertEqual(lex('x: .space 0x10, 1'), ('x', '.space', ['0x10', '1']))
+        self.assertEqual(lex('\t.float -1.5e-3'), (None, '.float', ['-1.5e-3']))
+        self.assertEqual(lex('$word 5'), (None, '.word', ['5']))
+        self.assertEqual(lex('.1word 5'), (None, None, None))
+
+    def test_displacement(self):
+        self.assertEqual(displacement('-18(sp)'), ('sp', '-18'))
+        self.assertEqual(displacement('(t10)'), ('t10', '0'))
+        self.assertEqual(displacement('%lo(x)(a5)'), None)
+        self.assertEqual(displacement('4((sp))'), ('(sp)', '4'))
+        self.assertIsNone(displacement('t10'))
+        self.assertIsNone(displacement('4()'))
+
+    def test_same_as_regex(self):
+        import ir
+        from bench import gen
+        lines = gen.generate(2000).splitlines() + [
+            'ret#c', 'ret #c', 'ret x y', 'ret(x)', 'a:b c', ': nop', 'x|y: nop',
+            'add a0 , a1', 'add a0,a1', 'add\ta0,\ta1', 'nop:', 'hoge: .globl x',
+            '.word 5 6', '.word -0', 'xword 3', '.L1: .word 3', 'sw ra, -4(sp)',
+            'fib.1: add x1, x2, 3 # c: d', '', '#only', 'ナ: nop', 'nop ナ', 'nop ナ,b',
+            'x#y: nop', 'a: b: nop', ':word 5', 'nop a,,b', 'nop ,a', '.word\t5#c',
+            '.word#c 5', 'hoge:#c', 'x$: nop', 'add a0, a1 ,a2', 'ADD A0', '_x.y z.w',
+            '.space 0x10, 1', '.globl _min_caml_start', '.text', '..x 1', '.x.y 1', '. word 1',
+            '.float 1.5e-3', '.word 1 ,2', '.ナ 1', 'x: .byte 1,2', '.fill 3, 4, -1 #c',
+        ]
+        for line in lines:
+            s = line.strip()
+            m = ir.tag_pat.match(s)
+            t = None if m is None else m.group('tag_name')
+            m = ir.op_pat.match(s) or ir.directive_pat.match(s)
+            if m is not None:
+                g = m.group('args')
+                args = [] if g is None else g.replace(' ', '').replace('\t', '').split(',')
+                expected = (t, m.group('op_name'), args)
+            else:
+                m = ir.const_pat.match(s)
+                if m is not None:
+                    expected = (t, '.word', [m.group('value')])
+                else:
+                    expected = (t, None, None)
+            self.assertEqual(lex(s), expected, line)
+            self.assertEqual(tag(s), t, line)
+            for arg in expected[2] or []:
+                m = ir.displacement_re.match(arg)
+                if m is not None:
+                    m = (m.group('reg'), m.group('offset') or '0')
+                self.assertEqual(displacement(arg), m, arg)
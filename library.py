@@ -0,0 +1,251 @@
+'''
+ # libmincaml
+
+ ## 探し方
+
+ `--lib` で指定されたファイル、無ければ環境変数 ASM_LIB_PATH (os.pathsep 区切り) に並んだ
+ ディレクトリかファイル、../compiler/、このリポジトリの compiler/ (submodule) の順に
+ libmincaml.S を探す。見つかったものはキャッシュディレクトリにチェックサムと一緒に
+ コピーしておき、どこにも見つからないときはチェックサムが合っていればそれを使う。
+ ネットワークには一切アクセスしない。
+
+ ## リンク済みイメージ
+
+ libmincaml.S はビルドのたびに変わるものではないので、毎回アセンブルし直すのは無駄。
+ `--lib-base` でライブラリを固定のアドレスに置くことにすれば、ライブラリ単体で
+ アセンブルした結果(機械語とタグの表)はユーザーのプログラムによらず同じになる。
+ これをキャッシュしておき、次からはファイルを読んでイメージの末尾に貼り付けるだけにする。
+
+ キャッシュのキーは、ライブラリの中身・置くアドレス・アセンブラ自身のソース (このディレクトリの
+ *.py 全部) のハッシュ。エンコーダだけでなくパーサや配置を直しても勝手に作り直される。
+'''
+
+import hashlib
+import json
+import os
+import tempfile
+import unittest
+
+
+lib_name = 'libmincaml.S'
+repo_dir = os.path.dirname(os.path.abspath(__file__))
+
+cache_dir = os.environ.get(
+    'ASM_CACHE_DIR',
+    os.path.join(os.path.expanduser('~'), '.cache', 'cpu3-asm'))
+
+
+
+def tool_files():
+    ''' アセンブル結果に影響しうるファイル。どれが効くかを選ぶと漏れるので *.py 全部 '''
+    return sorted(name for name in os.listdir(repo_dir) if name.endswith('.py'))
+
+
+def search_path():
+    l = []
+    env = os.environ.get('ASM_LIB_PATH')
+    if env:
+        l += [p for p in env.split(os.pathsep) if p]
+    l.append(os.path.join('..', 'compiler'))
+    l.append(os.path.join(repo_dir, 'compiler'))
+    return l
+
+
+def sha256(data):
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+def read(path, verbose=False):
+    with open(path) as f:
+        if verbose:
+            print('{}: reading from {}'.format(lib_name, path))
+        return f.read()
+
+
+def remember(data):
+    ''' 見つけたライブラリをキャッシュディレクトリに置いておく '''
+    path = os.path.join(cache_dir, lib_name)
+    if cached() == data:
+        return
+    os.makedirs(cache_dir, exist_ok=True)
+    _write(path, data.encode('utf-8'))
+    _write(path + '.sha256', sha256(data).encode('ascii'))
+
+
+def cached():
+    ''' キャッシュディレクトリのコピーを、チェックサムが合うときだけ返す '''
+    path = os.path.join(cache_dir, lib_name)
+    try:
+        with open(path) as f:
+            data = f.read()
+        with open(path + '.sha256') as f:
+            checksum = f.read().strip()
+    except OSError:
+        return None
+    if sha256(data) != checksum:
+        print('{} のチェックサムが一致しないので使いません'.format(path))
+        return None
+    return data
+
+
+def find(path=None, verbose=False):
+    ''' libmincaml.S を探して中身を返す '''
+    if path is not None:
+        if not os.path.isfile(path):
+            print('{} が見つかりません'.format(path))
+            raise Exception('Library Not Found')
+        return read(path, verbose)
+
+    for p in search_path():
+        if os.path.isdir(p):
+            p = os.path.join(p, lib_name)
+        if os.path.isfile(p):
+            data = read(p, verbose)
+            try:
+                remember(data)
+            except OSError:
+                pass
+            return data
+
+    data = cached()
+    if data is not None:
+        if verbose:
+            print('{}: reading from {}'.format(lib_name, cache_dir))
+        return data
+
+    print('{} が見つかりません。--lib で指定するか、ASM_LIB_PATH を設定してください'.format(lib_name))
+    print('  探した場所: {}'.format(', '.join(search_path() + [cache_dir])))
+    raise Exception('Library Not Found')
+
+
+def tool_hash():
+    h = hashlib.sha256()
+    for name in tool_files():
+        h.update(name.encode('utf-8') + b'\0')
+        with open(os.path.join(repo_dir, name), 'rb') as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+
+def cache_key(lib_data, base):
+    h = hashlib.sha256()
+    h.update(lib_data.encode('utf-8'))
+    h.update('@{:x}'.format(base).encode('ascii'))
+    h.update(tool_hash().encode('ascii'))
+    return h.hexdigest()
+
+
+def cache_path(key):
+    return os.path.join(cache_dir, key[:32])
+
+
+def load(key):
+    ''' キャッシュがあれば (image, tags) を、無いか壊れていれば None を返す '''
+    path = cache_path(key)
+    try:
+        with open(path + '.json') as f:
+            header = json.load(f)
+        with open(path + '.bin', 'rb') as f:
+            image = f.read()
+    except (OSError, ValueError):
+        return None
+
+    if header.get('key') != key:
+        return None
+    if hashlib.sha256(image).hexdigest() != header.get('sha256'):
+        return None
+    return (image, header['tags'])
+
+
+def _write(path, data):
+    # 途中で止まっても壊れたファイルが残らないようにする
+    fd, tmp = tempfile.mkstemp(dir=cache_dir)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def store(key, image, tags):
+    os.makedirs(cache_dir, exist_ok=True)
+    path = cache_path(key)
+    header = {
+        'key': key,
+        'size': len(image),
+        'sha256': hashlib.sha256(image).hexdigest(),
+        'tags': tags,
+    }
+    _write(path + '.bin', bytes(image))
+    _write(path + '.json', json.dumps(header).encode('utf-8'))
+
+
+class TestCache(unittest.TestCase):
+    def setUp(self):
+        global cache_dir
+        self.saved = cache_dir
+        self.tmp = tempfile.TemporaryDirectory()
+        cache_dir = self.tmp.name
+
+    def tearDown(self):
+        global cache_dir
+        cache_dir = self.saved
+        self.tmp.cleanup()
+
+    def test_key(self):
+        k = cache_key('nop\n', 0x1000)
+        self.assertEqual(k, cache_key('nop\n', 0x1000))
+        self.assertNotEqual(k, cache_key('nop\n', 0x2000))
+        self.assertNotEqual(k, cache_key('ret\n', 0x1000))
+
+    def test_tool_change(self):
+        # パーサや配置 (assembler.py, ir.py など) を変えても別のキーになる
+        global repo_dir
+        import shutil
+        saved = repo_dir
+        d = os.path.join(self.tmp.name, 'src')
+        os.mkdir(d)
+        for name in tool_files():
+            shutil.copy(os.path.join(repo_dir, name), d)
+        repo_dir = d
+        try:
+            k = cache_key('nop\n', 0x1000)
+            for name in ['assembler.py', 'ir.py', 'lexer.py', 'main.py']:
+                self.assertIn(name, tool_files())
+                with open(os.path.join(d, name), 'a') as f:
+                    f.write('\n')
+                self.assertNotEqual(cache_key('nop\n', 0x1000), k)
+                k = cache_key('nop\n', 0x1000)
+        finally:
+            repo_dir = saved
+
+    def test_roundtrip(self):
+        key = cache_key('nop\n', 0x1000)
+        self.assertIsNone(load(key))
+        store(key, b'\x13\x00\x00\x00', {'hoge': 0x400})
+        self.assertEqual(load(key), (b'\x13\x00\x00\x00', {'hoge': 0x400}))
+
+    def test_find(self):
+        d = os.path.join(self.tmp.name, 'lib')
+        os.mkdir(d)
+        with open(os.path.join(d, lib_name), 'w') as f:
+            f.write('ret\n')
+        saved = os.environ.get('ASM_LIB_PATH')
+        os.environ['ASM_LIB_PATH'] = d
+        try:
+            self.assertEqual(find(), 'ret\n')
+        finally:
+            if saved is None:
+                del os.environ['ASM_LIB_PATH']
+            else:
+                os.environ['ASM_LIB_PATH'] = saved
+        self.assertEqual(cached(), 'ret\n')
+
+        with open(os.path.join(cache_dir, lib_name), 'w') as f:
+            f.write('nop\n')
+        self.assertIsNone(cached())
+
+    def test_corrupted(self):
+        key = cache_key('nop\n', 0x1000)
+        store(key, b'\x13\x00\x00\x00', {})
+        with open(cache_path(key) + '.bin', 'wb') as f:
+            f.write(b'\x00')
+        self.assertIsNone(load(key))
@@ -3,15 +3,19 @@
  # ** instant ** assembler implementation
 
  ## 全体の構成
- fileを二回りするような実装。前提として一命令が4byteで構成されている。
+ 本体は assembler.Assembler。このファイルはコマンドラインと書き出しだけを受け持つ。
+
+ fileを一回りするような実装。前提として一命令が4byteで構成されている。
  一般にアセンブラは、.s -> .oの変換を行い、.oファイルたちをリンカがリンクする
  というのが一般的だが、ファイルが複数になることはなさそうなことと、まぁそれほど
  大規模なプログラムはコンパイルしないだろうということ、命令の長さが決まっていることや
  展開される場所が決まっていることから、まぁ、こういう構成でええやろみたいな判断
 
- 1. タグを前から探していき、その位置を記録する
- 2. 前から順に、アセンブリを機械語に変換する。このとき、jmp命令の即値は
-   適切に書き換える
+ 0. ソースは ir.parse で一度だけ中間表現(ir.Inst の列)にする。以降はこれだけを見る
+ 1. 前から順に、タグの位置を記録しつつアセンブリを機械語に変換してバッファに積む。
+   まだ位置の分からないタグを参照した命令は、即値を0にしておいてfixupとして記録する
+ 2. 最後まで読んでタグが出揃ったら、fixupの命令だけをもう一度変換してバッファを書き換える
+   (命令の長さはタグの値によらないので、上書きしても位置はずれない)
 
  ## Prologue
 
@@ -30,724 +34,251 @@
 
 import argparse
 import os
-import re
+import sys
 import unittest
 
-import asmgen
-import extension
-import heap
-import hook
-import utils
-
-
-read_bytes = 0
-emit_coe = False
-tags = {}  # map[tag]int
-use_place_holder = True
-
-__builtin_stack_init = (0xf4240 - 4) // 4
-__builtin_heap_init =   0x25000 //4
-
-program_start = 456 * 4
-
-tags['__builtin_stack_init'] = __builtin_stack_init
-tags['__builtin_heap_init'] = __builtin_heap_init
-
-prologue = '''\
-li sp, __builtin_stack_init
-li hp, __builtin_heap_init
-j _min_caml_start
-'''
-
-epilogue = '''
-li a0, __builtin_heap_init
-jalr x0, a0, -1
-'''
-
-debug = True
-
-tag_re = r'((?P<tag_name>[_|\w|.]*):)'
-r = r'^\s*' + tag_re + r'.*$'
-tag_pat = re.compile(r)
-
-lib_data = ''
-
-
-def error_line(line):
-    print('エラーの発生した行: {}'.format(line))
-
-
-def parse_tag_line(s):
-    m = tag_pat.match(s)
-    if m is not None:
-        if utils.is_reservations(s):
-            print('{} は予約語です'.format(s))
-            raise Exception('Name error')
-        name = m.group('tag_name')
-        if name in tags:
-            #raise Exception('Collision occurred: {}'.format(name))
-            pass
-        tags[m.group('tag_name')] = read_bytes // 4
-
-
-def _solve_tag(name):
-    if use_place_holder:
-        return 0
-
-    if name not in tags:
-        print(name, hex(heap.get(name)))
-        return heap.get(name) // 4
-        #print('{} は見つかりませんでした。'.format(name))
-        #raise Exception('Tag is not found')
-    addr = tags[name]
-    return addr
-
-
-def solve_tag_relative(name):
-    return str(_solve_tag(name) - read_bytes//4)
-
-
-def solve_tag_absolute(name):
-    return str(_solve_tag(name))
-
-
-def check_args(name, args, length):
-    if (len(args) == length):
-        if (debug):
-            print('{}: {}, {}'.format(hex(read_bytes // 4)[2:], name, ','.join(args)))
-        return
-
-    print('{} should have {} args. But got {}'.format(name, length, len(args)))
-    print('  -> {} {}', name, ','.join(args))
-    raise(Exception('Syntax Error'))
-
-
-displacement_res = r'^(?P<offset>(-?\d+)?)\((?P<reg>.+)\)$'
-displacement_re = re.compile(displacement_res)
-
-
-def match_displacement(s):
-    m = displacement_re.match(s)
-    if m is None:
-        return None
-
-    offset = m.group('offset')
-    reg = m.group('reg')
-
-    if offset == '':
-        return (reg, '0')
-    else:
-        return (reg, offset)
-
-
-class TestDisplacementRegex(unittest.TestCase):
-    ''' Does displacement regex work correctly? '''
-
-    def test_displacement_match(self):
-        r = displacement_re
-        self.assertIsNotNone(r.match('10(sp)'))
-        self.assertIsNotNone(r.match('-10(sp)'))
-        self.assertIsNotNone(r.match('(sp)'))
-        self.assertIsNone(r.match('hoge'))
-        self.assertIsNone(r.match('100'))
-
-    def test_displacement_values(self):
-        m = displacement_re.match('-18(sp)')
-        self.assertIsNotNone(m)
-        offset = m.group('offset')
-        reg = m.group('reg')
-        self.assertEqual(offset, '-18')
-        self.assertEqual(reg, 'sp')
-
-        m = displacement_re.match('(t1)')
-        self.assertIsNotNone(m)
-        offset = m.group('offset')
-        reg = m.group('reg')
-        self.assertEqual(offset, '')
-        self.assertEqual(reg, 't1')
-
-    def test_match_dislacement_func(self):
-        self.assertEqual(match_displacement('-18(sp)'), ('sp', '-18'))
-        self.assertEqual(match_displacement('(t10)'), ('t10', '0'))
-        self.assertIsNone(match_displacement('t10'))
-
-
-def handle_args(args, relative=True):
-    ret = []
-    for arg in args:
-        r = match_displacement(arg)
-        if r is not None:
-            # 再帰的にパターンが存在するかを（一応）確認する
-            l = handle_args(r)
-            ret += l
-        elif not utils.is_special(arg):
-            if relative:
-                ret.append(solve_tag_relative(arg))
-            else:
-                ret.append(solve_tag_absolute(arg))
-        else:
-            ret.append(arg)
-    return ret
-
-
-def handle_hooked_instructions(name, arguments):
-    args = handle_args(arguments, True)
-    aargs = handle_args(arguments, False)
-    if name == '_jal':
-        check_args(name, args, 1)
-        return hook.jal(args[0])
-    elif name == '_jalr':
-        check_args(name, args, 1)
-        return hook.jalr(args[0])
-    elif name == '_li':
-        check_args(name, aargs, 2)
-        return hook.li(aargs[0], aargs[1])
-    elif name == '_add':
-        check_args(name, args, 3)
-        return hook.add(args[0], args[1], args[2])
-    elif name == '_sub':
-        check_args(name, args, 3)
-        return hook.sub(args[0], args[1], args[2])
-    else:
-        return None
-
-
-def hook_instructions(name, args):
-    if name == 'jal':
-        if len(args) == 1:
-            return '_jal'
-        else:
-            return name
-    elif name == 'jalr':
-        if len(args) == 1:
-            return '_jalr'
-        else:
-            return name
-    elif name == 'li':
-        if len(args) == 2 and utils.is_number(args[1]):
-            return name
-        else:
-            return '_li'
-    elif name == 'add':
-        if len(args) == 3 and utils.is_number(args[2]):
-            return '_add'
-        else:
-            return name
-    elif name == 'sub':
-        if len(args) == 3 and utils.is_number(args[2]):
-            return '_sub'
-        else:
-            return name
+import formats
+import library
+import stats
+from assembler import Assembler
+
+
+def output_path(pattern, filename, fmt='raw'):
+    (d, name) = os.path.split(filename)
+    (stem, _) = os.path.splitext(name)
+    ext = formats.lookup(fmt).ext
+    return pattern.format(dir=d or '.', name=name, stem=stem, ext=ext)
+
+
+def read_manifest(path):
+    l = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                l.append(line)
+    return l
+
+
+# バッチのワーカープロセスごとのアセンブラ
+_worker = None
+
+
+def init_worker(lib, lib_base, use_lib_cache, optimize=False, prune_lib=True):
+    global _worker
+    _worker = Assembler(lib=lib, lib_base=lib_base, use_lib_cache=use_lib_cache,
+                        optimize=optimize, prune_lib=prune_lib)
+    _worker.preload()
+
+
+def assemble_job(job):
+    ''' 一つのプログラムをアセンブルして書き出す。(入力, 出力, 大きさ, エラー) を返す '''
+    import contextlib
+    import io
+    (filename, output, prologue, fmt) = job
+    log = io.StringIO()
+    try:
+        with contextlib.redirect_stdout(log):
+            image = _worker.assemble_file(filename, prologue=prologue)
+            formats.write(output, image, fmt)
+    except Exception as e:
+        l = log.getvalue().splitlines()[-5:]
+        l.append('{}: {}'.format(type(e).__name__, e))
+        return (filename, output, None, '\n'.join(l))
+    return (filename, output, len(image), None)
+
+
+def run_batch(asm, jobs, n):
+    import time
+    t = time.perf_counter()
+    lib = asm.get_lib_data()
+    init_worker(lib, asm.lib_base, asm.use_lib_cache, asm.optimize, asm.prune_lib)
+
+    if n == 1:
+        results = map(assemble_job, jobs)
+        pool = None
     else:
-        return name
-
-
-def handle_extension(name, arguments):
-    args = handle_args(arguments, True)
-    if name == 'nop':
-        check_args(name, args, 0)
-        return extension.nop()
-    elif name == 'li':
-        check_args(name, args, 2)
-        return extension.li(args[0], args[1])
-    elif name == 'mv':
-        check_args(name, args, 2)
-        return extension.mv(args[0], args[1])
-    elif name == 'bgt':
-        check_args(name, args, 3)
-        return extension.bgt(args[0], args[1], args[2])
-    elif name == 'ble':
-        check_args(name, args, 3)
-        return extension.ble(args[0], args[1], args[2])
-    elif name == 'bgtu':
-        check_args(name, args, 3)
-        return extension.bgtu(args[0], args[1], args[2])
-    elif name == 'bleu':
-        check_args(name, args, 3)
-        return extension.bleu(args[0], args[1], args[2])
-    elif name == 'bnei':
-        check_args(name, args, 3)
-        return extension.bnei(args[0], args[1], args[2])
-    elif name == 'j':
-        check_args(name, args, 1)
-        return extension.jump(args[0])
-    elif name == 'jl':
-        check_args(name, args, 1)
-        return extension.jumpl(args[0])
-    elif name == 'jr':
-        check_args(name, args, 1)
-        return extension.jr(args[0])
-    elif name == 'jrl':
-        check_args(name, args, 1)
-        return extension.jrl(args[0])
-    elif name == 'ret':
-        check_args(name, args, 0)
-        return extension.ret()
-    elif name == 'call':
-        check_args(name, args, 1)
-        return extension.call(args[0])
-    elif name == 'tail':
-        check_args(name, args, 1)
-        return extension.tail(args[0])
-    elif name == 'subi':
-        check_args(name, args, 3)
-        return extension.subi(args[0], args[1], args[2])
-    elif name == 'fmv.s':
-        check_args(name, args, 2)
-        return extension.fmv(args[0], args[1])
-    elif name == 'fneg.s':
-        check_args(name, args, 2)
-        return extension.fneg(args[0], args[1])
-    elif name == 'fabs.s':
-        check_args(name, args, 2)
-        return extension.fabs(args[0], args[1])
-    else:
-        return handle_hooked_instructions(name, arguments)
-
-
-def asm(name, arguments):
-    args = handle_args(arguments)
-
-    # 同名だが一定の解析で通常とは異なる動作をさせたい場合が存在する。
-    # これをHookして、別の名前に書き換える
-    name = hook_instructions(name, arguments)
-    if name == 'lui':
-        check_args(name, args, 2)
-        return asmgen.lui(args[0], args[1])
-    elif name == 'auipc':
-        check_args(name, args, 2)
-        return asmgen.auipc(args[0], args[1])
-    elif name == 'add':
-        check_args(name, args, 3)
-        return asmgen.add(args[0], args[1], args[2])
-    elif name == 'sub':
-        check_args(name, args, 3)
-        return asmgen.sub(args[0], args[1], args[2])
-    elif name == 'sll':
-        check_args(name, args, 3)
-        return asmgen.sll(args[0], args[1], args[2])
-    elif name == 'slt':
-        check_args(name, args, 3)
-        return asmgen.slt(args[0], args[1], args[2])
-    elif name == 'sltu':
-        check_args(name, args, 3)
-        return asmgen.sltu(args[0], args[1], args[2])
-    elif name == 'xor':
-        check_args(name, args, 3)
-        return asmgen.xor(args[0], args[1], args[2])
-    elif name == 'srl':
-        check_args(name, args, 3)
-        return asmgen.srl(args[0], args[1], args[2])
-    elif name == 'sra':
-        check_args(name, args, 3)
-        return asmgen.sra(args[0], args[1], args[2])
-    elif name == 'or':
-        check_args(name, args, 3)
-        return asmgen.or_(args[0], args[1], args[2])
-    elif name == 'and':
-        check_args(name, args, 3)
-        return asmgen.and_(args[0], args[1], args[2])
-    elif name == 'lui':
-        check_args(name, args, 2)
-        return asmgen.lui(args[0], args[1])
-    elif name == 'auipc':
-        check_args(name, args, 2)
-        return asmgen.auipc(args[0], args[1])
-    elif name == 'jal':
-        check_args(name, args, 2)
-        return asmgen.jal(args[0], args[1])
-    elif name == 'jalr':
-        check_args(name, args, 3)
-        return asmgen.jalr(args[0], args[1], args[2])
-    elif name == 'beq':
-        check_args(name, args, 3)
-        return asmgen.beq(args[0], args[1], args[2])
-    elif name == 'bne':
-        check_args(name, args, 3)
-        return asmgen.bne(args[0], args[1], args[2])
-    elif name == 'blt':
-        check_args(name, args, 3)
-        return asmgen.blt(args[0], args[1], args[2])
-    elif name == 'bge':
-        check_args(name, args, 3)
-        return asmgen.bge(args[0], args[1], args[2])
-    elif name == 'bltu':
-        check_args(name, args, 3)
-        return asmgen.bltu(args[0], args[1], args[2])
-    elif name == 'bgeu':
-        check_args(name, args, 3)
-        return asmgen.bgeu(args[0], args[1], args[2])
-    elif name == 'addi':
-        check_args(name, args, 3)
-        return asmgen.addi(args[0], args[1], args[2])
-    elif name == 'slti':
-        check_args(name, args, 3)
-        return asmgen.slti(args[0], args[1], args[2])
-    elif name == 'sltiu':
-        check_args(name, args, 3)
-        return asmgen.sltiu(args[0], args[1], args[2])
-    elif name == 'sltiu':
-        check_args(name, args, 3)
-        return asmgen.sltiu(args[0], args[1], args[2])
-    elif name == 'xori':
-        check_args(name, args, 3)
-        return asmgen.xori(args[0], args[1], args[2])
-    elif name == 'ori':
-        check_args(name, args, 3)
-        return asmgen.ori(args[0], args[1], args[2])
-    elif name == 'andi':
-        check_args(name, args, 3)
-        return asmgen.andi(args[0], args[1], args[2])
-    elif name == 'slli':
-        check_args(name, args, 3)
-        return asmgen.slli(args[0], args[1], args[2])
-    elif name == 'srai':
-        check_args(name, args, 3)
-        return asmgen.srai(args[0], args[1], args[2])
-    elif name == 'srli':
-        check_args(name, args, 3)
-        return asmgen.srli(args[0], args[1], args[2])
-    elif name == 'lb':
-        check_args(name, args, 3)
-        return asmgen.lb(args[0], args[1], args[2])
-    elif name == 'lh':
-        check_args(name, args, 3)
-        return asmgen.lh(args[0], args[1], args[2])
-    elif name == 'lw':
-        check_args(name, args, 3)
-        return asmgen.lw(args[0], args[1], args[2])
-    elif name == 'lbu':
-        check_args(name, args, 3)
-        return asmgen.lbu(args[0], args[1], args[2])
-    elif name == 'lhu':
-        check_args(name, args, 3)
-        return asmgen.lhu(args[0], args[1], args[2])
-    elif name == 'sb':
-        check_args(name, args, 3)
-        return asmgen.sb(args[0], args[1], args[2])
-    elif name == 'sh':
-        check_args(name, args, 3)
-        return asmgen.sh(args[0], args[1], args[2])
-    elif name == 'sw':
-        check_args(name, args, 3)
-        return asmgen.sw(args[0], args[1], args[2])
-    elif name == 'flw':
-        check_args(name, args, 3)
-        return asmgen.flw(args[0], args[1], args[2])
-    elif name == 'fsw':
-        check_args(name, args, 3)
-        return asmgen.fsw(args[0], args[1], args[2])
-    elif name == 'fadd.s':
-        check_args(name, args, 3)
-        return asmgen.fadd(args[0], args[1], args[2])
-    elif name == 'fsub.s':
-        check_args(name, args, 3)
-        return asmgen.fsub(args[0], args[1], args[2])
-    elif name == 'fmul.s':
-        check_args(name, args, 3)
-        return asmgen.fmul(args[0], args[1], args[2])
-    elif name == 'fdiv.s':
-        check_args(name, args, 3)
-        return asmgen.fdiv(args[0], args[1], args[2])
-    elif name == 'fsqrt.s':
-        check_args(name, args, 2)
-        return asmgen.fsqrt(args[0], args[1])
-    elif name == 'flt.s':
-        check_args(name, args, 3)
-        return asmgen.flt(args[0], args[1], args[2])
-    elif name == 'feq.s':
-        check_args(name, args, 3)
-        return asmgen.feq(args[0], args[1], args[2])
-    elif name == 'fle.s':
-        check_args(name, args, 3)
-        return asmgen.fle(args[0], args[1], args[2])
-    elif name == 'fsgnj.s':
-        check_args(name, args, 3)
-        return asmgen.fsgnj(args[0], args[1], args[2])
-    elif name == 'fsgnjn.s':
-        check_args(name, args, 3)
-        return asmgen.fsgnjn(args[0], args[1], args[2])
-    elif name == 'fsgnjx.s':
-        check_args(name, args, 3)
-        return asmgen.fsgnjx(args[0], args[1], args[2])
-    elif name == 'fcvt.w.s':
-        check_args(name, args, 2)
-        return asmgen.fcvt_w_s(args[0], args[1])
-    elif name == 'fcvt.s.w':
-        check_args(name, args, 2)
-        return asmgen.fcvt_s_w(args[0], args[1])
-    else:
-        l = handle_extension(name, arguments)
-        if l is None:
-            print('そのような命令は存在しません: {}'.format(name))
-            raise Exception('No Such Operation')
-        else:
-            # 拡張命令は複数命令に渡っている可能性がある。
-            ret = bytes()
-            for (name, args) in l:
-                ret += asm(name, args)
-            return ret
-
-
-op_name_re = r'(?P<op_name>[a-zA-Z_](\w|\.)*)'
-args_re = r'(?P<args>(((-|\w|\.|%|\(|\))+,)\s*)*(-|\w|\.|%|\(|\))+)?'  # 若干雑だが
-comment_q = r'(#.*)?'
-spaces = r'\s+'
-spaces_star = r'\s*'
-space_args = '(' + spaces+args_re + ')'
-no_args = spaces_star
-args = '(' + space_args + '|' + no_args + ')'
-r = ''.join([
-    spaces_star,
-    tag_re,
-    '?',
-    spaces_star,
-    op_name_re,
-    args,
-    spaces_star,
-    comment_q,
-    spaces_star,
-    '$'
-])
-op_pat = re.compile(r)
-
-
-class TestOperationRegex(unittest.TestCase):
-    ''' does regex work correctly? '''
-
-    def test_op_name_re(self):
-        r = re.compile(op_name_re + '$')  # $はとりあえず仕方なく
-        self.assertIsNotNone(r.match('mov'))
-        self.assertIsNotNone(r.match('MOV'))
-        self.assertEqual(r.match('mov').group('op_name'), 'mov')
-        self.assertIsNone(r.match('0'))
-        self.assertIsNone(r.match(' mov'))
-
-    def test_args_re(self):
-        r = re.compile(args_re + '$')
-        self.assertIsNotNone(r.match('a, b, c, d, e,f,\tg, h'))
-        self.assertIsNotNone(r.match('hoge'))
-        self.assertIsNotNone(r.match(''))
-        self.assertIsNotNone(r.match(r'%lo(msg)'))
-        self.assertIsNone(r.match('a b c d'))
-        self.assertIsNone(r.match('hoge,'))
-
-    def test_all(self):
-        self.assertIsNotNone(op_pat.match(
-            'addi a1, a1,  %lo(msg)       # load msg(lo)'))
-        self.assertIsNotNone(op_pat.match('jalr ra, puts'))
-        self.assertIsNone(op_pat.match('_start:'))
-        self.assertIsNotNone(op_pat.match(
-            '1:	    auipc a1,     %pcrel_hi(msg) # load msg(hi)'))
-        self.assertIsNotNone(op_pat.match(
-            'ret'
-        ))
-        self.assertIsNone(op_pat.match('.globl _start'))
-        self.assertIsNotNone(op_pat.match('	flw	fa5,%lo(.LC1)(a5)'))
-
-        m = op_pat.match('hoge: jalr ra, puts')
-        self.assertEqual(m.group('tag_name'), 'hoge')
-        self.assertEqual(m.group('op_name'), 'jalr')
-        self.assertEqual(m.group('args'), 'ra, puts')
-
-dec_num = r'(-?[1-9][0-9]*|0)'
-number = r'(?P<value>' + dec_num + ')'
-r = ''.join([
-    '^',
-    spaces_star,
-    tag_re,
-    '?',
-    spaces_star,
-    '.word',
-    spaces,
-    number,
-    spaces_star,
-    comment_q,
-    spaces_star,
-    '$'
-])
-const_pat = re.compile(r)
-
-
-class TestConstantRegex(unittest.TestCase):
-    def test_constant(self):
-        self.assertIsNotNone(const_pat.match('hoge:\t.word	1075838976'))
-        self.assertIsNotNone(const_pat.match('\t.word       0 #zero'))
-        self.assertIsNone(const_pat.match('hoge: jalr ra, puts'))
-
-        m = const_pat.match('\t.word\t1075838976')
-        self.assertEqual(m.group('value'), '1075838976')
-
-
-def parse_line(s):
-    # print('{}: {}'.format(read_bytes, s))
-    m = op_pat.match(s)
-    m2 = const_pat.match(s)
-    if m is not None:
-        op_name = m.group('op_name')
-        # ここかっこよくやる方法わからん
-        g = m.group('args')
-        if g is None:
-            args = []
+        import multiprocessing
+        pool = multiprocessing.Pool(n, init_worker,
+                                    (lib, asm.lib_base, asm.use_lib_cache, asm.optimize,
+                                     asm.prune_lib))
+        results = pool.imap(assemble_job, jobs)
+
+    failed = 0
+    for (filename, output, size, error) in results:
+        if error is None:
+            print('{} -> {} ({} bytes)'.format(filename, output, size))
         else:
-            args = m.group('args').replace(' ', '').replace('\t', '').split(',')
-        try:
-            a = asm(op_name, args)
-        except Exception as e:
-            error_line(s)
-            raise e
-        return a
-    elif m2 is not None:
-        value = m2.group('value')
-        i = utils.check_and_trans_imm(value, 32)
-        return utils.int2u32b(i)
-    elif debug:
-        print('{} is ignored'.format(s))
-    return None
-
-
-def emit(output_file, assembly):
-    def hex2(x):
-        s = hex(x)[2:]
-        if len(s) == 1:
-            return '0' + s
-        else:
-            return s
-
-    if emit_coe:
-        l = [hex2(x) for x in assembly]
-        r = []
-        if len(l) % 4 != 0:
-            print('命令列のうち4byte alignedでないものが存在します')
-            raise Exception('Alignment error')
-        for i in range(len(l) // 4):
-            r.append(''.join(l[4 * i: 4 * (i + 1)]))
-        h = ',\n'.join(r)
-        output_file.write((h + ',\n').encode('ascii'))
-    else:
-        output_file.write(assembly)
+            failed += 1
+            print('{}: 失敗しました'.format(filename))
+            print('  ' + error.replace('\n', '\n  '))
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    print('{} files, {} failed, {:.2f} s'.format(
+        len(jobs), failed, time.perf_counter() - t))
+    return failed
+
+
+class TestBatch(unittest.TestCase):
+    def test_output_path(self):
+        self.assertEqual(output_path('{dir}/{stem}.{ext}', 'test/fib.s'), 'test/fib.out')
+        self.assertEqual(output_path('out/{name}.bin', 'fib.s'), 'out/fib.s.bin')
+        self.assertEqual(output_path('{dir}/{stem}.{ext}', 'fib.s', 'coe'), './fib.coe')
+
+    def test_job(self):
+        import tempfile
+        init_worker('', None, True)
+        with tempfile.TemporaryDirectory() as d:
+            src = os.path.join(d, 'a.s')
+            with open(src, 'w') as f:
+                f.write('_min_caml_start:\n\tj _min_caml_start\n')
+            (_, out, size, error) = assemble_job((src, output_path('{dir}/{stem}.{ext}', src),
+                                                  True, 'raw'))
+            self.assertIsNone(error)
+            self.assertEqual(os.path.getsize(out), size)
+            (_, _, size, error) = assemble_job((src + 'x', out, True, 'raw'))
+            self.assertIsNone(size)
+            self.assertIn('FileNotFoundError', error)
 
 
-coe_prologue = b'''\
-memory_initialization_radix=16;
-memory_initialization_vector=
-'''
-coe_epilogue = b'''\
-0;
-'''
-
 def main():
-    global read_bytes, use_place_holder, emit_coe
-
     parser = argparse.ArgumentParser()
-    parser.add_argument('filename', help='source file')
-    parser.add_argument('-c', '--coe', help='dump coe', action='store_true')
+    parser.add_argument('filenames', help='source files', nargs='*',
+            metavar='filename')
+    parser.add_argument('--manifest',
+            help='file listing source files, one per line')
+    parser.add_argument('-j', '--jobs',
+            help='number of processes (0: all cores). With several sources '
+                 'each file is assembled in its own process; with one source '
+                 'the encoding is split across processes',
+            type=int, default=1)
+    parser.add_argument('--output-pattern',
+            help='output path for each source, e.g. out/{stem}.{ext} '
+                 '(fields: dir, name, stem, ext)',
+            default='{dir}/{stem}.{ext}')
+    parser.add_argument('-c', '--coe', help='dump coe (same as --format coe)',
+            action='store_true')
+    parser.add_argument('--format', help='output format', default='raw',
+            choices=sorted(formats.table))
     parser.add_argument('--output', help='output file')
     parser.add_argument('--no-prologue',
             help='assemble without prologue',
             action='store_true')
+    parser.add_argument('--lib', help='path to libmincaml.S')
+    parser.add_argument('--no-lib',
+            help='assemble without libmincaml.S',
+            action='store_true')
+    parser.add_argument('--lib-base',
+            help='place the prelinked library at this byte address',
+            type=lambda x: int(x, 0))
+    parser.add_argument('--no-lib-cache',
+            help='do not read or write the prelinked library cache',
+            action='store_true')
+    parser.add_argument('--keep-unused-lib',
+            help='link all of libmincaml.S, even functions the program never reaches',
+            action='store_true')
+    parser.add_argument('-O', '--optimize',
+            help='remove jumps to the next instruction, self moves and nops, '
+                 'and thread jumps to jumps',
+            action='store_true')
+    parser.add_argument('--watch',
+            help='keep running and re-assemble when the source changes',
+            action='store_true')
+    parser.add_argument('--listing', metavar='FILE',
+            help='write address, machine code, source line and resolved tags of each instruction')
+    parser.add_argument('--map', metavar='FILE',
+            help='write address, size, section and name of each symbol')
+    parser.add_argument('-v', '--verbose', help='print diagnostics',
+            action='store_true')
+    parser.add_argument('--stats', nargs='?', const='text', choices=['text', 'json'],
+            help='print time per phase, counters and peak memory')
+    parser.add_argument('--trace', metavar='FILE',
+            help='write the phases as a Chrome trace (chrome://tracing)')
+    parser.add_argument('--serve',
+            help='stay resident and assemble requests from client.py',
+            action='store_true')
+    parser.add_argument('--socket',
+            help='Unix socket for --serve (default: $ASM_SOCKET or /tmp/cpu3-asm-UID.sock)')
 
     args = parser.parse_args()
-    filename = args.filename
+    filenames = list(args.filenames)
+    if args.manifest:
+        filenames += read_manifest(args.manifest)
+    if not filenames and not args.serve:
+        parser.error('no source file given')
+    if len(filenames) > 1 and (args.output or args.watch or args.listing or args.map
+                               or args.stats or args.trace):
+        parser.error('--output, --watch, --listing, --map, --stats and --trace '
+                     'take a single source file')
+
+    if args.optimize and args.watch:
+        parser.error('--watch does not support -O')
+    if args.map and args.watch:
+        parser.error('--watch does not support --map')
+
+    fmt = 'coe' if args.coe else args.format
+
+    st = None
+    if args.stats or args.trace:
+        st = stats.Stats(memory=args.stats is not None)
+
+    lib = None
+    if args.no_lib:
+        lib = ''
+    elif args.lib:
+        lib = library.find(args.lib, args.verbose)
+    asm = Assembler(lib=lib, lib_base=args.lib_base,
+                    use_lib_cache=not args.no_lib_cache,
+                    verbose=args.verbose, listing=args.listing is not None,
+                    stats=st, optimize=args.optimize,
+                    prune_lib=not args.keep_unused_lib)
+
+    n = args.jobs if args.jobs > 0 else os.cpu_count()
+    if args.serve:
+        import client
+        import server
+        server.serve(args.socket or client.socket_path(), asm, n)
+        return
+
+    if len(filenames) > 1:
+        jobs = [(f, output_path(args.output_pattern, f, fmt),
+                 not args.no_prologue, fmt) for f in filenames]
+        if run_batch(asm, jobs, n):
+            sys.exit(1)
+        return
+
+    filename = filenames[0]
     if args.output:
         output = args.output
     else:
-        if args.coe:
-            output = 'a.coe'
-        else:
-            output = 'a.out'
-    of = open(output, 'wb')
-
-    if args.coe:
-        emit_coe = True
-        of.write(coe_prologue)
-
-
-    if not args.no_prologue:
-        for line in prologue.split('\n'):
-            a = parse_line(line.strip())
-            if a is None:
-                continue
-            read_bytes += len(a)
-
-    read_bytes = program_start
-
-    for line in open(filename).readlines():
-        l = line.strip()
-        parse_tag_line(l)
-        if parse_line(l) is not None:
-            # あんま綺麗じゃないなあ
-            read_bytes += len(parse_line(l))
-
-    for line in epilogue.split('\n'):
-        a = parse_line(line.strip())
-        if a is None:
-            continue
-        read_bytes += len(a)
-
-
-    for line in lib_data.split('\n'):
-        a = parse_line(line.strip())
-        parse_tag_line(line.strip())
-        if a is None:
-            continue
-        read_bytes += len(a)
-
-
-    print(tags)
-    asmgen.tags = tags
-    use_place_holder = False
-    read_bytes = 0
-
-    # prologue
-    if not args.no_prologue:
-        for line in prologue.split('\n'):
-            a = parse_line(line.strip())
-            if a is None:
-                continue
-            read_bytes += len(a)
-            emit(of, a)
-
-    for i in range((0x10 * 4 - read_bytes) // 4):
-        read_bytes += 4
-        emit(of, b'\x00' * 4)
-
-    import struct
-    p = os.path.dirname(os.path.abspath(__file__))
-    with open(os.path.join(p, "heap_file2"), "r") as f:
-        l = f.read().strip().split('\n')
-        for x in l:
-            read_bytes += 4
-            emit(of, struct.pack("<I", int(x, 16)))
-
-    print(read_bytes)
-    read_bytes = program_start
-
-
-    for line in open(filename).readlines():
-        a = parse_line(line.strip())
-        if a is None:
-            continue
-        read_bytes += len(a)
-        emit(of, a)
-
-    for line in epilogue.split('\n'):
-        a = parse_line(line.strip())
-        if a is None:
-            continue
-        read_bytes += len(a)
-        emit(of, a)
-
-    for line in lib_data.split('\n'):
-        a = parse_line(line.strip())
-        if a is None:
-            continue
-        read_bytes += len(a)
-        emit(of, a)
-
-    # prologue
-    if emit_coe:
-        of.write(coe_epilogue)
+        output = 'a.' + formats.lookup(fmt).ext
+
+    if args.watch:
+        import watch
+        w = watch.Watcher(asm, filename, output, fmt=fmt,
+                          prologue=not args.no_prologue)
+        w.run()
+        return
+
+    image = asm.assemble_file(filename, prologue=not args.no_prologue, jobs=n)
+    with stats.phase(st, 'write'):
+        formats.write(output, image, fmt)
+    if args.listing:
+        with stats.phase(st, 'listing'):
+            asm.write_listing(args.listing, image)
+    if args.map:
+        with stats.phase(st, 'map'):
+            asm.write_map(args.map)
+
+    if st is not None:
+        if args.stats == 'json':
+            print(st.json(), end='')
+        elif args.stats:
+            print(st.text(), end='')
+        if args.trace:
+            st.write_trace(args.trace)
 
 
 def test():
@@ -755,17 +286,4 @@ def test():
 
 
 if __name__ == '__main__':
-    libfile = '../compiler/libmincaml.S'
-    if not os.path.exists(libfile):
-        libfile = '/tmp/libmincaml.S'
-        import urllib.request
-        url = 'https://raw.githubusercontent.com/cpu-3/compiler/master/libmincaml.S'
-        with urllib.request.urlopen(url) as response:
-            data = response.read()
-            with open(libfile, 'wb') as f:
-                f.write(data)
-    with open(libfile) as f:
-        print('libmincaml.S: reading from {}'.format(libfile))
-        lib_data = f.read()
-
     main()
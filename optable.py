@@ -0,0 +1,343 @@
+'''
+命令表
+
+ニーモニックから命令形式・opcode・funct3・funct7・引数の数を一回で引くための表。
+asmgen のエンコーダ、extension の疑似命令、hook による書き換えはすべてここから
+辿るので、main.asm で名前を順番に比較していく必要はない。
+
+形式は R/I/S/B/U/J/F の7つと、他の命令列に展開される疑似命令 P、データの指示 D (directive)。
+'''
+
+import unittest
+
+import asmgen
+import directive
+import extension
+import hook
+
+
+class Op:
+    __slots__ = ('name', 'fmt', 'arity', 'opcode', 'funct3', 'funct7',
+                 'base', 'encoder', 'expand', 'relative', 'size', 'directive')
+
+    def __init__(self, name, fmt, arity, opcode=0, funct3=0, funct7=None,
+                 expand=None, relative=True, size=4, directive=None):
+        self.name = name
+        self.fmt = fmt
+        self.arity = arity
+        self.opcode = opcode
+        self.funct3 = funct3
+        self.funct7 = funct7
+        # opcode/funct3/funct7 を詰めた命令語。エンコーダはここに他のフィールドをORする
+        self.base = asmgen.base_word(opcode, funct3, funct7)
+        self.encoder = asmgen.formats.get(fmt)
+        self.expand = expand
+        # タグを相対アドレスで解決するか(Falseなら絶対アドレス)
+        self.relative = relative
+        # エンコードした結果のバイト数。エンコードせずにアドレスを割り当てるときに使う。
+        # None なら引数や置く場所で変わる (データの指示)
+        self.size = size
+        # データの指示 (形式 D) なら directive.Directive
+        self.directive = directive
+
+    def __repr__(self):
+        return 'Op({}, {})'.format(self.name, self.fmt)
+
+
+table = {}
+
+
+def add(name, fmt, arity, opcode=0, funct3=0, funct7=None):
+    table[name] = Op(name, fmt, arity, opcode, funct3, funct7)
+
+
+def add_pseudo(name, arity, expand, relative=True, size=4):
+    table[name] = Op(name, 'P', arity, expand=expand, relative=relative, size=size)
+
+
+OP = 0b0110011
+OP_IMM = 0b0010011
+LOAD = 0b0000011
+STORE = 0b0100011
+BRANCH = 0b1100011
+OP_FP = 0b1010011
+
+add('lui', 'U', 2, 0b0110111)
+add('auipc', 'U', 2, 0b0010111)
+add('jal', 'J', 2, 0b1101111)
+add('jalr', 'I', 3, 0b1100111, 0b000)
+
+add('beq', 'B', 3, BRANCH, 0b000)
+add('bne', 'B', 3, BRANCH, 0b001)
+add('blt', 'B', 3, BRANCH, 0b100)
+add('bge', 'B', 3, BRANCH, 0b101)
+add('bltu', 'B', 3, BRANCH, 0b110)
+add('bgeu', 'B', 3, BRANCH, 0b111)
+
+add('lb', 'I', 3, LOAD, 0b000)
+add('lh', 'I', 3, LOAD, 0b001)
+add('lw', 'I', 3, LOAD, 0b010)
+add('lbu', 'I', 3, LOAD, 0b100)
+add('lhu', 'I', 3, LOAD, 0b101)
+
+add('sb', 'S', 3, STORE, 0b000)
+add('sh', 'S', 3, STORE, 0b001)
+add('sw', 'S', 3, STORE, 0b010)
+
+add('addi', 'I', 3, OP_IMM, 0b000)
+add('slti', 'I', 3, OP_IMM, 0b010)
+add('sltiu', 'I', 3, OP_IMM, 0b011)
+add('xori', 'I', 3, OP_IMM, 0b100)
+add('ori', 'I', 3, OP_IMM, 0b100)
+add('andi', 'I', 3, OP_IMM, 0b111)
+add('slli', 'I', 3, OP_IMM, 0b001, 0b0000000)
+add('srli', 'I', 3, OP_IMM, 0b101, 0b0000000)
+add('srai', 'I', 3, OP_IMM, 0b101, 0b0100000)
+
+add('add', 'R', 3, OP, 0b000, 0b0000000)
+add('sub', 'R', 3, OP, 0b000, 0b0100000)
+add('sll', 'R', 3, OP, 0b001, 0b0000000)
+add('slt', 'R', 3, OP, 0b010, 0b0000000)
+add('sltu', 'R', 3, OP, 0b011, 0b0000000)
+add('xor', 'R', 3, OP, 0b100, 0b0000000)
+add('srl', 'R', 3, OP, 0b101, 0b0000000)
+add('sra', 'R', 3, OP, 0b101, 0b0100000)
+add('or', 'R', 3, OP, 0b110, 0b0000000)
+add('and', 'R', 3, OP, 0b111, 0b0000000)
+
+add('flw', 'I', 3, 0b0000111, 0b010)
+add('fsw', 'S', 3, 0b0100111, 0b010)
+
+rm = asmgen.default_rm
+add('fadd.s', 'F', 3, OP_FP, rm, 0b0000000)
+add('fsub.s', 'F', 3, OP_FP, rm, 0b0000100)
+add('fmul.s', 'F', 3, OP_FP, rm, 0b0001000)
+add('fdiv.s', 'F', 3, OP_FP, rm, 0b0001100)
+add('fsqrt.s', 'F', 2, OP_FP, rm, 0b0101100)
+add('feq.s', 'F', 3, OP_FP, 0b010, 0b1010000)
+add('flt.s', 'F', 3, OP_FP, 0b001, 0b1010000)
+add('fle.s', 'F', 3, OP_FP, 0b000, 0b1010000)
+add('fsgnj.s', 'F', 3, OP_FP, 0b000, 0b0010000)
+add('fsgnjn.s', 'F', 3, OP_FP, 0b001, 0b0010000)
+add('fsgnjx.s', 'F', 3, OP_FP, 0b010, 0b0010000)
+add('fcvt.w.s', 'F', 2, OP_FP, rm, 0b1100000)
+add('fcvt.s.w', 'F', 2, OP_FP, rm, 0b1101000)
+
+# データの指示。引数の数も大きさも指示ごとに決まる
+for (name, d) in directive.table.items():
+    table[name] = Op(name, 'D', None, size=None, directive=d)
+
+# extension: 疑似命令
+add_pseudo('nop', 0, extension.nop)
+add_pseudo('li', 2, extension.li, size=8)
+add_pseudo('mv', 2, extension.mv)
+add_pseudo('bgt', 3, extension.bgt)
+add_pseudo('ble', 3, extension.ble)
+add_pseudo('bgtu', 3, extension.bgtu)
+add_pseudo('bleu', 3, extension.bleu)
+add_pseudo('bnei', 3, extension.bnei)
+add_pseudo('j', 1, extension.jump)
+add_pseudo('jl', 1, extension.jumpl)
+add_pseudo('jr', 1, extension.jr)
+add_pseudo('jrl', 1, extension.jrl)
+add_pseudo('ret', 0, extension.ret)
+add_pseudo('call', 1, extension.call, size=8)
+add_pseudo('tail', 1, extension.tail, size=8)
+add_pseudo('subi', 3, extension.subi)
+add_pseudo('fmv.s', 2, extension.fmv)
+add_pseudo('fneg.s', 2, extension.fneg)
+add_pseudo('fabs.s', 2, extension.fabs)
+
+# hook: 引数を見て書き換えた後の名前
+add_pseudo('_jal', 1, hook.jal)
+add_pseudo('_jalr', 1, hook.jalr)
+add_pseudo('_li', 2, hook.li, relative=False, size=8)
+add_pseudo('_li_short', 2, extension.li_short)
+add_pseudo('_add', 3, hook.add)
+add_pseudo('_sub', 3, hook.sub)
+
+# 分岐。B形式と、B形式一つになる疑似命令で、どれも3つ目の引数が飛び先
+branches = {'beq', 'bne', 'blt', 'bge', 'bltu', 'bgeu',
+            'bgt', 'ble', 'bgtu', 'bleu', 'bnei'}
+
+# 条件を反対にした分岐
+inverse = {
+    'beq': 'bne',
+    'bne': 'beq',
+    'blt': 'bge',
+    'bge': 'blt',
+    'bltu': 'bgeu',
+    'bgeu': 'bltu',
+}
+
+# 置いた場所によって、短い形 (4バイト) と長い形 (8バイト) を選ぶ命令:
+# 名前 -> 長さを決める引数 (飛び先か値) の位置。
+# 分岐は飛び先が遠いときだけ、条件を反対にした分岐と jal にする。
+# call, tail, _li は飛び先や値が近いときだけ、下の short の命令一つにする
+relaxable = {name: 2 for name in branches}
+relaxable.update({'call': 0, 'tail': 0, '_li': 1})
+
+# 長い形の大きさ。bnei の rs2 は即値で、条件を反対にした分岐が無いので、
+# bnei rs, imm, 2; jal x0, 2; jal x0, far の3命令にする
+long_size = {name: 8 for name in relaxable}
+long_size['bnei'] = 12
+
+short = {
+    'call': table['_jal'],
+    'tail': table['j'],
+    '_li': table['_li_short'],
+}
+
+# 同名だが引数によって別の命令として扱いたいもの
+hooks = {
+    'jal': hook.rename_jal,
+    'jalr': hook.rename_jalr,
+    'li': hook.rename_li,
+    'add': hook.rename_add,
+    'sub': hook.rename_sub,
+}
+
+
+def lookup(name, args):
+    # 同名だが一定の解析で通常とは異なる動作をさせたい場合が存在する。
+    # これをHookして、別の名前に書き換える
+    hook = hooks.get(name)
+    if hook is not None:
+        name = hook(args)
+
+    op = table.get(name)
+    if op is None:
+        print('そのような命令は存在しません: {}'.format(name))
+        raise Exception('No Such Operation')
+    return op
+
+
+class TestEncoding(unittest.TestCase):
+    cases = [
+        ('lui', ['t2', '100'], 'b7430600'),
+        ('lui', ['a0', '-1'], '37f5ffff'),
+        ('auipc', ['t2', '100'], '97430600'),
+        ('auipc', ['a0', '-1'], '17f5ffff'),
+        ('jal', ['ra', '-20'], 'eff09ffd'),
+        ('jal', ['x0', '300001'], '6f20297c'),
+        ('jalr', ['a0', 'a1', '-5'], '6785b5ff'),
+        ('jalr', ['t6', 'sp', '2047'], 'e70ff17f'),
+        ('beq', ['a0', 'a1', '-3'], 'e30db5fe'),
+        ('beq', ['t5', 't6', '2047'], 'e30fff7f'),
+        ('bne', ['a0', 'a1', '-3'], 'e31db5fe'),
+        ('bne', ['t5', 't6', '2047'], 'e31fff7f'),
+        ('blt', ['a0', 'a1', '-3'], 'e34db5fe'),
+        ('blt', ['t5', 't6', '2047'], 'e34fff7f'),
+        ('bge', ['a0', 'a1', '-3'], 'e35db5fe'),
+        ('bge', ['t5', 't6', '2047'], 'e35fff7f'),
+        ('bltu', ['a0', 'a1', '-3'], 'e36db5fe'),
+        ('bltu', ['t5', 't6', '2047'], 'e36fff7f'),
+        ('bgeu', ['a0', 'a1', '-3'], 'e37db5fe'),
+        ('bgeu', ['t5', 't6', '2047'], 'e37fff7f'),
+        ('lb', ['a0', 'a1', '-5'], '0385b5ff'),
+        ('lb', ['t6', 'sp', '2047'], '830ff17f'),
+        ('lh', ['a0', 'a1', '-5'], '0395b5ff'),
+        ('lh', ['t6', 'sp', '2047'], '831ff17f'),
+        ('lw', ['a0', 'a1', '-5'], '03a5b5ff'),
+        ('lw', ['t6', 'sp', '2047'], '832ff17f'),
+        ('lbu', ['a0', 'a1', '-5'], '03c5b5ff'),
+        ('lbu', ['t6', 'sp', '2047'], '834ff17f'),
+        ('lhu', ['a0', 'a1', '-5'], '03d5b5ff'),
+        ('lhu', ['t6', 'sp', '2047'], '835ff17f'),
+        ('sb', ['a0', 'sp', '-8'], '230ca1fe'),
+        ('sb', ['ra', 's0', '2044'], '230e147e'),
+        ('sh', ['a0', 'sp', '-8'], '231ca1fe'),
+        ('sh', ['ra', 's0', '2044'], '231e147e'),
+        ('sw', ['a0', 'sp', '-8'], '232ca1fe'),
+        ('sw', ['ra', 's0', '2044'], '232e147e'),
+        ('addi', ['a0', 'a1', '-5'], '1385b5ff'),
+        ('addi', ['t6', 'sp', '2047'], '930ff17f'),
+        ('slti', ['a0', 'a1', '-5'], '13a5b5ff'),
+        ('slti', ['t6', 'sp', '2047'], '932ff17f'),
+        ('sltiu', ['a0', 'a1', '-5'], '13b5b5ff'),
+        ('sltiu', ['t6', 'sp', '2047'], '933ff17f'),
+        ('xori', ['a0', 'a1', '-5'], '13c5b5ff'),
+        ('xori', ['t6', 'sp', '2047'], '934ff17f'),
+        ('ori', ['a0', 'a1', '-5'], '13c5b5ff'),
+        ('ori', ['t6', 'sp', '2047'], '934ff17f'),
+        ('andi', ['a0', 'a1', '-5'], '13f5b5ff'),
+        ('andi', ['t6', 'sp', '2047'], '937ff17f'),
+        ('slli', ['a0', 'a1', '3'], '13953500'),
+        ('slli', ['t6', 'sp', '31'], '931ff101'),
+        ('srli', ['a0', 'a1', '3'], '13d53500'),
+        ('srli', ['t6', 'sp', '31'], '935ff101'),
+        ('srai', ['a0', 'a1', '3'], '13d53540'),
+        ('srai', ['t6', 'sp', '31'], '935ff141'),
+        ('add', ['a0', 'a1', 'a2'], '3385c500'),
+        ('add', ['t6', 'zero', 's11'], 'b30fb001'),
+        ('sub', ['a0', 'a1', 'a2'], '3385c540'),
+        ('sub', ['t6', 'zero', 's11'], 'b30fb041'),
+        ('sll', ['a0', 'a1', 'a2'], '3395c500'),
+        ('sll', ['t6', 'zero', 's11'], 'b31fb001'),
+        ('slt', ['a0', 'a1', 'a2'], '33a5c500'),
+        ('slt', ['t6', 'zero', 's11'], 'b32fb001'),
+        ('sltu', ['a0', 'a1', 'a2'], '33b5c500'),
+        ('sltu', ['t6', 'zero', 's11'], 'b33fb001'),
+        ('xor', ['a0', 'a1', 'a2'], '33c5c500'),
+        ('xor', ['t6', 'zero', 's11'], 'b34fb001'),
+        ('srl', ['a0', 'a1', 'a2'], '33d5c500'),
+        ('srl', ['t6', 'zero', 's11'], 'b35fb001'),
+        ('sra', ['a0', 'a1', 'a2'], '33d5c540'),
+        ('sra', ['t6', 'zero', 's11'], 'b35fb041'),
+        ('or', ['a0', 'a1', 'a2'], '33e5c500'),
+        ('or', ['t6', 'zero', 's11'], 'b36fb001'),
+        ('and', ['a0', 'a1', 'a2'], '33f5c500'),
+        ('and', ['t6', 'zero', 's11'], 'b37fb001'),
+        ('flw', ['a0', 'a1', '-5'], '07a5b5ff'),
+        ('flw', ['t6', 'sp', '2047'], '872ff17f'),
+        ('fsw', ['a0', 'sp', '-8'], '272ca1fe'),
+        ('fsw', ['ra', 's0', '2044'], '272e147e'),
+        ('fadd.s', ['fa0', 'fa1', 'fa2'], '5385c500'),
+        ('fadd.s', ['ft0', 'f31', 'fs11'], 'd382bf01'),
+        ('fsub.s', ['fa0', 'fa1', 'fa2'], '5385c508'),
+        ('fsub.s', ['ft0', 'f31', 'fs11'], 'd382bf09'),
+        ('fmul.s', ['fa0', 'fa1', 'fa2'], '5385c510'),
+        ('fmul.s', ['ft0', 'f31', 'fs11'], 'd382bf11'),
+        ('fdiv.s', ['fa0', 'fa1', 'fa2'], '5385c518'),
+        ('fdiv.s', ['ft0', 'f31', 'fs11'], 'd382bf19'),
+        ('fsqrt.s', ['fa0', 'fa1'], '53850558'),
+        ('fsqrt.s', ['a0', 'f31'], '53850f58'),
+        ('feq.s', ['fa0', 'fa1', 'fa2'], '53a5c5a0'),
+        ('feq.s', ['ft0', 'f31', 'fs11'], 'd3a2bfa1'),
+        ('flt.s', ['fa0', 'fa1', 'fa2'], '5395c5a0'),
+        ('flt.s', ['ft0', 'f31', 'fs11'], 'd392bfa1'),
+        ('fle.s', ['fa0', 'fa1', 'fa2'], '5385c5a0'),
+        ('fle.s', ['ft0', 'f31', 'fs11'], 'd382bfa1'),
+        ('fsgnj.s', ['fa0', 'fa1', 'fa2'], '5385c520'),
+        ('fsgnj.s', ['ft0', 'f31', 'fs11'], 'd382bf21'),
+        ('fsgnjn.s', ['fa0', 'fa1', 'fa2'], '5395c520'),
+        ('fsgnjn.s', ['ft0', 'f31', 'fs11'], 'd392bf21'),
+        ('fsgnjx.s', ['fa0', 'fa1', 'fa2'], '53a5c520'),
+        ('fsgnjx.s', ['ft0', 'f31', 'fs11'], 'd3a2bf21'),
+        ('fcvt.w.s', ['fa0', 'fa1'], '538505c0'),
+        ('fcvt.w.s', ['a0', 'f31'], '53850fc0'),
+        ('fcvt.s.w', ['fa0', 'fa1'], '538505d0'),
+        ('fcvt.s.w', ['a0', 'f31'], '53850fd0'),
+    ]
+
+    def test_encoding(self):
+        for (name, args, expected) in self.cases:
+            op = table[name]
+            self.assertEqual(op.encoder(op, *args).hex(), expected, name)
+
+    def test_size(self):
+        # 疑似命令の size は、展開した結果の長さと一致していなければならない
+        args = {
+            'bnei': ['a0', 'x20', '3'],
+            'subi': ['a0', 'a1', '3'],
+            '_add': ['a0', 'a1', '3'],
+            '_sub': ['a0', 'a1', '3'],
+        }
+        for (name, op) in table.items():
+            if op.expand is None:
+                continue
+            a = args.get(name, ['a0', 'a1', '3'][3 - op.arity:])
+            size = 0
+            for (n, l) in op.expand(*a):
+                size += lookup(n, l).size
+            self.assertEqual(size, op.size, name)
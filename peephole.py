@@ -0,0 +1,289 @@
+'''
+ # のぞき穴最適化 (-O)
+
+ パースした Inst の列を見て、消しても動きの変わらない命令を消す。
+ タグは全部の列を見てから集める (同名のタグは後の定義が有効なのはアセンブラと同じ)。
+ アドレスはまだ決めていないので、消した後はアセンブラが普通に配置し直す。
+
+ - jump to next: 飛び先がすぐ次の命令である `j`/`jal x0` と条件分岐を消す
+ - self move: 同じレジスタへの移動 (`add rd, rd, 0`, `mv rd, rd`, `fmv.s fd, fd` など)
+ - nop: `nop`
+ - jump threading: 飛び先の最初の命令が `j M` なら、飛び先を M にする
+
+ 飛び先を数 (語単位の相対) で書いた分岐やジャンプが一つでもあると、命令を消したときに
+ その飛び先がずれるので、そのときは何も消さない (jump threading だけする)。
+
+ Inst は共有されている (アセンブラのパース結果のキャッシュ) ので書き換えず、
+ 新しい列と新しい Inst を作る。消した命令にタグが付いていたら、タグだけの Inst を残す。
+'''
+
+import collections
+import unittest
+
+import ir
+import optable
+import utils
+
+
+# 値の変わらない移動。(命令名, 移る先, 元, 即値) の引数の位置。即値は0のときだけ
+moves = {
+    '_add': (0, 1, 2),
+    '_sub': (0, 1, 2),
+    'addi': (0, 1, 2),
+    'subi': (0, 1, 2),
+    'mv': (0, 1, None),
+    'fmv.s': (0, 1, None),
+    'fsgnj.s': (0, 1, None),
+}
+
+
+def is_jump(inst):
+    ''' 無条件ジャンプ (j L, jal x0, L) なら飛び先の引数の位置 '''
+    name = inst.op.name
+    if name == 'j':
+        return 0
+    if name == 'jal' and utils.get_reg(inst.args[0]) == 0:
+        return 1
+    return None
+
+
+def target_index(inst):
+    ''' タグに飛ぶジャンプ・分岐なら、飛び先の引数の位置。それ以外は None '''
+    if inst.op is None or inst.refs is None:
+        return None
+    i = is_jump(inst)
+    if i is None and inst.op.name in optable.branches:
+        i = 2
+    if i is None or i not in inst.refs:
+        return None
+    return i
+
+
+def offset_index(inst):
+    ''' 飛び先を数 (語単位の相対) で書いた分岐・ジャンプなら、その引数の位置。それ以外は None '''
+    if inst.op is None:
+        return None
+    name = inst.op.name
+    if name in optable.branches:
+        i = 2
+    elif name in ('j', '_jal', 'call', 'tail'):
+        i = 0
+    elif name == 'jal':
+        i = 1
+    else:
+        return None
+    if i < len(inst.args) and utils.is_number(inst.args[i]):
+        return i
+    return None
+
+
+def is_self_move(inst):
+    m = moves.get(inst.op.name)
+    if m is None:
+        return False
+    (rd, rs, imm) = m
+    args = inst.args
+    if imm is not None and (not utils.is_number(args[imm]) or int(args[imm]) != 0):
+        return False
+    if inst.op.name == 'fsgnj.s' and args[1] != args[2] and \
+            utils.get_reg(args[1]) != utils.get_reg(args[2]):
+        return False
+    d = utils.get_reg(args[rd])
+    return d is not None and d == utils.get_reg(args[rs])
+
+
+def replace(inst, i, value):
+    ''' inst の i 番目の引数を value にした Inst '''
+    args = list(inst.args)
+    args[i] = value
+    return ir.Inst(inst.op, args, inst.tag, inst.source, inst.lineno)
+
+
+def untag(inst):
+    ''' inst を消すときに残すもの (タグだけの Inst か None) '''
+    if inst.tag is None:
+        return None
+    return ir.Inst(None, None, inst.tag, inst.source, inst.lineno)
+
+
+class Optimizer:
+    def __init__(self, sections, external=()):
+        # sections は Inst の列のリスト。列どうしは続けて置かれるとは限らない
+        self.sections = [list(s) for s in sections]
+        # ここで決まらないタグ (リンク済みのライブラリのものなど)。飛び先としては見ない
+        self.external = external
+        self.counts = collections.Counter()
+        # 数で書いた飛び先があれば、命令を消すとずれるので消さない
+        self.frozen = any(offset_index(inst) is not None
+                          for insts in self.sections for inst in insts)
+
+    def collect(self):
+        ''' タグ -> (列の番号, 位置)。同名のタグは後の定義が有効 '''
+        self.defs = {}
+        for (k, insts) in enumerate(self.sections):
+            for (j, inst) in enumerate(insts):
+                if inst.tag is not None:
+                    self.defs[inst.tag] = (k, j)
+
+    def first(self, name):
+        ''' タグ name の位置から実行される最初の命令 (同じ列の中に無ければ None) '''
+        if name in self.external or name not in self.defs:
+            return None
+        (k, j) = self.defs[name]
+        insts = self.sections[k]
+        while j < len(insts):
+            if insts[j].op is not None:
+                return insts[j]
+            j += 1
+        return None
+
+    def is_next(self, k, j, name):
+        ''' 列 k の j 番目の命令のすぐ次が、タグ name の位置か '''
+        if name in self.external or self.defs.get(name, (None, -1))[0] != k:
+            return False
+        i = self.defs[name][1]
+        insts = self.sections[k]
+        j += 1
+        while j < i and insts[j].op is None:
+            j += 1
+        return j == i
+
+    def thread(self, name):
+        ''' name から j をたどった先のタグ。たどれなければ None '''
+        seen = {name}
+        cur = name
+        while True:
+            inst = self.first(cur)
+            if inst is None or is_jump(inst) is None:
+                break
+            i = is_jump(inst)
+            if inst.refs is None or i not in inst.refs:
+                break
+            nxt = inst.args[i]
+            if nxt in seen:
+                # 無限ループになっている
+                break
+            seen.add(nxt)
+            cur = nxt
+        if cur == name:
+            return None
+        return cur
+
+    def step(self):
+        ''' 一通り見て、変えた数を返す '''
+        self.collect()
+        changed = 0
+        # 位置は元の列のものなので、全部見終わってから入れ替える
+        sections = []
+        for (k, insts) in enumerate(self.sections):
+            out = []
+            for (j, inst) in enumerate(insts):
+                if inst.op is None:
+                    out.append(inst)
+                    continue
+                kind = None
+                i = target_index(inst)
+                if i is not None and self.is_next(k, j, inst.args[i]):
+                    kind = 'jump to next'
+                elif inst.op.name == 'nop':
+                    kind = 'nop'
+                elif is_self_move(inst):
+                    kind = 'self move'
+                if kind is not None and not self.frozen:
+                    self.counts[kind] += 1
+                    changed += 1
+                    t = untag(inst)
+                    if t is not None:
+                        out.append(t)
+                    continue
+
+                if i is not None:
+                    m = self.thread(inst.args[i])
+                    if m is not None:
+                        self.counts['jump threading'] += 1
+                        changed += 1
+                        inst = replace(inst, i, m)
+                out.append(inst)
+            sections.append(out)
+        self.sections = sections
+        return changed
+
+    def run(self):
+        while self.step():
+            pass
+        return self.sections
+
+
+def optimize(sections, external=()):
+    '''
+    Inst の列のリストを最適化して、(新しい列のリスト, 種類ごとの数の Counter) を返す。
+    external のタグ (この中に定義があっても使われないもの) は飛び先として扱わない
+    '''
+    o = Optimizer(sections, external)
+    return (o.run(), o.counts)
+
+
+class TestPeephole(unittest.TestCase):
+    def opt(self, *texts):
+        sections = [ir.parse(t.split('\n'), 'test.s') for t in texts]
+        return optimize(sections)
+
+    def names(self, insts):
+        return [str(inst) for inst in insts]
+
+    def test_jump_to_next(self):
+        ((l,), c) = self.opt('f:\tbgt a0, a1, g\n\tj f_end\ng:\tret\n\tj f_end\nf_end:\n\tret')
+        self.assertEqual(self.names(l), ['f: bgt a0, a1, g', 'j f_end', 'g: ret ', 'f_end: ',
+                                         'ret '])
+        self.assertEqual(c, {'jump to next': 1})
+        ((l,), c) = self.opt('\tbeq a0, a1, l\nl:\tj m\nm:\n\tret')
+        self.assertEqual(c, {'jump to next': 2})
+
+    def test_self_move(self):
+        ((l,), c) = self.opt('\tadd a0, a0, 0\n\tadd a0, a1, 0\nx:\tmv s1, x9\n\tsub t0, t0, 0\n'
+                             '\tfmv.s fa0, fa0\n\tfmv.s fa0, fa1\n\tadd a0, a0, 1\n\tnop')
+        self.assertEqual(self.names(l), ['_add a0, a1, 0', 'x: ', 'fmv.s fa0, fa1',
+                                         '_add a0, a0, 1'])
+        self.assertEqual(c, {'self move': 4, 'nop': 1})
+
+    def test_threading(self):
+        (l, c) = self.opt('\tbeq a0, a1, a\n\tjal x0, a\n\tj c\n\tj loop\n',
+                          'a:\tj b\n\tadd a0, a0, 1\nb:\tj c\n\tadd a0, a0, 2\nc:\tret\n'
+                          'loop:\tj loop')
+        self.assertEqual(self.names(l[0]), ['beq a0, a1, c', 'jal x0, c', 'j c', 'j loop'])
+        self.assertEqual(self.names(l[1])[0], 'a: j c')
+        self.assertEqual(c, {'jump threading': 3})
+        # 外のタグはたどらない
+        (l, c) = optimize([ir.parse(['\tj a', 'a:', '\tj b'], 'test.s')], external={'a'})
+        self.assertEqual(self.names(l[0]), ['j a', 'a: ', 'j b'])
+
+    def test_numeric_offset(self):
+        # 数で書いた飛び先をまたぐ命令は消せないので、何も消さない
+        src = '_min_caml_start:\n\tbeq a0, a1, 3\n\tnop\n\tadd a0, a0, 0\n\taddi a0, a0, 1\n\tret'
+        ((l,), c) = self.opt(src)
+        self.assertEqual(self.names(l), self.names(ir.parse(src.split('\n'), 'test.s')))
+        self.assertEqual(c, {})
+        (l, c) = self.opt('\tj l\nl:\tnop\n\tj 1', 'f:\n\tnop')
+        self.assertEqual(c, {})
+        # threading は大きさが変わらないのでする
+        (l, c) = self.opt('\tbeq a0, a1, a\n\tbne a0, a1, -1\na:\tj b\nb:\tret')
+        self.assertEqual(c, {'jump threading': 1})
+
+        from assembler import Assembler
+        src += '\n'
+        self.assertEqual(Assembler(lib='', optimize=True).assemble(src),
+                         Assembler(lib='').assemble(src))
+
+    def test_shared(self):
+        l = ir.parse(['\tj a', 'a:', '\tnop'], 'test.s')
+        before = list(l)
+        optimize([l])
+        self.assertEqual(l, before)
+
+    def test_assemble(self):
+        from assembler import Assembler
+        src = 'f:\n\tnop\n\tj g\ng:\n\tj _min_caml_start\n_min_caml_start:\n\tj g\n\tret\n'
+        a = Assembler(lib='', optimize=True)
+        image = a.assemble(src)
+        self.assertEqual(len(image) + 4 * 3, len(Assembler(lib='').assemble(src)))
+        self.assertEqual(a.tags['_min_caml_start'], a.tags['g'])
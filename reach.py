@@ -0,0 +1,216 @@
+'''
+ # 使われないライブラリ関数を除く
+
+ libmincaml.S はプログラムがどれを呼ぶかによらず全部付けていたので、呼ばない関数の分だけ
+ イメージが大きくなっていた。ここでは配置の前に、たどり着けるところだけを残す。
+
+ - 命令の列をタグのある所で区切ってブロックにする
+ - prologue・プログラム・epilogue のすべてのブロックから始めて、
+   ブロックの中の命令が参照しているタグ (call, tail, jal, j, 分岐、li で入れるアドレスなど) と、
+   最後が無条件のジャンプでなければすぐ次のブロック (fall through) をたどる。
+   プログラムは実行されない関数も除かずにエンコードするので、そこから参照するタグも残す必要がある
+ - プログラム・epilogue・ライブラリはこの順に続けて置くので、一つながりとして見る
+ - ライブラリの中で、たどり着けなかったブロックの命令を除く。プログラムは何も除かない
+
+ 飛び先を数 (語単位の相対) で書いた分岐やジャンプがプログラム・epilogue・ライブラリにあると、
+ どのブロックに飛ぶかは配置してみないと分からず、ライブラリを除くとずれもするので、
+ そのときはライブラリを全部残す。
+ 同名のタグは後の定義が有効なのはアセンブラと同じ。
+ タグを介さずにアドレスを計算して飛ぶようなコードは見えないので、そういうライブラリには
+ --keep-unused-lib を使う。
+'''
+
+import unittest
+
+import peephole
+import utils
+
+
+# 次の命令に進まない命令
+stops = {'j', 'tail', 'ret', 'jr', '_jalr'}
+
+
+def falls_through(inst):
+    ''' inst の後に、次の命令が実行されることがあるか '''
+    name = inst.op.name
+    if name in stops:
+        return False
+    if name == 'jal':
+        return peephole.is_jump(inst) is None
+    if name == 'jalr':
+        return utils.get_reg(inst.args[0]) != 0
+    return True
+
+
+class Graph:
+    def __init__(self, chains):
+        # chains は続けて置かれる Inst の列のリスト
+        self.chains = chains
+        # ブロック: (列の番号, 最初の位置, 終わりの位置)
+        self.blocks = []
+        # (列の番号, 位置) -> その位置から始まるブロックの番号
+        self.starts = {}
+        self.defs = {}
+        for (k, insts) in enumerate(chains):
+            start = 0
+            for (j, inst) in enumerate(insts):
+                if inst.tag is not None:
+                    if j > start:
+                        self.add(k, start, j)
+                        start = j
+                    self.defs[inst.tag] = len(self.blocks)
+            if insts:
+                self.add(k, start, len(insts))
+
+    def add(self, k, start, end):
+        self.starts[(k, start)] = len(self.blocks)
+        self.blocks.append((k, start, end))
+
+    def block_at(self, k, j):
+        ''' 列 k の j 番目を含むブロックの番号 '''
+        while (k, j) not in self.starts:
+            j -= 1
+        return self.starts[(k, j)]
+
+    def successors(self, b):
+        (k, start, end) = self.blocks[b]
+        insts = self.chains[k]
+        l = []
+        last = None
+        for inst in insts[start:end]:
+            if inst.op is None:
+                continue
+            last = inst
+            if inst.refs is None:
+                continue
+            for i in inst.refs:
+                t = self.defs.get(inst.args[i])
+                if t is not None:
+                    l.append(t)
+        if (last is None or falls_through(last)) and b + 1 < len(self.blocks) \
+                and self.blocks[b + 1][0] == k:
+            l.append(b + 1)
+        return l
+
+    def reach(self, roots):
+        ''' roots からたどり着けるブロックの番号の集合 '''
+        seen = set(roots)
+        stack = list(roots)
+        while stack:
+            for t in self.successors(stack.pop()):
+                if t not in seen:
+                    seen.add(t)
+                    stack.append(t)
+        return seen
+
+
+def prune(head, body, tail, lib):
+    '''
+    lib のうち、たどり着けるブロックの命令だけを残す。
+    (残した lib の列, 除いた Inst の列) を返す。lib そのものは書き換えない
+    '''
+    chain = body + tail + lib
+    if any(peephole.offset_index(inst) is not None for inst in chain):
+        return (list(lib), [])
+    g = Graph([head, chain])
+    offset = len(body) + len(tail)
+    roots = [b for (b, (k, start, end)) in enumerate(g.blocks) if k == 0 or start < offset]
+    live = g.reach(roots)
+
+    kept = []
+    removed = []
+    b = g.block_at(1, offset) if lib else None
+    for (j, inst) in enumerate(lib, offset):
+        if (1, j) in g.starts:
+            b = g.starts[(1, j)]
+        if b in live:
+            kept.append(inst)
+        else:
+            removed.append(inst)
+    return (kept, removed)
+
+
+class TestReach(unittest.TestCase):
+    lib = '''\t.text
+min_caml_print_int:
+\taddi\tsp, sp, -8
+\tcall\tmin_caml_helper
+\tret
+min_caml_helper:
+\tbeq a0, a1, .L1
+\tadd\ta0, a0, 1
+.L1:
+\tret
+min_caml_unused:
+\tli\ta1, min_caml_table
+\tjr\tra
+min_caml_table:
+\t.word\t1
+min_caml_fall:
+\tnop
+min_caml_next:
+\tret
+'''
+
+    def prune(self, src, prologue=True):
+        import assembler
+        import ir
+        a = assembler.Assembler(lib='')
+        head = ir.parse(a.prologue.split('\n'), '<prologue>') if prologue else []
+        tail = ir.parse(a.epilogue.split('\n'), '<epilogue>')
+        lib = ir.parse(self.lib.split('\n'), 'libmincaml.S')
+        (kept, removed) = prune(head, ir.parse(src.split('\n'), 'a.s'), tail, lib)
+        self.assertEqual(len(kept) + len(removed), len(lib))
+        return sorted(inst.tag for inst in kept if inst.tag is not None)
+
+    def test_call(self):
+        self.assertEqual(self.prune('_min_caml_start:\n\tcall min_caml_print_int\n'),
+                         ['.L1', 'min_caml_helper', 'min_caml_print_int'])
+        self.assertEqual(self.prune('_min_caml_start:\n\tret\n'), [])
+
+    def test_reference(self):
+        # li で入れたアドレスや、fall through の先も残す (.word の後も続いているとみなす)
+        self.assertEqual(self.prune('_min_caml_start:\n\tli a0, min_caml_unused\n'),
+                         ['min_caml_fall', 'min_caml_next', 'min_caml_table', 'min_caml_unused'])
+        self.assertEqual(self.prune('_min_caml_start:\n\tj min_caml_fall\n'),
+                         ['min_caml_fall', 'min_caml_next'])
+
+    def test_dead_program(self):
+        # 呼ばれない関数もエンコードするので、そこから呼ぶものは残す
+        src = 'f:\n\tcall min_caml_helper\n\tret\n_min_caml_start:\n\tret\n'
+        self.assertEqual(self.prune(src), ['.L1', 'min_caml_helper'])
+        self.assertEqual(self.prune(src, prologue=False), ['.L1', 'min_caml_helper'])
+
+        from assembler import Assembler
+        src = 'f:\n\tcall min_caml_print_int\n\tret\n_min_caml_start:\n\tret\n'
+        a = Assembler(lib=self.lib)
+        image = a.assemble(src)
+        self.assertIn('min_caml_print_int', a.tags)
+        self.assertNotIn('min_caml_unused', a.tags)
+        full = Assembler(lib=self.lib, prune_lib=False).assemble(src)
+        self.assertEqual(full[:len(image)], image)
+
+    def test_numeric_offset(self):
+        # 数で書いた飛び先があれば、ライブラリを全部残す
+        import ir
+        tags = sorted(inst.tag for inst in ir.parse(self.lib.split('\n'), 'libmincaml.S')
+                      if inst.tag is not None)
+        self.assertEqual(self.prune('_min_caml_start:\n\tbeq a0, a1, 2\n\tret\n'), tags)
+        f = 'min_caml_f:\n\tbeq a0, a1, 2\n\tret\nmin_caml_g:\n\taddi a0, a0, 1\n\tret\n'
+        self.lib += f
+        self.assertEqual(self.prune('_min_caml_start:\n\tcall min_caml_f\n'),
+                         sorted(tags + ['min_caml_f', 'min_caml_g']))
+
+        from assembler import Assembler
+        src = '_min_caml_start:\n\tcall min_caml_f\n'
+        self.assertEqual(Assembler(lib=f).assemble(src),
+                         Assembler(lib=f, prune_lib=False).assemble(src))
+
+    def test_assemble(self):
+        from assembler import Assembler
+        src = '_min_caml_start:\n\tcall min_caml_helper\n'
+        a = Assembler(lib=self.lib)
+        small = a.assemble(src)
+        self.assertNotIn('min_caml_print_int', a.tags)
+        full = Assembler(lib=self.lib, prune_lib=False).assemble(src)
+        self.assertEqual(len(full) - len(small), 4 * 3 + 4 * 2 + 4 + 4 + 4)
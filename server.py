@@ -0,0 +1,246 @@
+'''
+ # --serve モード
+
+ `python main.py --serve` とすると、Unix ソケットで待ち受けてアセンブルの要求を受け付ける。
+ 毎回のプロセス起動、モジュールの読み込み、ヒープのイメージやライブラリのパース
+ (--lib-base があればライブラリのリンク)を最初に一度だけ済ませておくので、
+ 一回のアセンブルはユーザーのプログラムの分だけで済む。
+
+ - 接続は asyncio で受け、アセンブルはワーカープロセス(-j 個)のプールに投げる。
+   ワーカーは起動時にライブラリなどを読み込んだ Assembler を一つ持つ
+ - プロトコルとクライアントは client.py
+'''
+
+import asyncio
+import concurrent.futures
+import contextlib
+import io
+import json
+import os
+import socket
+import stat
+import unittest
+
+import client
+import formats
+from assembler import Assembler
+
+
+# ワーカープロセスごとのアセンブラ
+_worker = None
+
+
+def init_worker(lib, lib_base, use_lib_cache, optimize=False, prune_lib=True):
+    global _worker
+    _worker = Assembler(lib=lib, lib_base=lib_base, use_lib_cache=use_lib_cache,
+                        optimize=optimize, prune_lib=prune_lib)
+    with contextlib.redirect_stdout(io.StringIO()):
+        _worker.preload()
+
+
+def assemble_job(source, filename, prologue, fmt):
+    ''' (出力, タグの表, エラー) を返す '''
+    log = io.StringIO()
+    try:
+        with contextlib.redirect_stdout(log):
+            image = _worker.assemble(source, filename=filename, prologue=prologue)
+        out = formats.render(image, fmt)
+    except Exception as e:
+        l = log.getvalue().splitlines()[-5:]
+        l.append('{}: {}'.format(type(e).__name__, e))
+        return (None, None, '\n'.join(l))
+    return (out, _worker.tags, None)
+
+
+def read_header(line):
+    ''' (ヘッダ, エラー) を返す。要求のヘッダの行が読めなければヘッダは None '''
+    try:
+        header = json.loads(line)
+    except ValueError:
+        return (None, 'ヘッダが JSON ではありません')
+    if not isinstance(header, dict):
+        return (None, 'ヘッダが JSON のオブジェクトではありません')
+    n = header.get('length')
+    if type(n) is not int or n < 0:
+        return (None, 'ヘッダの length が0以上の整数ではありません')
+    return (header, None)
+
+
+def claim_socket(path):
+    '''
+    path で待ち受けられるようにする。前のサーバーが残した古いソケットなら消す。
+    サーバーが応答するときや、ソケットでないものがあるときは消さずに例外
+    '''
+    try:
+        st = os.lstat(path)
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(st.st_mode):
+        print('{} はソケットではないので使えません'.format(path))
+        raise Exception('Socket Error')
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        try:
+            s.connect(path)
+        except (ConnectionRefusedError, FileNotFoundError):
+            os.remove(path)
+            return
+    print('{} では既にサーバーが動いています'.format(path))
+    raise Exception('Socket Error')
+
+
+class Server:
+    def __init__(self, path, asm, jobs=1):
+        # asm の設定(ライブラリとその置き方)でワーカーを作る
+        self.path = path
+        self.jobs = jobs
+        self.lib = asm.get_lib_data()
+        self.lib_base = asm.lib_base
+        self.use_lib_cache = asm.use_lib_cache
+        self.optimize = asm.optimize
+        self.prune_lib = asm.prune_lib
+        self.pool = None
+        self.server = None
+        # 処理中の接続
+        self.clients = set()
+
+    async def handle(self, reader, writer):
+        loop = asyncio.get_running_loop()
+        task = asyncio.current_task()
+        self.clients.add(task)
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                (header, error) = read_header(line)
+                if header is None:
+                    # 本体の長さが分からないので読まずに、次の行を要求として待つ
+                    reply = {'error': error, 'tags': None, 'length': 0}
+                    writer.write(json.dumps(reply).encode('utf-8') + b'\n')
+                    await writer.drain()
+                    continue
+                source = (await reader.readexactly(header['length'])).decode('utf-8')
+                (out, tags, error) = await loop.run_in_executor(
+                    self.pool, assemble_job, source,
+                    header.get('filename', '<source>'),
+                    header.get('prologue', True), header.get('format', 'raw'))
+                if out is None:
+                    out = b''
+                reply = {'error': error, 'tags': tags, 'length': len(out)}
+                writer.write(json.dumps(reply).encode('utf-8') + b'\n')
+                writer.write(out)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+            self.clients.discard(task)
+
+    async def start(self):
+        claim_socket(self.path)
+        self.pool = concurrent.futures.ProcessPoolExecutor(
+            self.jobs, initializer=init_worker,
+            initargs=(self.lib, self.lib_base, self.use_lib_cache, self.optimize,
+                      self.prune_lib))
+        # ワーカーを全部立ち上げて、ライブラリの読み込みを済ませておく
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*[loop.run_in_executor(self.pool, os.getpid)
+                               for i in range(self.jobs)])
+
+        self.server = await asyncio.start_unix_server(self.handle, path=self.path)
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+        await asyncio.gather(*self.clients, return_exceptions=True)
+        self.pool.shutdown()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    async def run(self):
+        await self.start()
+        print('listening on {} ({} workers)'.format(self.path, self.jobs))
+        try:
+            await self.server.serve_forever()
+        finally:
+            await self.stop()
+
+
+def serve(path, asm, jobs=1):
+    try:
+        asyncio.run(Server(path, asm, jobs).run())
+    except KeyboardInterrupt:
+        pass
+
+
+class TestServer(unittest.TestCase):
+    lib = 'min_caml_hoge:\n\tli a0, min_caml_hoge\n\tret\n'
+
+    def test_request(self):
+        import tempfile
+        with tempfile.TemporaryDirectory() as d:
+            asyncio.run(self.run_clients(os.path.join(d, 'asm.sock')))
+
+    async def run_clients(self, path):
+        server = Server(path, Assembler(lib=self.lib), jobs=2)
+        await server.start()
+        try:
+            # クライアントはブロックするので別のスレッドで動かす
+            await asyncio.get_running_loop().run_in_executor(None, self.check, path)
+        finally:
+            await server.stop()
+
+    def check(self, path):
+        src = '_min_caml_start:\n\tcall min_caml_hoge\n\tj _min_caml_start\n'
+        (header, body) = client.request(path, src)
+        self.assertIsNone(header['error'])
+        a = Assembler(lib=self.lib)
+        self.assertEqual(body, a.assemble(src))
+        self.assertEqual(header['tags'], a.tags)
+
+        (header, body) = client.request(path, src, prologue=False, fmt='coe')
+        self.assertEqual(body, formats.render(a.assemble(src, prologue=False), 'coe'))
+
+        (header, body) = client.request(path, 'hoge a0\n', 'bad.s')
+        self.assertIn('bad.s:1', header['error'])
+
+        # おかしなヘッダにはエラーを返し、同じ接続で次の要求を受ける
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+            s.connect(path)
+            f = s.makefile('rwb')
+            for line in [b'{"filename": "a.s"}', b'[1]', b'{"length": "3"}',
+                         b'{"length": -1}', b'{"length": true}', b'hoge']:
+                f.write(line + b'\n')
+                f.flush()
+                (header, body) = client.receive(f)
+                self.assertIsNotNone(header['error'])
+                self.assertEqual(body, b'')
+            client.send(f, {}, src.encode('utf-8'))
+            (header, body) = client.receive(f)
+            self.assertIsNone(header['error'])
+            self.assertEqual(body, a.assemble(src))
+
+        # 動いているサーバーのソケットは取らない
+        with self.assertRaises(Exception):
+            claim_socket(path)
+        self.assertTrue(os.path.exists(path))
+
+    def test_claim(self):
+        import tempfile
+        with tempfile.TemporaryDirectory() as d:
+            # ソケットでないものは消さない
+            path = os.path.join(d, 'file')
+            with open(path, 'w') as f:
+                f.write('x')
+            with self.assertRaises(Exception):
+                claim_socket(path)
+            self.assertTrue(os.path.exists(path))
+
+            # 誰も待ち受けていない古いソケットは消す
+            path = os.path.join(d, 'asm.sock')
+            s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            s.bind(path)
+            s.close()
+            claim_socket(path)
+            self.assertFalse(os.path.exists(path))
+            claim_socket(path)
@@ -0,0 +1,163 @@
+'''
+ # --stats
+
+ どこに時間とメモリを使っているかを測る。
+
+ - フェーズ(ライブラリの準備、パース、エンコード、fixup、書き出しなど)ごとの時間。
+   Chrome の trace 形式 (chrome://tracing, Perfetto) でも書き出せる
+ - 命令ごとに呼ばれるもの(タグの解決、エンコード、疑似命令の展開)の合計時間と回数。
+   Assembler のインスタンスのメソッドを測るものに差し替えて測る
+ - 行数、ニーモニックごとの命令数、疑似命令の数、タグを引いた回数
+ - tracemalloc で測ったメモリのピーク
+
+ --stats を付けなければ Stats は作られず、差し替えも起きないので、何もしないのと同じ。
+'''
+
+import collections
+import contextlib
+import json
+import os
+import threading
+import time
+import tracemalloc
+import unittest
+
+
+class Stats:
+    def __init__(self, memory=True):
+        self.t0 = time.perf_counter()
+        # name -> [回数, 秒]
+        self.phases = {}
+        self.hot = {}
+        # Chrome trace 用: (name, 開始, 長さ) (秒)
+        self.events = []
+        self.counters = collections.Counter()
+        self.mnemonics = collections.Counter()
+        self.memory = memory
+        if memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            d = time.perf_counter() - t
+            p = self.phases.setdefault(name, [0, 0.0])
+            p[0] += 1
+            p[1] += d
+            self.events.append((name, t - self.t0, d))
+
+    def timed(self, name, f):
+        ''' f を、呼ばれた回数と合計時間を数えるものに包む。再帰した分は外側だけ測る '''
+        h = self.hot.setdefault(name, [0, 0.0])
+        depth = [0]
+        clock = time.perf_counter
+
+        def g(*args):
+            h[0] += 1
+            if depth[0]:
+                return f(*args)
+            depth[0] += 1
+            t = clock()
+            try:
+                return f(*args)
+            finally:
+                h[1] += clock() - t
+                depth[0] -= 1
+        return g
+
+    def counted(self, name, f):
+        counters = self.counters
+
+        def g(*args):
+            counters[name] += 1
+            return f(*args)
+        return g
+
+    def count_insts(self, insts):
+        for inst in insts:
+            if inst.op is None:
+                continue
+            self.counters['instructions'] += 1
+            self.mnemonics[inst.op.name] += 1
+            if inst.op.expand is not None:
+                self.counters['pseudo-op expansions'] += 1
+
+    def report(self):
+        r = {
+            'total': time.perf_counter() - self.t0,
+            'phases': {k: {'calls': n, 'seconds': t} for (k, (n, t)) in self.phases.items()},
+            'hot': {k: {'calls': n, 'seconds': t} for (k, (n, t)) in self.hot.items()},
+            'counters': dict(self.counters),
+            'mnemonics': dict(self.mnemonics.most_common()),
+        }
+        if self.memory and tracemalloc.is_tracing():
+            (current, peak) = tracemalloc.get_traced_memory()
+            r['memory'] = {'current': current, 'peak': peak}
+        return r
+
+    def text(self):
+        r = self.report()
+        l = ['{:24} {:>10} {:>12}'.format('phase', 'calls', 'ms')]
+        for (k, v) in r['phases'].items():
+            l.append('{:24} {:>10} {:>12.2f}'.format(k, v['calls'], v['seconds'] * 1000))
+        l.append('{:24} {:>10} {:>12.2f}'.format('total', '', r['total'] * 1000))
+        if r['hot']:
+            l.append('')
+            l.append('{:24} {:>10} {:>12}'.format('per instruction', 'calls', 'ms'))
+            for (k, v) in r['hot'].items():
+                l.append('{:24} {:>10} {:>12.2f}'.format(k, v['calls'], v['seconds'] * 1000))
+        l.append('')
+        for (k, v) in sorted(r['counters'].items()):
+            l.append('{:24} {:>10}'.format(k, v))
+        if 'memory' in r:
+            l.append('{:24} {:>10.1f} MB'.format('peak memory', r['memory']['peak'] / 2**20))
+        l.append('')
+        l.append('mnemonics: ' + ', '.join(
+            '{} {}'.format(k, v) for (k, v) in r['mnemonics'].items()))
+        return '\n'.join(l) + '\n'
+
+    def json(self):
+        return json.dumps(self.report(), indent=2) + '\n'
+
+    def write_trace(self, path):
+        pid = os.getpid()
+        tid = threading.get_ident()
+        events = [{'name': name, 'ph': 'X', 'ts': start * 1e6, 'dur': d * 1e6,
+                   'pid': pid, 'tid': tid}
+                  for (name, start, d) in self.events]
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+    def stop(self):
+        if self.memory and tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+
+def phase(stats, name):
+    ''' stats が None なら何もしない '''
+    if stats is None:
+        return contextlib.nullcontext()
+    return stats.phase(name)
+
+
+class TestStats(unittest.TestCase):
+    def test_stats(self):
+        s = Stats(memory=False)
+        with s.phase('a'):
+            pass
+        f = s.timed('f', lambda n: n if n == 0 else f(n - 1))
+        self.assertEqual(f(3), 0)
+        g = s.counted('g', lambda: 1)
+        g()
+        g()
+        r = s.report()
+        self.assertEqual(r['phases']['a']['calls'], 1)
+        self.assertEqual(r['hot']['f']['calls'], 4)
+        self.assertEqual(r['counters']['g'], 2)
+        self.assertEqual(len(s.events), 1)
+        json.loads(s.json())
+        self.assertIn('peak memory', Stats().text())
+        tracemalloc.stop()
@@ -0,0 +1,203 @@
+'''
+ # シンボル表
+
+ アセンブルし終わったもののタグを、名前・アドレス・セクション・大きさで引けるようにしたもの。
+ アセンブルの途中は Assembler.tags (名前 -> 語単位のアドレスの dict) だけを使い、
+ これは最後に Assembler.symbols で作る。
+
+ - 名前から引く: table[name] / name in table
+ - アドレスから引く: lookup(addr) はそのアドレスを含むシンボル。アドレスで整列した
+   表を二分探索するので O(log n)。lookup_many はまとめて引く (整列してから一度なめる)
+ - 範囲: between(lo, hi) は lo <= アドレス < hi のシンボル
+ - 同じ名前を二度 add すると後のものが有効で、collisions に (名前, 前のもの, 後のもの) を残す
+
+ 大きさは、同じセクションの次のシンボル (アドレスの違うもの) かセクションの終わりまで。
+
+ ## .map ファイル
+
+ 一行に一つ、アドレス順に `アドレス 大きさ セクション 名前` (アドレスと大きさはバイト単位の16進)。
+ `#` で始まる行は注釈。read_map で読み戻せる。
+'''
+
+import bisect
+import unittest
+
+
+class Symbol:
+    __slots__ = ('name', 'addr', 'section', 'size')
+
+    def __init__(self, name, addr, section, size=None):
+        self.name = name
+        # バイト単位
+        self.addr = addr
+        self.section = section
+        self.size = size
+
+    def __repr__(self):
+        return 'Symbol({}, {}, {}, {})'.format(self.name, hex(self.addr), self.section, self.size)
+
+
+class SymbolTable:
+    def __init__(self):
+        self.symbols = {}
+        # add で大きさを決めたものの名前
+        self.sized = set()
+        self.collisions = []
+        # セクション -> 終わりのアドレス
+        self.ends = {}
+        # アドレスで整列したもの。必要になったときに作る
+        self.addrs = None
+        self.sorted = None
+
+    def add(self, name, addr, section, size=None):
+        s = Symbol(name, addr, section, size)
+        old = self.symbols.get(name)
+        if old is not None:
+            self.collisions.append((name, old, s))
+        self.symbols[name] = s
+        if size is None:
+            self.sized.discard(name)
+        else:
+            self.sized.add(name)
+        self.addrs = None
+        return s
+
+    def end(self, section, addr):
+        ''' セクションの終わり。大きさの決まっていないシンボルはここまでになる '''
+        self.ends[section] = addr
+        self.addrs = None
+
+    def __contains__(self, name):
+        return name in self.symbols
+
+    def __getitem__(self, name):
+        return self.symbols[name]
+
+    def __len__(self):
+        return len(self.symbols)
+
+    def get(self, name):
+        return self.symbols.get(name)
+
+    def index(self):
+        if self.addrs is not None:
+            return
+        l = sorted(self.symbols.values(), key=lambda s: (s.addr, s.name))
+        # 大きさの決まっていないものは、同じセクションの次のシンボル (アドレスの違うもの) まで
+        last = {}
+        bound = {}
+        for s in reversed(l):
+            sec = s.section
+            if last.get(sec) != s.addr:
+                bound[sec] = last.get(sec, self.ends.get(sec, s.addr))
+                last[sec] = s.addr
+            if s.name not in self.sized:
+                s.size = max(0, bound[sec] - s.addr)
+        self.sorted = l
+        self.addrs = [s.addr for s in l]
+
+    def lookup(self, addr):
+        ''' addr を含むシンボル。無ければ None '''
+        self.index()
+        i = bisect.bisect_right(self.addrs, addr) - 1
+        # 同じアドレスのものが並んでいたら、大きさのあるものを探す
+        while i >= 0:
+            s = self.sorted[i]
+            if addr < s.addr + s.size:
+                return s
+            if i == 0 or self.addrs[i - 1] != s.addr:
+                return None
+            i -= 1
+        return None
+
+    def lookup_many(self, addrs):
+        ''' addrs のそれぞれを含むシンボルのリスト (順番は addrs のまま) '''
+        self.index()
+        order = sorted(range(len(addrs)), key=addrs.__getitem__)
+        out = [None] * len(addrs)
+        l = self.sorted
+        j = -1
+        for k in order:
+            a = addrs[k]
+            while j + 1 < len(l) and l[j + 1].addr <= a:
+                j += 1
+            # 同じアドレスが並んでいる所や、大きさ0のものは lookup に任せる
+            if j >= 0 and a < l[j].addr + l[j].size:
+                out[k] = l[j]
+            elif j >= 0:
+                out[k] = self.lookup(a)
+        return out
+
+    def between(self, lo, hi):
+        ''' lo <= アドレス < hi のシンボル (アドレス順) '''
+        self.index()
+        return self.sorted[bisect.bisect_left(self.addrs, lo):bisect.bisect_left(self.addrs, hi)]
+
+    def map_text(self):
+        self.index()
+        l = ['# address  size     section  name']
+        for s in self.sorted:
+            l.append('{:08x} {:08x} {} {}'.format(s.addr, s.size, s.section, s.name))
+        return '\n'.join(l) + '\n'
+
+    def write_map(self, path):
+        with open(path, 'w') as f:
+            f.write(self.map_text())
+
+
+def read_map(path):
+    t = SymbolTable()
+    with open(path) as f:
+        for line in f:
+            if line.startswith('#') or not line.strip():
+                continue
+            (addr, size, rest) = line.split(None, 2)
+            # セクション (ファイル名) には空白があるかもしれない
+            (section, name) = rest.rsplit(None, 1)
+            t.add(name, int(addr, 16), section, int(size, 16))
+    return t
+
+
+class TestSymbols(unittest.TestCase):
+    def table(self):
+        t = SymbolTable()
+        t.add('f', 0x100, 'a.s')
+        t.add('f.1', 0x100, 'a.s')
+        t.add('g', 0x120, 'a.s')
+        t.end('a.s', 0x140)
+        t.add('x', 0x40, 'heap', 8)
+        t.add('lib', 0x140, 'my lib.S')
+        t.end('my lib.S', 0x150)
+        return t
+
+    def test_lookup(self):
+        t = self.table()
+        t.index()
+        self.assertEqual([t[n].size for n in ('f', 'f.1', 'g', 'x')], [0x20, 0x20, 0x20, 8])
+        self.assertEqual(t.lookup(0x11c).name, 'f.1')
+        self.assertEqual(t.lookup(0x120).name, 'g')
+        self.assertEqual(t.lookup(0x44).name, 'x')
+        self.assertIsNone(t.lookup(0x48))
+        self.assertIsNone(t.lookup(0x10))
+        self.assertEqual(t.lookup(0x14f).name, 'lib')
+        self.assertIsNone(t.lookup(0x150))
+        pcs = [0x14f, 0x10, 0x100, 0x48, 0x104, 0x120]
+        self.assertEqual(t.lookup_many(pcs), [t.lookup(a) for a in pcs])
+        self.assertEqual([s.name for s in t.between(0x100, 0x140)], ['f', 'f.1', 'g'])
+
+    def test_collision(self):
+        t = self.table()
+        t.add('g', 0x130, 'a.s')
+        self.assertEqual(t['g'].addr, 0x130)
+        self.assertEqual([(n, a.addr, b.addr) for (n, a, b) in t.collisions], [('g', 0x120, 0x130)])
+
+    def test_map(self):
+        import os
+        import tempfile
+        t = self.table()
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'a.map')
+            t.write_map(path)
+            r = read_map(path)
+        self.assertEqual(r.map_text(), t.map_text())
+        self.assertEqual(r.lookup(0x104).name, 'f.1')
@@ -1,4 +1,27 @@
 from main import *
+from bench.gen import TestGen
+from assembler import TestAsm
+from assembler import TestAssembler
+from assembler import TestFixup
+from assembler import TestRelax
+from directive import TestDirective
+from disasm import TestDisasm
+from formats import TestFormats
+from heap import TestHeap
+from ir import TestConstantRegex
+from ir import TestDirectiveRegex
+from ir import TestDisplacementRegex
+from ir import TestOperationRegex
+from ir import TestParse
+from lexer import TestLexer
+from library import TestCache
+from optable import TestEncoding
+from peephole import TestPeephole
+from reach import TestReach
+from server import TestServer
+from stats import TestStats
+from symbols import TestSymbols
+from watch import TestWatch
 
 if __name__ == '__main__':
     test()
@@ -44,10 +44,26 @@ reg_d = {
 }
 
 
+# レジスタ名 -> 番号。x0..x31, f0..f31 (x05 のような0埋めも), ABI名, f を前に付けたABI名
+regs = {}
+for i in range(32):
+    for p in ('x', 'f'):
+        regs['{}{}'.format(p, i)] = i
+        regs['{}{:02}'.format(p, i)] = i
+for (k, v) in reg_d.items():
+    regs.setdefault(k, v)
+    regs.setdefault('f' + k, v)
+
+
 def get_reg(name):
+    if type(name) == str:
+        r = regs.get(name)
+        if r is not None:
+            return r
     if type(name) != str and type(name) != bytes:
         return None
 
+    # 表に無い書き方 (x1_0 など) は今まで通りに解釈する
     m = re.match(r'(x|f)\d{1,2}', name)
     if m is not None:
         if int(name[1:]) < 32:
@@ -61,15 +77,16 @@ def get_reg(name):
 
 
 def is_reservations(name):
-    r = get_reg(name)
-    if r is not None:
-        return True
-    return False
+    return get_reg(name) is not None
 
 
 def is_number(name):
-    m = re.match(r'^-?\d+$', name)
-    return m is not None
+    # ^-?\d+$ と同じ
+    if name[:1] == '-':
+        name = name[1:]
+    if name[-1:] == '\n':
+        name = name[:-1]
+    return name.isdecimal()
 
 
 def num2str(s):
@@ -77,15 +94,18 @@ def num2str(s):
 
 
 def is_special(name):
-    return is_number(name) or is_reservations(name)
+    return name in regs or is_number(name) or is_reservations(name)
 
 
 def int2uint(imm, bit_len=32):
     return ctypes.c_ulong(imm).value & (2 ** bit_len - 1)
 
 
+u32b = struct.Struct('<L').pack
+
+
 def int2u32b(v):
-    return struct.pack('<L', int2uint(v))
+    return u32b(int2uint(v))
 
 
 def check_and_trans_reg(name):
@@ -123,36 +143,14 @@ def check_alignment(imm, size):
 
 
 def pack(tuples):
-
-    # MSBとLSBが分からなかった人間の末路
-    reordered = []
-    for (x, l) in tuples:
-        val = 0
-        for _ in range(l):
-            tmp = x & 1
-            x >>= 1
-            val <<= 1
-            val |= tmp
-        reordered.append((val, l))
-    tuples = reordered
-    # check
+    # 先頭の要素から順にLSB側に詰めていく
     cnt = 0
     val = 0
     for (code, length) in tuples:
-        val <<= length
-        val += code
+        val |= (code & ((1 << length) - 1)) << cnt
         cnt += length
 
-    # 悲しいね
-    # MSBとLSBも分からない人間になった。人生終了です
-    ret = 0
-    for _ in range(32):
-        tmp = val & 1
-        val >>= 1
-        ret <<= 1
-        ret |= tmp
-
     if cnt != INST_LEN:
         print('アセンブラがバグっていて、命令の長さが32bitになっていません')
         raise Exception('Bit Length Error')
-    return struct.pack('<L', ret)
+    return u32b(val)
@@ -0,0 +1,294 @@
+'''
+ # watch モード
+
+ `python main.py --watch prog.s` とすると、prog.s が書き換わるたびにアセンブルし直す。
+ 前回の結果をメモリに持っておき、変わったところだけをやり直す。
+
+ - ソースはタグのある行で区切ってブロックにする。前回と同じテキストのブロックは
+   パース結果と機械語をそのまま使い、変わったブロックだけをパースしてエンコードする
+ - ブロックの先頭アドレスを並べ直してタグの表を作る。ブロック内の位置は変わらないので、
+   ここではタグの数しか見ない
+ - タグを参照している命令は、解決した引数の値を覚えておく。値が変わったもの
+   (参照先との距離が変わった相対参照、参照先が動いた絶対参照)だけをエンコードし直す
+ - 出力ファイルは、全体の大きさが変わらなければ変わったバイトだけを書き換える
+ - 分岐の飛び先が届かなくなったら、そのブロックを緩和してエンコードし直す
+   (一度緩和した分岐は、届くようになってもそのまま)
+ - ブロックの長さは置く場所によらないとしているので、4バイトより大きい .align は使えない
+'''
+
+import os
+import time
+import unittest
+
+import assembler
+import formats
+import heap
+import ir
+import lexer
+
+
+class Block:
+    __slots__ = ('text', 'insts', 'code', 'labels', 'refs', 'start', 'fixed')
+
+    def __init__(self, text, insts, fixed=None):
+        self.text = text
+        self.insts = insts
+        self.code = bytearray()
+        # (タグ, ブロック内の位置)
+        self.labels = []
+        # [ブロック内の位置, Inst, 前回解決した引数]
+        self.refs = []
+        self.start = None
+        # 置く場所が決まっているブロック
+        self.fixed = fixed
+
+
+def split_blocks(lines):
+    ''' タグのある行で区切って、(先頭の行番号, 行のリスト) の列にする '''
+    blocks = []
+    cur = []
+    start = 1
+    for (i, line) in enumerate(lines, 1):
+        if cur and lexer.tag(line.strip()) is not None:
+            blocks.append((start, cur))
+            cur = []
+            start = i
+        cur.append(line)
+    if cur:
+        blocks.append((start, cur))
+    return blocks
+
+
+class Watcher:
+    def __init__(self, asm, filename, output, fmt='raw', prologue=True):
+        # asm は assembler.Assembler。ライブラリの置き方はこれの設定に従う
+        self.asm = asm
+        self.filename = filename
+        self.output = output
+        self.format = formats.lookup(fmt)
+        lib_base = asm.lib_base
+        self.lib_tags = {}
+
+        self.head = []
+        self.tail = []
+        self.blocks = []
+        self.size = None
+        # ユーザーのプログラムの最初のブロック。ここから program_start に置く
+        self.blocks_start = None
+
+        if lib_base is not None:
+            assembler.check_lib_base(lib_base)
+            (lib_image, self.lib_tags) = asm.load_lib()
+
+        if prologue:
+            b = self.new_block('', asm.prologue.split('\n'), '<prologue>', 1, fixed=0)
+            self.head.append(b)
+        h = Block('', [], fixed=heap.base)
+        h.code = assembler.heap_image()
+        self.head.append(h)
+
+        self.tail.append(self.new_block('', asm.epilogue.split('\n'), '<epilogue>', 1))
+        if lib_base is None:
+            lib = asm.get_lib_data()
+            self.tail.append(self.new_block('', lib.split('\n'), 'libmincaml.S', 1))
+        else:
+            lib = Block('', [], fixed=lib_base)
+            lib.code = bytearray(lib_image)
+            self.tail.append(lib)
+
+    def new_block(self, text, lines, source, start, fixed=None):
+        b = Block(text, ir.parse(lines, source, start, self.asm.verbose), fixed)
+        for inst in b.insts:
+            # ブロックの中の位置だけでは、語より大きい境界に揃えられない
+            if inst.op is not None and inst.op.name == '.align' and \
+                    inst.op.directive.alignment(inst.args) > 4:
+                ir.error_line(inst.source, inst.lineno, inst)
+                print('--watch では4バイトより大きい .align は使えません')
+                raise Exception('Watch Error')
+        self.encode_block(b)
+        return b
+
+    def encode_block(self, b):
+        # タグがまだ決まらないので、参照は全部仮の値でエンコードしておく(長さは変わらない)
+        # 後の link で必ずエンコードし直される
+        asm = self.asm
+        asm.tags = {}
+        asm.use_place_holder = True
+        code = bytearray()
+        b.labels = []
+        b.refs = []
+        for inst in b.insts:
+            if inst.tag is not None:
+                b.labels.append((inst.tag, len(code)))
+            if inst.op is None:
+                continue
+            asm.read_bytes = len(code)
+            if inst.refs is not None:
+                b.refs.append([len(code), inst, None])
+            code += asm.encode(inst)
+        b.code = code
+
+    def update(self):
+        ''' ソースを読み直して、ユーザーのブロックの列を作る。(新しい列, 作り直した数) '''
+        with open(self.filename) as f:
+            lines = f.readlines()
+
+        old = {}
+        for b in self.blocks:
+            old.setdefault(b.text, []).append(b)
+
+        blocks = []
+        fresh = 0
+        for (start, l) in split_blocks(lines):
+            text = ''.join(l)
+            if old.get(text):
+                blocks.append(old[text].pop())
+            else:
+                blocks.append(self.new_block(text, l, self.filename, start))
+                fresh += 1
+        return (blocks, fresh)
+
+    def link(self, seq):
+        ''' アドレスを割り当て直し、値の変わった参照だけエンコードし直す '''
+        asm = self.asm
+        dirty = []
+        addr = 0
+        tags = dict(assembler.builtin_tags)
+        for b in seq:
+            if b is self.blocks_start:
+                addr = assembler.program_start
+            if b.fixed is not None:
+                assembler.check_overlap(addr, b.fixed)
+                addr = b.fixed
+            if b.start != addr:
+                dirty.append(b)
+            b.start = addr
+            for (name, offset) in b.labels:
+                tags[name] = (addr + offset) // 4
+            addr += len(b.code)
+        tags.update(self.lib_tags)
+
+        asm.tags = tags
+        # 届かない分岐があれば、そのブロックを緩和してエンコードし直し、置き直す
+        grown = self.relax(seq)
+        if grown:
+            for b in grown:
+                self.encode_block(b)
+                b.start = None
+            return self.link(seq)
+
+        asm.use_place_holder = False
+        patched = 0
+        for b in seq:
+            for ref in b.refs:
+                (offset, inst, prev) = ref
+                asm.read_bytes = b.start + offset
+                args = asm.resolve_args(inst)
+                if args == prev:
+                    continue
+                c = asm.encode(inst, args)
+                b.code[offset:offset + len(c)] = c
+                ref[2] = args
+                patched += 1
+                if not dirty or dirty[-1] is not b:
+                    dirty.append(b)
+        return (dirty, patched)
+
+    def relax(self, seq):
+        ''' 飛び先に届かなくなった分岐を緩和し、長さの変わるブロックを返す '''
+        grown = []
+        for b in seq:
+            placed = [(b.start + offset, inst) for (offset, inst, prev) in b.refs]
+            if self.asm.relax(placed):
+                grown.append(b)
+        return grown
+
+    def rebuild(self):
+        t = time.perf_counter()
+        (blocks, fresh) = self.update()
+        seq = self.head + blocks + self.tail
+        # ユーザーのプログラムは program_start から
+        self.blocks_start = blocks[0] if blocks else self.tail[0]
+        (dirty, patched) = self.link(seq)
+        self.blocks = blocks
+
+        image = bytearray()
+        for b in seq:
+            image += bytes(b.start - len(image))
+            image += b.code
+        self.write(image, dirty)
+
+        print('{}: {} blocks, {} re-encoded, {} references patched, {:.1f} ms'.format(
+            self.filename, len(blocks), fresh, patched,
+            (time.perf_counter() - t) * 1000))
+        return image
+
+    def write(self, image, dirty):
+        if not self.format.raw or self.size != len(image) or not os.path.exists(self.output):
+            self.format.write(self.output, image)
+            self.size = len(image)
+            return
+
+        # 大きさが変わらなければ、変わったブロックだけ書き換える
+        with open(self.output, 'r+b') as f:
+            for b in dirty:
+                f.seek(b.start)
+                f.write(b.code)
+
+    def run(self, interval=0.2):
+        mtime = None
+        while True:
+            try:
+                m = os.stat(self.filename).st_mtime_ns
+            except OSError:
+                m = None
+            if m is not None and m != mtime:
+                mtime = m
+                try:
+                    self.rebuild()
+                except Exception as e:
+                    print('{}: {}'.format(self.filename, e))
+            time.sleep(interval)
+
+
+class TestWatch(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        self.asm = assembler.Assembler(lib='min_caml_hoge:\n\tli a0, min_caml_hoge\n\tret\n')
+        self.tmp = tempfile.TemporaryDirectory()
+        self.src = os.path.join(self.tmp.name, 'a.s')
+        self.out = os.path.join(self.tmp.name, 'a.out')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write(self, s):
+        with open(self.src, 'w') as f:
+            f.write(s)
+
+    def check(self, w):
+        image = w.rebuild()
+        with open(self.out, 'rb') as f:
+            self.assertEqual(f.read(), image)
+        self.assertEqual(image, assembler.Assembler(lib=self.asm.lib).assemble_file(self.src))
+
+    def test_rebuild(self):
+        self.write('_min_caml_start:\n\tcall f\n\tj end\nf:\n\tadd a0, a0, 1\n\tret\n'
+                   'end:\n\tli a1, f\n\tcall min_caml_hoge\n')
+        w = Watcher(self.asm, self.src, self.out)
+        self.check(w)
+
+        # 大きさの変わらない変更
+        self.write('_min_caml_start:\n\tcall f\n\tj end\nf:\n\tadd a0, a0, 2\n\tret\n'
+                   'end:\n\tli a1, f\n\tcall min_caml_hoge\n')
+        self.check(w)
+
+        # 後ろのブロックが動く変更
+        self.write('_min_caml_start:\n\tnop\n\tcall f\n\tj end\nf:\n\tadd a0, a0, 2\n\tret\n'
+                   'end:\n\tli a1, f\n\tcall min_caml_hoge\n')
+        self.check(w)
+
+        # 分岐が届かなくなる変更
+        self.write('_min_caml_start:\n\tbeq a0, a1, end\n\tcall f\n\tj end\nf:\n\tret\n'
+                   + '\tnop\n' * 2100 + 'end:\n\tcall min_caml_hoge\n')
+        self.check(w)